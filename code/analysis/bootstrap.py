@@ -0,0 +1,286 @@
+# coding: utf-8
+
+""" Vectorized parametric bootstrap of psychometric function thresholds.
+
+For every condition the maximum likelihood fit of psychometric.py is used
+to draw all B resampled binomial data sets as one (B, n_conditions,
+n_levels) array. All of them are refitted together with Fisher scoring
+(Newton steps with the expected information), warm-started at the original
+fit and from a coarse grid, with step halving and projection onto the
+parameter bounds. Data sets whose projected gradient has not vanished
+after that are refitted with the L-BFGS-B fitter of psychometric.py.
+Conditions are split into chunks that run in a process
+pool.
+
+Percentile and BCa intervals are returned. The BCa acceleration comes
+from the jackknife, which for binomial counts needs at most two refits per
+level (leaving out one correct or one incorrect trial), weighted by the
+counts.
+
+Example:
+    python bootstrap.py ../../results/experiment_1/all_data.parquet --experiment 1 -B 2000 --out expt_1_thresholds.csv
+"""
+
+import argparse
+import multiprocessing as mp
+import numpy as np
+from scipy import stats
+import psychometric as pm
+
+
+''' --------  Batched refitting  ---------'''
+
+def projected_gradient(params, grad, bounds):
+    """Largest component of the gradient projected onto the parameter bounds, per data set.
+
+    Zero at a (bounded) stationary point; components that push a
+    parameter out of its bounds do not count.
+    """
+    pg = params - np.clip(params - grad, bounds[..., 0], bounds[..., 1])
+    return np.abs(pg).max(axis=1)
+
+
+def newton_fit(params, u, k, n, sigmoid, bounds, gamma=pm.GUESS_RATE, n_iter=30, gtol=1e-5):
+    """Refit many data sets at once with damped Fisher scoring.
+
+    Args:
+        params (array): (m, 3) start values (mu, log width, lapse)
+        u (array): (m, n_levels) stimulus levels (see psychometric.stimulus_scale)
+        k, n (array): (m, n_levels) correct and total trials
+        sigmoid (string): see psychometric.SIGMOIDS
+        bounds (array): (m, 3, 2) parameter bounds
+        gamma (float): guess rate
+        n_iter (int): maximum number of steps
+        gtol (float): a data set has converged when its projected gradient
+            (see projected_gradient) is below this
+    Returns:
+        params (array): (m, 3) fitted parameters
+        converged (array): (m,) bool
+    """
+    params = np.clip(params, bounds[..., 0], bounds[..., 1])
+    nll, grad, dpsi, p = pm.nll_and_grad(params, u, k, n, sigmoid, gamma)
+    converged = projected_gradient(params, grad, bounds) < gtol
+    eye = np.eye(3)
+    for _ in range(n_iter):
+        if converged.all():
+            break
+        info = np.einsum('ml,mli,mlj->mij', n / (p * (1 - p)), dpsi, dpsi)
+        # parameters at a bound with the gradient pointing outwards stay fixed:
+        fixed = ((params <= bounds[..., 0]) & (grad > 0)) | ((params >= bounds[..., 1]) & (grad < 0))
+        free = ~fixed
+        info = info * (free[:, :, None] & free[:, None, :]) + fixed[:, :, None] * eye
+        # ridge relative to the free block only: a lapse of 0 with psi near 1 has a
+        # huge information that would otherwise swamp the other parameters' steps
+        info += 1e-9 * (np.trace(info, axis1=1, axis2=2)[:, None, None] + 1) * eye
+        step = -np.linalg.solve(info, (grad * free)[..., None])[..., 0]
+        scale = np.ones(len(params))
+        # converged data sets take no further steps
+        improved = converged.copy()
+        new_params, new_nll = params.copy(), nll.copy()
+        for _ in range(8):
+            todo = ~improved
+            if not todo.any():
+                break
+            trial = np.clip(params[todo] + scale[todo, None] * step[todo],
+                            bounds[todo, :, 0], bounds[todo, :, 1])
+            trial_nll = pm.nll_and_grad(trial, u[todo], k[todo], n[todo], sigmoid, gamma)[0]
+            ok = trial_nll <= nll[todo]
+            idx = np.flatnonzero(todo)
+            new_params[idx[ok]] = trial[ok]
+            new_nll[idx[ok]] = trial_nll[ok]
+            improved[idx[ok]] = True
+            scale[idx[~ok]] /= 2
+        params = new_params
+        nll, grad, dpsi, p = pm.nll_and_grad(params, u, k, n, sigmoid, gamma)
+        converged = projected_gradient(params, grad, bounds) < gtol
+    return params, converged
+
+
+def refit(params, u, k, n, sigmoid, bounds, gamma=pm.GUESS_RATE, chunk_size=16):
+    """newton_fit from the warm start and from a grid start, keeping the better fit.
+
+    The grid start (psychometric.start_values) catches resampled data sets
+    whose likelihood has its maximum away from the original fit. Data sets
+    on which Fisher scoring stalls are refitted from their best point with
+    psychometric.minimize_nll (L-BFGS-B), chunk_size at a time.
+    """
+    warm, warm_ok = newton_fit(params, u, k, n, sigmoid, bounds, gamma)
+    cold, cold_ok = newton_fit(pm.start_values(u, k, n, sigmoid, bounds), u, k, n, sigmoid, bounds, gamma)
+    warm_nll = pm.nll_and_grad(warm, u, k, n, sigmoid, gamma)[0]
+    cold_nll = pm.nll_and_grad(cold, u, k, n, sigmoid, gamma)[0]
+    better = cold_nll < warm_nll
+    warm[better] = cold[better]
+    warm_nll[better] = cold_nll[better]
+    converged = np.where(better, cold_ok, warm_ok)
+
+    todo = np.flatnonzero(~converged)
+    for i in range(0, len(todo), chunk_size):
+        idx = todo[i:i + chunk_size]
+        fit = pm.minimize_nll(warm[idx], u[idx], k[idx], n[idx], sigmoid, bounds[idx], gamma)
+        ok = pm.nll_and_grad(fit, u[idx], k[idx], n[idx], sigmoid, gamma)[0] < warm_nll[idx]
+        warm[idx[ok]] = fit[ok]
+    return warm
+
+
+def _jackknife(params, u, k, n, sigmoid, bounds, gamma):
+    """Leave-one-trial-out refits of every condition.
+
+    Returns:
+        mu (array): (n_conditions, 2 * n_levels) thresholds on the stimulus scale
+        w (array): matching weights (number of trials each refit stands for)
+    """
+    c, l = k.shape
+    # data set (i, j, 0) drops a correct trial at level j, (i, j, 1) an incorrect one
+    kk = np.repeat(k[:, None, :], 2 * l, axis=1).reshape(c, l, 2, l)
+    nn = np.repeat(n[:, None, :], 2 * l, axis=1).reshape(c, l, 2, l)
+    j = np.arange(l)
+    kk[:, j, 0, j] -= 1
+    nn[:, j, 0, j] -= 1
+    nn[:, j, 1, j] -= 1
+    w = np.stack([k, n - k], axis=2)  # (c, l, 2)
+    kk = np.maximum(kk, 0).reshape(c * 2 * l, l)
+    nn = np.maximum(nn, 0).reshape(c * 2 * l, l)
+    rep = lambda a: np.repeat(a, 2 * l, axis=0)
+    fit = refit(rep(params), rep(u), kk, nn, sigmoid, rep(bounds), gamma)
+    return fit[:, 0].reshape(c, 2 * l), w.reshape(c, 2 * l).astype(float)
+
+
+def bca_interval(theta_hat, boot, jack, jack_w, ci=0.95):
+    """BCa intervals.
+
+    Args:
+        theta_hat (array): (c,) estimates
+        boot (array): (B, c) bootstrap estimates
+        jack, jack_w (array): (c, m) jackknife estimates and their weights
+        ci (float): coverage
+    Returns:
+        low, high (array)
+    """
+    prop = (boot < theta_hat).mean(axis=0) + 0.5 * (boot == theta_hat).mean(axis=0)
+    z0 = stats.norm.ppf(np.clip(prop, 1e-6, 1 - 1e-6))
+    mean = (jack * jack_w).sum(axis=1) / jack_w.sum(axis=1)
+    d = mean[:, None] - jack
+    num = (jack_w * d**3).sum(axis=1)
+    den = 6 * (jack_w * d**2).sum(axis=1)**1.5
+    a = np.where(den > 0, num / np.where(den > 0, den, 1), 0)
+    out = []
+    for alpha in ((1 - ci) / 2, 1 - (1 - ci) / 2):
+        z = z0 + stats.norm.ppf(alpha)
+        q = stats.norm.cdf(z0 + z / (1 - a * z))
+        out.append(np.array([np.quantile(boot[:, i], q[i]) for i in range(boot.shape[1])]))
+    return out[0], out[1]
+
+
+def bootstrap_arrays(x, k, n, sigmoid='norm', n_boot=1000, ci=0.95, gamma=pm.GUESS_RATE,
+                     max_lapse=0.1, seed=None):
+    """Parametric bootstrap of all conditions of (n_conditions, n_levels) count arrays.
+
+    Returns:
+        params (array): (c, 3) maximum likelihood fits
+        boot_mu (array): (B, c) bootstrap thresholds on the stimulus scale
+        intervals (dict): 'percentile' and 'bca' (low, high) of mu
+    """
+    rng = np.random.RandomState(seed)
+    u = pm.stimulus_scale(x, sigmoid)
+    bounds = pm._bounds(u, max_lapse)
+    params, _, _ = pm.fit_arrays(x, k, n, sigmoid, gamma, max_lapse)
+
+    c, l = k.shape
+    p_hat = pm.psi(params, x, sigmoid, gamma)
+    k_boot = rng.binomial(n.astype(np.int64), p_hat, size=(n_boot, c, l)).astype(float)
+    tile = lambda a: np.broadcast_to(a, (n_boot,) + a.shape).reshape((n_boot * c,) + a.shape[1:])
+    fit = refit(tile(params), tile(u), k_boot.reshape(n_boot * c, l), tile(n),
+                sigmoid, tile(bounds), gamma)
+    boot_mu = fit[:, 0].reshape(n_boot, c)
+
+    a = (1 - ci) / 2
+    percentile = (np.quantile(boot_mu, a, axis=0), np.quantile(boot_mu, 1 - a, axis=0))
+    jack, jack_w = _jackknife(params, u, k, n, sigmoid, bounds, gamma)
+    bca = bca_interval(params[:, 0], boot_mu, jack, jack_w, ci)
+    return params, boot_mu, {'percentile': percentile, 'bca': bca}
+
+
+def _bootstrap_chunk(args):
+    x, k, n, sigmoid, n_boot, ci, gamma, max_lapse, seed = args
+    params, _, intervals = bootstrap_arrays(x, k, n, sigmoid, n_boot, ci, gamma, max_lapse, seed)
+    return params, intervals
+
+
+def bootstrap_conditions(counts, sigmoid='norm', n_boot=1000, ci=0.95, gamma=pm.GUESS_RATE,
+                         max_lapse=0.1, seed=None, n_workers=None, chunk_size=8, condition_cols=None):
+    """Thresholds with bootstrap intervals for every condition of a count table.
+
+    Args:
+        counts (DataFrame): as returned by psychometric.aggregate
+        sigmoid (string): 'norm', 'logistic' or 'weibull'
+        n_boot (int): bootstrap samples per condition
+        ci (float): coverage of the intervals
+        gamma, max_lapse (float): see psychometric.fit_arrays
+        seed (int): seed for the per-chunk seeds
+        n_workers (int): processes (cpu count if None, 1 runs in this process)
+        chunk_size (int): conditions per task
+        condition_cols (list): see psychometric.aggregate
+    Returns:
+        fits (DataFrame): columns of psychometric.fit_conditions, with
+            threshold_low / threshold_high the BCa interval, plus
+            threshold_pct_low / threshold_pct_high (percentile interval).
+    """
+    conditions, x, k, n = pm.to_arrays(counts, condition_cols)
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=(len(x) + chunk_size - 1) // chunk_size)
+    jobs = [(x[i:i + chunk_size], k[i:i + chunk_size], n[i:i + chunk_size], sigmoid, n_boot, ci,
+             gamma, max_lapse, int(seeds[i // chunk_size])) for i in range(0, len(x), chunk_size)]
+    if n_workers == 1 or len(jobs) == 1:
+        results = [_bootstrap_chunk(j) for j in jobs]
+    else:
+        pool = mp.Pool(n_workers)
+        try:
+            results = pool.map(_bootstrap_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    params = np.concatenate([r[0] for r in results])
+    pct = [np.concatenate([r[1]['percentile'][i] for r in results]) for i in (0, 1)]
+    bca = [np.concatenate([r[1]['bca'][i] for r in results]) for i in (0, 1)]
+
+    fits = conditions.copy()
+    fits['threshold'] = pm.threshold_scale(params[:, 0], sigmoid)
+    fits['threshold_low'] = pm.threshold_scale(bca[0], sigmoid)
+    fits['threshold_high'] = pm.threshold_scale(bca[1], sigmoid)
+    fits['threshold_pct_low'] = pm.threshold_scale(pct[0], sigmoid)
+    fits['threshold_pct_high'] = pm.threshold_scale(pct[1], sigmoid)
+    fits['width'] = np.exp(params[:, 1])
+    fits['lapse'] = params[:, 2]
+    fits['n_trials'] = n.sum(axis=1).astype(np.int64)
+    return fits
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Thresholds with parametric bootstrap intervals.')
+    parser.add_argument('data', help='munged trials (all_data.csv or all_data.parquet)')
+    parser.add_argument('--experiment', type=int, default=1, choices=(1, 2), help='output format')
+    parser.add_argument('--sigmoid', default='norm', choices=pm.SIGMOIDS)
+    parser.add_argument('-B', type=int, default=1000, help='bootstrap samples per condition')
+    parser.add_argument('--interval', default='bca', choices=('bca', 'percentile'))
+    parser.add_argument('--subjects', type=int, nargs='+', default=sorted(pm.SUBJECT_NAMES))
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default=None, help='thresholds csv (default expt_N_thresholds.csv)')
+    args = parser.parse_args(argv)
+
+    dat = pm.read_table(args.data)
+    dat = dat[dat['subject'].astype(int).isin(args.subjects)]
+    fits = bootstrap_conditions(pm.aggregate(dat), sigmoid=args.sigmoid, n_boot=args.B,
+                                seed=args.seed, n_workers=args.workers)
+    if args.interval == 'percentile':
+        fits['threshold_low'] = fits['threshold_pct_low']
+        fits['threshold_high'] = fits['threshold_pct_high']
+    table = pm.threshold_table(fits, args.experiment)
+    out = args.out or 'expt_{}_thresholds.csv'.format(args.experiment)
+    table.to_csv(out)
+    print('{} conditions written to {}'.format(len(table), out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+# coding: utf-8
+
+""" Feature congestion clutter (Rosenholtz et al., 2007) in Python.
+
+Python version of clutter_analysis.m, which needs MATLAB and the clutter
+toolbox of https://dspace.mit.edu/handle/1721.1/37593. Images are found
+by globbing the stimulus directories, read in batches in a process pool,
+and the measure is computed for a whole batch at once:
+
+    Feature congestion (FC): colour, luminance contrast and orientation
+        clutter, each the local (co)variance of the feature over a
+        Gaussian pooling window at three scales of a Gaussian pyramid,
+        collapsed over scales by the maximum, normalised by the
+        toolbox's constants (0.2088, 0.0660, 0.0269), summed and
+        averaged over the image.
+
+Filters, borders, pyramids and the colour conversion follow the toolbox
+(getClutter_FC). On a random sample of 48 experiment 1 images FC is within
+0.4% of the published values. --check compares a sample with the
+published table and fails if any image is off by more than 1%.
+
+Subband entropy (SE) is not computed. Most steerable pyramid coefficients
+of these displays are zero, so the toolbox's entropy over sqrt(N) bins
+depends on a few extreme coefficients, and a reimplementation did not
+reproduce the ranking of the published SE within a condition. Use the SE
+column of the published tables.
+
+The output has the columns of results/clutter_analysis/expt_*_clutter_results.csv
+without SE. Do not write over those tables.
+
+Reference:
+    Rosenholtz, R., Li, Y. & Nakano, L. (2007). Measuring visual clutter.
+    Journal of Vision, 7(2), 17:1-22.
+
+Example:
+    python clutter.py 1 ../../results/clutter_analysis/expt_1_clutter_python.csv --workers 8
+    python clutter.py 1 --check 48
+"""
+
+import os
+import re
+import glob
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from skimage import io
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+stim_dir = os.path.join(this_dir, os.pardir, 'stimuli')
+# the tables clutter_analysis.m wrote with the MATLAB toolbox
+PUBLISHED_TABLE = os.path.join(this_dir, os.pardir, os.pardir, 'results', 'clutter_analysis',
+                               'expt_{}_clutter_results.csv')
+
+# distorted image directories of clutter_analysis.m, by number of distorted flankers
+EXPERIMENT_DIRS = {1: {None: 'images'},
+                   2: {0: 'exp3img0flankersdistorted',
+                       2: 'exp3img2flankersdistorted',
+                       4: 'exp3img4flankersdistorted'}}
+
+IMAGE_RE = re.compile(
+    r'^(?P<flanked>flanked|unflanked)_(?P<distortion>bex|rf)_freq_(?P<freq>[\d.]+)'
+    r'_amplitude_(?P<amplitude>[\d.]+)_rep_(?P<rep>\d+)_(?P<targ_pos>[tlbr])_(?P<letter>[A-Z])'
+    r'(?:_2\.0)?\.png$')
+
+# row order of clutter_analysis.m
+LETTER_ORDER = ['N', 'K', 'D', 'H']
+FLANKED_ORDER = ['flanked', 'unflanked']
+DISTORTION_ORDER = ['rf', 'bex']
+AMP_ORDER = {1: {'bex': [0.25, 0.5, 1, 1.5, 2, 2.5, 3, 5],
+                 'rf': [0.0075, 0.01, 0.165, 0.0617, 0.1133, 0.2167, 0.2683, 0.32]},
+             2: {'bex': [1, 2, 3, 4, 5, 6, 7],
+                 'rf': [0.05, 0.125, 0.2, 0.275, 0.35, 0.425, 0.5]}}
+TARGET_ORDER = ['t', 'b', 'l', 'r']
+
+# feature congestion parameters
+N_LEVELS = 3
+COLOR_POOL_SIGMA = 3.
+CONTRAST_FILT_SIGMA = 1.
+CONTRAST_POOL_SIGMA = 3 * CONTRAST_FILT_SIGMA
+ORIENT_FILT_SIGMA = 16 / 14. * 1.75
+ORIENT_ENERGY_SIGMA = 1.75
+ORIENT_POOL_SIGMA = 7 / 2.
+ORIENT_NOISE = 0.001
+ORIENT_SMOOTH = 1.
+DELTA_LAB2 = np.array([0.0007, 0.1, 0.05])**2
+FC_NORM = {'color': 0.2088, 'contrast': 0.0660, 'orient': 0.0269}
+PYR_KERNEL = np.array([.05, .25, .4, .25, .05])
+
+# largest relative deviation from the published FC that --check accepts
+CHECK_MAX_REL_ERR = 0.01
+
+''' --------  Colour space  ---------'''
+
+def rgb2lab(rgb):
+    """sRGB in [0, 1], shape (..., 3), to Lab as the clutter toolbox computes it.
+
+    The toolbox divides XYZ in [0, 1] by the white point in [0, 100], so
+    L* of white is about 9 rather than 100. The FC normalising constants
+    were fitted on this scale, so it is kept.
+    """
+    rgb = np.asarray(rgb, dtype=float)
+    lin = np.where(rgb < 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055)**2.4)
+    m = np.array([[0.412453, 0.357580, 0.180423],
+                  [0.212671, 0.715160, 0.072169],
+                  [0.019334, 0.119193, 0.950227]])
+    xyz = lin @ m.T / np.array([95.047, 100., 108.833])
+    f = np.where(xyz >= 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116.)
+    L = 116 * f[..., 1] - 16
+    a = 500 * (f[..., 0] - f[..., 1])
+    b = 200 * (f[..., 1] - f[..., 2])
+    return np.stack([L, a, b], axis=-1)
+
+
+def gray2lab(ims):
+    """Lab of grey images (n, h, w) in [0, 1], as the toolbox sees them after writing them as RGB."""
+    lab = rgb2lab(np.repeat(np.asarray(ims, dtype=float)[..., None], 3, axis=-1))
+    lab[..., 1:] = 0  # a* and b* of grey are zero up to rounding error
+    return lab
+
+
+''' --------  Feature congestion  ---------'''
+
+def _gauss(half, sigma, centre=0.):
+    t = np.arange(-half, half + 1)
+    k = np.exp(-(t - centre)**2 / (2. * sigma**2))
+    return k / k.sum()
+
+
+def _conv_same(ims, kernel, axis):
+    # conv2(..., 'same') with zero padding
+    return ndimage.convolve1d(ims, kernel[::-1], axis=axis, mode='constant', cval=0.,
+                              origin=0 if len(kernel) % 2 else -1)
+
+
+def _overlapconv(ims, kernel, axis):
+    # RRoverlapconv: zero-padded convolution, renormalised by the part of the kernel inside the image
+    shape = [1] * ims.ndim
+    shape[axis] = ims.shape[axis]
+    norm = _conv_same(np.ones(ims.shape[axis]), kernel, 0).reshape(shape)
+    return kernel.sum() * _conv_same(ims, kernel, axis) / norm
+
+
+def _pool(ims, kernel):
+    """Separable RRoverlapconv of a stack (n, h, w)."""
+    return _overlapconv(_overlapconv(ims, kernel, -1), kernel, -2)
+
+
+def _filt2(ims, kernel, axis=None):
+    # filt2 of the toolbox: convolution with odd (reflect-101) borders
+    if axis is not None:
+        return ndimage.convolve1d(ims, kernel[::-1], axis=axis, mode='mirror')
+    return ndimage.convolve(ims, kernel[None, ::-1, ::-1], mode='mirror')
+
+
+def _reduce(ims, kernel=PYR_KERNEL):
+    return _filt2(_filt2(ims, kernel, -1)[..., ::2], kernel, -2)[..., ::2, :]
+
+
+def _expand(ims, kernel):
+    # RRoverlapconvexpand: zero insertion and twice the kernel, with overlap renormalisation
+    kernel = 2 * kernel
+    tmp = np.zeros(ims.shape[:-1] + (2 * ims.shape[-1],))
+    tmp[..., ::2] = ims
+    tmp = _overlapconv(tmp, kernel, -1)
+    out = np.zeros(tmp.shape[:-2] + (2 * tmp.shape[-2], tmp.shape[-1]))
+    out[..., ::2, :] = tmp
+    return _overlapconv(out, kernel, -2)
+
+
+def gaussian_pyramid(ims, n_levels=N_LEVELS):
+    """Gaussian pyramid of a stack (n, h, w) with the toolbox's 5-tap reduce kernel."""
+    pyr = [ims]
+    for _ in range(n_levels - 1):
+        pyr.append(_reduce(pyr[-1]))
+    return pyr
+
+
+def color_clutter(lab, sigma=COLOR_POOL_SIGMA):
+    """Cube root of the volume of the local Lab covariance ellipsoid; lab is (n, h, w, 3)."""
+    kernel = _gauss(int(round(2 * sigma)), sigma)
+    mean = np.stack([_pool(lab[..., i], kernel) for i in range(3)], axis=-1)
+    cov = np.empty(lab.shape[:-1] + (3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            c = _pool(lab[..., i] * lab[..., j], kernel) - mean[..., i] * mean[..., j]
+            if i == j:
+                c = c + DELTA_LAB2[i]
+            cov[..., i, j] = cov[..., j, i] = c
+    det = np.maximum(np.linalg.det(cov), 0)
+    return np.sqrt(det)**(1 / 3.)
+
+
+def contrast_clutter(L, filt_sigma=CONTRAST_FILT_SIGMA, pool_sigma=CONTRAST_POOL_SIGMA):
+    """Local standard deviation of the centre-surround (DoG) contrast of L."""
+    half = int(round(3 * filt_sigma))
+    inner, outer = _gauss(half, 0.71 * filt_sigma), _gauss(half, 1.14 * filt_sigma)
+    contrast = np.abs(_filt2(_filt2(L, inner, -1), inner, -2) - _filt2(_filt2(L, outer, -1), outer, -2))
+    kernel = _gauss(int(round(2 * pool_sigma)), pool_sigma)
+    m = _pool(contrast, kernel)
+    m2 = _pool(contrast**2, kernel)
+    return np.sqrt(np.abs(m2 - m**2))
+
+
+def _keys(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(x <= 1, (a + 2) * x**3 - (a + 3) * x**2 + 1,
+                    np.where(x < 2, a * x**3 - 5 * a * x**2 + 8 * a * x - 4 * a, 0.))
+
+
+def _rotate(im, degrees):
+    """imrotate(im, degrees, 'bicubic', 'crop') of a square filter."""
+    n = im.shape[0]
+    c = (n - 1) / 2.
+    th = np.deg2rad(degrees)
+    yy, xx = np.mgrid[0:n, 0:n].astype(float)
+    xs = np.cos(th) * (xx - c) - np.sin(th) * (yy - c) + c
+    ys = np.sin(th) * (xx - c) + np.cos(th) * (yy - c) + c
+    x0, y0 = np.floor(xs).astype(int), np.floor(ys).astype(int)
+    out = np.zeros_like(im)
+    for dy in range(-1, 3):
+        for dx in range(-1, 3):
+            xi, yi = x0 + dx, y0 + dy
+            inside = (xi >= 0) & (xi < n) & (yi >= 0) & (yi < n)
+            w = _keys(xs - xi) * _keys(ys - yi)
+            out += np.where(inside, w * im[np.clip(yi, 0, n - 1), np.clip(xi, 0, n - 1)], 0.)
+    inside = (xs >= -0.5) & (xs <= n - 0.5) & (ys >= -0.5) & (ys <= n - 0.5)
+    return np.where(inside, out, 0.)
+
+
+def orientation_filters(sigma=ORIENT_FILT_SIGMA):
+    """The toolbox's (orient_filtnew) horizontal, vertical and diagonal second-derivative filters.
+
+    Returns:
+        h, v, l, r (array): square filters; r and l are h rotated by +-45 degrees
+    """
+    half = int(round(3 * sigma))
+    gx = _gauss(half, sigma)
+    gs = [np.outer(_gauss(half, sigma, c), gx) for c in (sigma, 0., -sigma)]
+    gs = [g / g.sum() for g in gs]
+    h = -gs[0] + 2 * gs[1] - gs[2]
+    diag = []
+    for degrees in (45, -45):
+        rot = [_rotate(g, degrees) for g in gs]
+        rot = [g / g.sum() for g in rot]
+        diag.append(-rot[0] + 2 * rot[1] - rot[2])
+    return h, h.T, diag[1], diag[0]
+
+
+def orientation_clutter(L, pool_sigma=ORIENT_POOL_SIGMA, noise=ORIENT_NOISE):
+    """Fourth root of the determinant of the local covariance of the opponent orientation vector."""
+    energy_kernel = _gauss(int(round(2 * ORIENT_ENERGY_SIGMA)), ORIENT_ENERGY_SIGMA)
+    pool_kernel = _gauss(int(round(8 * pool_sigma)), 4 * pool_sigma)
+    h, v, l, r = [_reduce(_expand(_filt2(L, f)**2, energy_kernel), energy_kernel)
+                  for f in orientation_filters()]
+    total = h + v + l + r + ORIENT_SMOOTH
+    hv = (h - v) / total
+    dd = (r - l) / total
+    m_hv, m_dd = _pool(hv, pool_kernel), _pool(dd, pool_kernel)
+    c_hv = _pool(hv * hv, pool_kernel) - m_hv**2 + noise
+    c_dd = _pool(dd * dd, pool_kernel) - m_dd**2 + noise
+    c_x = _pool(hv * dd, pool_kernel) - m_hv * m_dd
+    return (c_hv * c_dd - c_x**2)**0.25
+
+
+def _collapse(levels):
+    """Maximum over scales, each level brought to full resolution by the toolbox's upConv."""
+    kernel = np.outer(PYR_KERNEL, PYR_KERNEL)
+    out = levels[0].copy()
+    for i, lev in enumerate(levels[1:], 1):
+        for _ in range(i):
+            up = np.zeros(lev.shape[:-2] + (2 * lev.shape[-2], 2 * lev.shape[-1]))
+            up[..., ::2, ::2] = lev
+            lev = _filt2(up, kernel)
+        h, w = min(out.shape[-2], lev.shape[-2]), min(out.shape[-1], lev.shape[-1])
+        out[..., :h, :w] = np.maximum(out[..., :h, :w], lev[..., :h, :w])
+    return out
+
+
+def feature_congestion(lab, n_levels=N_LEVELS, return_map=False):
+    """Feature congestion clutter of a stack of Lab images (n, h, w, 3).
+
+    Returns:
+        fc (array): (n,) scalar clutter
+        fc_map (array): (n, h, w) clutter maps, if return_map
+    """
+    pyr = [gaussian_pyramid(lab[..., i], n_levels) for i in range(3)]
+    color, contrast, orient = [], [], []
+    for lev in range(n_levels):
+        lab_lev = np.stack([pyr[i][lev] for i in range(3)], axis=-1)
+        color.append(color_clutter(lab_lev))
+        contrast.append(contrast_clutter(lab_lev[..., 0]))
+        orient.append(orientation_clutter(lab_lev[..., 0]))
+    fc_map = _collapse(color) / FC_NORM['color'] + \
+        _collapse(contrast) / FC_NORM['contrast'] + \
+        _collapse(orient) / FC_NORM['orient']
+    fc = fc_map.reshape(len(fc_map), -1).mean(axis=1)
+    if return_map:
+        return fc, fc_map
+    return fc
+
+
+''' --------  Stimulus images  ---------'''
+
+def parse_image_name(fname):
+    """Fields of a stimulus file name, or None."""
+    m = IMAGE_RE.match(os.path.basename(fname))
+    return None if m is None else m.groupdict()
+
+
+def find_images(experiment):
+    """The distorted images clutter_analysis.m uses for an experiment (1 or 2).
+
+    Returns:
+        images (DataFrame): path plus the fields of the file name (and
+            n_dist_flanks for experiment 2), in the row order of
+            clutter_analysis.m
+    """
+    rows = []
+    for n_dist, d in EXPERIMENT_DIRS[experiment].items():
+        for path in glob.glob(os.path.join(stim_dir, d, 'distorted', '*.png')):
+            info = parse_image_name(path)
+            if info is None or (experiment == 2 and info['flanked'] != 'flanked'):
+                continue
+            info['path'] = path
+            info['n_dist_flanks'] = n_dist
+            rows.append(info)
+    images = pd.DataFrame(rows)
+    if len(images) == 0:
+        return images
+    amps = AMP_ORDER[experiment]
+    amp_rank = [amps[d].index(float(a)) if float(a) in amps[d] else len(amps[d])
+                for d, a in zip(images['distortion'], images['amplitude'])]
+    images['_order'] = list(zip(images['letter'].map(LETTER_ORDER.index),
+                                images['n_dist_flanks'].fillna(0),
+                                images['flanked'].map(FLANKED_ORDER.index),
+                                images['distortion'].map(DISTORTION_ORDER.index),
+                                images['freq'].astype(float), amp_rank,
+                                images['rep'].astype(int),
+                                images['targ_pos'].map(TARGET_ORDER.index)))
+    images = images.sort_values('_order').drop(columns='_order').reset_index(drop=True)
+    return images
+
+
+def load_batch(paths):
+    """Read grey images as a float stack in [0, 1]."""
+    return np.stack([io.imread(p, as_gray=False).astype(float) / 255. for p in paths])
+
+
+def clutter_batch(paths):
+    """FC of a batch of image files."""
+    return feature_congestion(gray2lab(load_batch(paths)))
+
+
+def compute_clutter(paths, batch_size=4, n_workers=None):
+    """FC of many image files, in batches over a process pool."""
+    paths = list(paths)
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    if n_workers == 1:
+        results = [clutter_batch(b) for b in batches]
+    else:
+        pool = mp.Pool(n_workers)
+        try:
+            results = pool.map(clutter_batch, batches, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    if not results:
+        return np.zeros(0)
+    return np.concatenate(results)
+
+
+def clutter_table(experiment, batch_size=4, n_workers=None, limit=None, rows=None):
+    """The rows of expt_<experiment>_clutter_results.csv, without SE.
+
+    Args:
+        rows (array): only these rows (positions in the table), if given
+    """
+    images = find_images(experiment)
+    if rows is not None:
+        images = images.iloc[rows]
+    if limit is not None:
+        images = images.iloc[:limit]
+    fc = compute_clutter(images['path'], batch_size, n_workers)
+    images['freq'] = images['freq'].astype(float).astype(int)
+    images['rep'] = images['rep'].astype(int)
+    images['FC'] = fc
+    if experiment == 1:
+        cols = ['letter', 'flanked', 'distortion', 'freq', 'amplitude', 'rep', 'FC']
+    else:
+        images['n_dist_flanks'] = images['n_dist_flanks'].astype(int)
+        cols = ['letter', 'distortion', 'freq', 'amplitude', 'rep', 'n_dist_flanks', 'FC']
+    return images[cols]
+
+
+def compare_with_published(experiment, n_images=48, seed=0, batch_size=4, n_workers=None):
+    """Compare FC of a random sample of images with the toolbox's published values.
+
+    The rows of find_images are in the order of clutter_analysis.m, so row i
+    of the published table belongs to image i.
+
+    Returns:
+        summary (DataFrame): per condition (flanked or the number of
+            distorted flankers): the number of images, the mean ratio to
+            the published value, the largest relative error, the Pearson
+            and Spearman correlations with the published values and
+            whether the largest error is within CHECK_MAX_REL_ERR
+    """
+    published = pd.read_csv(PUBLISHED_TABLE.format(experiment))
+    n_found = len(find_images(experiment))
+    if n_found != len(published):
+        raise ValueError('{} images found but the published table has {} rows'.format(
+            n_found, len(published)))
+    rows = np.sort(np.random.RandomState(seed).choice(len(published), min(n_images, len(published)),
+                                                      replace=False))
+    ours = clutter_table(experiment, batch_size, n_workers, rows=rows)
+    published = published.iloc[rows]
+    condition = 'flanked' if experiment == 1 else 'n_dist_flanks'
+    summary = []
+    for cond, pub in published.groupby(condition):
+        x, y = ours.loc[pub.index, 'FC'], pub['FC']
+        max_rel_err = (x / y - 1).abs().max()
+        summary.append({condition: cond, 'n': len(pub),
+                        'ratio': (x / y).mean(),
+                        'max_rel_err': max_rel_err,
+                        'pearson': x.corr(y),
+                        'spearman': x.corr(y, method='spearman'),
+                        'passed': max_rel_err <= CHECK_MAX_REL_ERR})
+    return pd.DataFrame(summary)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Feature congestion clutter of the stimuli.')
+    parser.add_argument('experiment', type=int, choices=(1, 2))
+    parser.add_argument('out', nargs='?', help='output csv')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--limit', type=int, default=None, help='only the first N images')
+    parser.add_argument('--check', type=int, default=None, metavar='N',
+                        help='compare N random images with the published toolbox values instead')
+    args = parser.parse_args(argv)
+
+    if args.check is not None:
+        summary = compare_with_published(args.experiment, args.check, batch_size=args.batch_size,
+                                         n_workers=args.workers)
+        print(summary.to_string(index=False))
+        if not summary['passed'].all():
+            parser.exit(1, 'FC differs from the published values by more than {:.0%}\n'.format(
+                CHECK_MAX_REL_ERR))
+        return
+    if args.out is None:
+        parser.error('an output csv is required unless --check is given')
+    published = PUBLISHED_TABLE.format(args.experiment)
+    if os.path.exists(args.out) and os.path.samefile(args.out, published):
+        parser.error('{} holds the toolbox values; write to another file'.format(args.out))
+
+    table = clutter_table(args.experiment, args.batch_size, args.workers, args.limit)
+    table.to_csv(args.out, index=False)
+    print('{} images written to {}'.format(len(table), args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+# coding: utf-8
+
+""" Labeled N-d cube of trial counts, accuracy and response times.
+
+Instead of grouping the long trial table again for every question, the
+trials are counted once into a dense array with one axis per dimension:
+
+    subject x experiment x flanked x distortion x n_dist_flanks x freq
+            x amplitude x targ_pos x response
+
+Every cell holds the number of trials, the number with a response, the
+number correct, and the number, sum and sum of squares of the finite
+response times. The cube is built in a single pass: the trials' level
+codes are combined into a flat cell index with np.ravel_multi_index, and
+every statistic is one np.bincount over that index.
+
+Selections and marginals are array indexing and sums over axes, and
+return smaller cubes. The 4 x 4 confusion matrix of target position and
+response of any selection is the cube summed over all other axes.
+Missed responses ('n.a.') are a level of the response axis.
+
+Experiment 1 tables have no experiment or n_dist_flanks column; their
+trials get the levels '1' and 0, also when concatenated with experiment 2.
+
+Example:
+    import condition_cube as cc
+    cube = cc.build(pm.read_table('all_data.parquet'))
+    cube.sel(distortion='bex', flanked='flanked').accuracy()
+    cube.confusion(subject='2', freq=6)
+    cube.save('cube_expt_1.npz')
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+
+DIMS = ['subject', 'experiment', 'flanked', 'distortion', 'n_dist_flanks', 'freq', 'amplitude',
+        'targ_pos', 'response']
+STATS = ['count', 'n_responded', 'correct', 'n_rt', 'rt_sum', 'rt_sumsq']
+# value of a dimension that is missing from a table
+DEFAULT_LEVELS = {'experiment': '1', 'n_dist_flanks': 0}
+# fixed level orders (the others are sorted)
+POSITION_ORDER = ['t', 'l', 'b', 'r']
+LEVEL_ORDERS = {'targ_pos': POSITION_ORDER, 'response': POSITION_ORDER + ['n.a.']}
+
+
+class ConditionCube(object):
+    """Counts and response time sums over labeled dimensions.
+
+    Args:
+        dims (list): dimension names, one per axis
+        levels (list): array of level labels per dimension
+        stats (dict): array per name in STATS, shape (len(levels[0]), ...)
+    """
+
+    def __init__(self, dims, levels, stats):
+        self.dims = list(dims)
+        self.levels = [np.asarray(l) for l in levels]
+        self.stats = stats
+
+    @property
+    def shape(self):
+        return tuple(len(l) for l in self.levels)
+
+    def __repr__(self):
+        return 'ConditionCube({})'.format(', '.join('{}={}'.format(d, len(l))
+                                                    for d, l in zip(self.dims, self.levels)))
+
+    def __getitem__(self, stat):
+        return self.stats[stat]
+
+    def axis(self, dim):
+        return self.dims.index(dim)
+
+    def level_index(self, dim, labels):
+        """Positions of level labels on a dimension's axis."""
+        levels = self.levels[self.axis(dim)]
+        labels = np.atleast_1d(labels)
+        idx = np.empty(len(labels), dtype=int)
+        for i, label in enumerate(labels):
+            if levels.dtype.kind in 'biuf':
+                hit = np.flatnonzero(np.isclose(levels, float(label)))
+            else:
+                hit = np.flatnonzero(levels.astype(str) == str(label))
+            if len(hit) == 0:
+                raise KeyError('{} is not a level of {}'.format(label, dim))
+            idx[i] = hit[0]
+        return idx
+
+    def sel(self, **selection):
+        """Select levels by label.
+
+        A single label drops the dimension; a list keeps it with those levels.
+        e.g. cube.sel(distortion='bex', freq=[4, 6])
+        """
+        index = [slice(None)] * len(self.dims)
+        keep = [True] * len(self.dims)
+        for dim, labels in selection.items():
+            a = self.axis(dim)
+            idx = self.level_index(dim, labels)
+            if np.ndim(labels) == 0:
+                index[a] = idx[0]
+                keep[a] = False
+            else:
+                index[a] = idx
+        # one axis at a time, so that several list selections do not broadcast together
+        stats = dict(self.stats)
+        for a in reversed(range(len(self.dims))):
+            if isinstance(index[a], slice):
+                continue
+            stats = dict((k, np.take(v, index[a], axis=a)) for k, v in stats.items())
+        levels = [l if isinstance(i, slice) else l[i] for l, i in zip(self.levels, index)]
+        return ConditionCube([d for d, k in zip(self.dims, keep) if k],
+                             [l for l, k in zip(levels, keep) if k], stats)
+
+    def sum(self, dims):
+        """Marginalize (sum out) dimensions."""
+        dims = [dims] if isinstance(dims, str) else list(dims)
+        axes = tuple(self.axis(d) for d in dims)
+        keep = [i for i in range(len(self.dims)) if i not in axes]
+        stats = dict((k, v.sum(axis=axes)) for k, v in self.stats.items())
+        return ConditionCube([self.dims[i] for i in keep], [self.levels[i] for i in keep], stats)
+
+    def keep(self, dims):
+        """Marginalize all dimensions except these (in the cube's axis order)."""
+        return self.sum([d for d in self.dims if d not in dims])
+
+    def accuracy(self):
+        """Proportion correct of the trials with a response, per cell (NaN where there are none)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.stats['correct'] / self.stats['n_responded']
+
+    def mean_rt(self):
+        """Mean of the finite response times per cell."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.stats['rt_sum'] / self.stats['n_rt']
+
+    def sd_rt(self):
+        """Standard deviation (n - 1) of the finite response times per cell."""
+        n = self.stats['n_rt']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = (self.stats['rt_sumsq'] - self.stats['rt_sum']**2 / n) / (n - 1)
+        return np.sqrt(np.maximum(var, 0))
+
+    def confusion(self, proportions=False, **selection):
+        """Target position x response matrix of a selection.
+
+        Args:
+            proportions (bool): rows normalised to sum to 1 (missed responses excluded)
+            selection: labels as in sel
+        Returns:
+            (DataFrame): rows targ_pos, columns response (t, l, b, r)
+        """
+        cube = self.sel(**selection).keep(['targ_pos', 'response'])
+        m = cube['count']
+        if cube.dims != ['targ_pos', 'response']:
+            m = m.T
+        resp = cube.levels[cube.axis('response')].astype(str)
+        m = m[:, resp != 'n.a.'].astype(float)
+        if proportions:
+            with np.errstate(invalid='ignore'):
+                m = m / m.sum(axis=1, keepdims=True)
+        return pd.DataFrame(m, index=pd.Index(cube.levels[cube.axis('targ_pos')], name='targ_pos'),
+                            columns=pd.Index(resp[resp != 'n.a.'], name='response'))
+
+    def to_frame(self, nonzero=True):
+        """Long table with one row per cell (only cells with trials if nonzero)."""
+        mask = self.stats['count'] > 0 if nonzero else np.ones(self.shape, dtype=bool)
+        idx = np.nonzero(mask)
+        out = pd.DataFrame(dict((d, l[i]) for d, l, i in zip(self.dims, self.levels, idx)))
+        for k, v in self.stats.items():
+            out[k] = v[idx]
+        return out
+
+    def counts(self, condition_cols=None):
+        """Correct and total trials per condition and amplitude, like psychometric.aggregate.
+
+        Missed responses are left out.
+        """
+        if condition_cols is None:
+            condition_cols = [d for d in DIMS[:6] if d in self.dims]
+        cube = self.keep(condition_cols + ['amplitude'])
+        out = cube.to_frame()
+        out = out[out['n_responded'] > 0]
+        out = out.rename(columns={'correct': 'n_correct', 'n_responded': 'n_total'})
+        out['n_correct'] = out['n_correct'].astype(np.int64)
+        return out[cube.dims + ['n_correct', 'n_total']].reset_index(drop=True)
+
+    def save(self, fname):
+        """Write the cube to an .npz file."""
+        arrays = dict(('stat_' + k, v) for k, v in self.stats.items())
+        arrays.update(('level_' + d, l) for d, l in zip(self.dims, self.levels))
+        np.savez_compressed(fname, dims=np.array(self.dims), **arrays)
+
+
+def load(fname):
+    """Read a cube written by ConditionCube.save."""
+    with np.load(fname, allow_pickle=False) as f:
+        dims = [str(d) for d in f['dims']]
+        levels = [f['level_' + d] for d in dims]
+        stats = dict((k[5:], f[k]) for k in f.files if k.startswith('stat_'))
+    return ConditionCube(dims, levels, stats)
+
+
+def _codes(values, dim):
+    values = pd.Series(values)
+    if dim in LEVEL_ORDERS:
+        order = LEVEL_ORDERS[dim]
+        extra = sorted(set(values.astype(str)) - set(order))
+        levels = np.array(order + extra)
+        codes = pd.Categorical(values.astype(str), categories=levels).codes
+        return codes, levels
+    codes, levels = pd.factorize(values, sort=True)
+    levels = np.asarray(levels)
+    if levels.dtype == object:
+        # fixed-width strings, so that cubes can be saved without pickling
+        levels = levels.astype(str)
+    return codes, levels
+
+
+def build(dat, dims=None):
+    """Count trials into a cube in one bincount pass per statistic.
+
+    Args:
+        dat (DataFrame): munged trials (one or more experiments)
+        dims (list): dimensions (default DIMS)
+    Returns:
+        ConditionCube
+    """
+    dims = list(DIMS if dims is None else dims)
+    codes, levels = [], []
+    for d in dims:
+        values = dat[d] if d in dat.columns else pd.Series(np.full(len(dat), DEFAULT_LEVELS[d]))
+        if d in DEFAULT_LEVELS:
+            values = values.astype(object).where(values.notna(), DEFAULT_LEVELS[d])
+            values = values.astype(type(DEFAULT_LEVELS[d]))
+        if d == 'subject':
+            values = values.astype(str)
+        c, l = _codes(values.values, d)
+        if (c < 0).any():
+            raise ValueError('missing values in {}'.format(d))
+        codes.append(c)
+        levels.append(l)
+    shape = tuple(len(l) for l in levels)
+    flat = np.ravel_multi_index(codes, shape)
+    size = int(np.prod(shape))
+    correct = dat['correct'].astype(float)
+    responded = correct.notna().values
+    correct = correct.fillna(0).values
+    rt = dat['RT'].values.astype(float) if 'RT' in dat.columns else np.full(len(dat), np.nan)
+    finite = np.isfinite(rt)
+    rt = np.where(finite, rt, 0)
+    stats = {'count': np.bincount(flat, minlength=size),
+             'n_responded': np.bincount(flat, responded, size).astype(np.int64),
+             'correct': np.bincount(flat, correct, size).astype(np.int64),
+             'n_rt': np.bincount(flat, finite, size).astype(np.int64),
+             'rt_sum': np.bincount(flat, rt, size),
+             'rt_sumsq': np.bincount(flat, rt**2, size)}
+    stats = dict((k, v.reshape(shape)) for k, v in stats.items())
+    return ConditionCube(dims, levels, stats)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    import psychometric as pm
+    parser = argparse.ArgumentParser(description='Count trials into a condition cube.')
+    parser.add_argument('data', nargs='+', help='munged trials (all_data.csv or all_data.parquet)')
+    parser.add_argument('out', help='output .npz file')
+    args = parser.parse_args(argv)
+
+    dat = pd.concat([pm.read_table(f) for f in args.data], ignore_index=True)
+    cube = build(dat)
+    cube.save(args.out)
+    print('{} trials in {} written to {}'.format(int(cube['count'].sum()), cube, args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,25 @@
 
 import psyutils as pu
 import os
-import pandas as pd
-import numpy as np
-from itertools import product
+import argparse
+import ingest
+import trial_store
 
 
 """ Script to do data munging.
 
 
 Tom Wallis wrote it.
+
+By default only new or changed session files are read and merged into
+all_data.csv (see ingest.update_table); --full rebuilds it from all files.
+The table is also written as a typed Parquet store, all_data.parquet.
 """
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--full', action='store_true', help='rebuild from all session files')
+args = parser.parse_args()
+
 experiment_num = 2
 
 #---------------------------------------------------------------
@@ -31,57 +39,23 @@ if not os.path.exists(out_dir):
 
 # enumerate files for this experiment:
 subjs = ['2', '5', '7']
-conds = ['0', '2', '4']
-distortion = ['rf', 'bex']
-sub_experiments = ['a', 'b', 'c']
-
-dat = pd.DataFrame()
-
-for e, s, c, d in product(sub_experiments, subjs, conds, distortion):
-    this_session = 1
-    finished = False
-
-    while not finished:
-        if e == 'a':
-            print('Doing experiment 3a')
-            fname = '{}distflanker_distortionData_flanked_{}_sub_{}_session_{}.csv'.format(
-                    c, d, s, this_session)
-            fname = os.path.join(raw_dir, fname)
-        else:
-            print('Doing experiment 3{}'.format(e))
-            fname = '{}exp3{}_distflanker_distortionData_flanked_{}_sub_{}_session_{}.csv'.format(
-                    c, e, d, s, this_session)
-            fname = os.path.join(raw_dir, fname)
-
-        if os.path.exists(fname):
-            this_dat = pd.read_csv(fname, sep='\t')
-            this_dat['experiment'] = e
-            dat = dat.append(this_dat, ignore_index=True)
-            this_session += 1
-        else:
-            finished = True
-
-
-def new_col(col):
-    # rename columns containing leading space:
-    col = col.rstrip()
-    return col.lstrip()
-
-dat.rename(columns=new_col, inplace=True)
-
-# create a "correct" column by comparing target and response:
-dat.targ_pos = dat.targ_pos.apply(str)
-dat.response = dat.response.apply(str)
-dat['correct'] = 0
-dat.loc[dat['targ_pos'] == dat['response'], 'correct'] = 1
-# nans for missed responses:
-dat.loc[dat['response'] == 'na', 'correct'] = np.nan
-
-# re-sort:
-dat.sort_values(by=['experiment', 'subject', 'session', 'trial'], inplace=True)
-
-# save data:
+
+
+def prepare(dat):
+    # sub-experiment label as before ('a', 'b', 'c'):
+    dat['experiment'] = dat['experiment'].str[1:]
+    return dat
+
 fname = os.path.join(out_dir, 'all_data.csv')
-dat.to_csv(fname, index=False)
+summary = ingest.update_table(raw_dir, fname, experiments=['3a', '3b', '3c'], subjects=subjs,
+                              prepare=prepare, sort_by=['experiment', 'subject', 'session', 'trial'],
+                              full=args.full)
+print('{} new, {} modified, {} deleted session files'.format(
+    len(summary['new']), len(summary['modified']), len(summary['deleted'])))
+
+# typed columnar copy for fast loading (see trial_store.py):
+store_fname = os.path.join(out_dir, 'all_data.parquet')
+if summary['appended'] or summary['rewritten'] or not os.path.exists(store_fname):
+    trial_store.csv_to_store(fname, store_fname)
 
 print('Success!')
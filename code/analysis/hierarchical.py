@@ -0,0 +1,324 @@
+# coding: utf-8
+
+""" Hierarchical psychometric model of all subjects and conditions.
+
+All subjects x conditions are fitted jointly. For subject s and condition c,
+with psi as in psychometric.py:
+
+    threshold   log t_sc = m_c + sigma_a * za_s + sigma_e * ze_sc
+    width       log w_sc = v_c + sigma_b * zb_s
+    lapse       l_s      = max_lapse * logistic(q_s)
+
+m_c and v_c are the population (log) threshold and width of a condition.
+za and zb are subject random effects on threshold and slope, shared by all
+conditions of a subject. ze is the subject x condition deviation of the
+threshold. The random effects are non-centred (z ~ N(0, 1), scaled by their
+sd), which suits both the optimiser and the sampler. For the Weibull the
+threshold is already on log amplitude, so the location is used as mu
+directly.
+
+The log posterior and its analytic gradient are computed as one
+vectorized expression over every row of the typed trial table (or over
+binomial counts, which give the same likelihood). Per-trial gradients are
+reduced to the parameters with np.bincount. fit_map finds the posterior
+mode with L-BFGS-B. sample draws from the posterior with Hamiltonian Monte
+Carlo, using a diagonal mass matrix adapted during warm-up.
+
+Example:
+    python hierarchical.py ../../results/experiment_1/all_data.parquet --experiment 1 --samples 1000 --out expt_1_thresholds_hierarchical.csv
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import optimize
+import psychometric as pm
+
+MAX_LAPSE = 0.1
+# prior sd of the population log thresholds and log widths, scale of the
+# half-normal priors on the random effect sds, prior of the lapse logits
+LOCATION_SD = 10.
+SIGMA_SCALE = 1.
+LAPSE_PRIOR = (-3., 1.5)
+
+
+class HierarchicalModel(object):
+    """Joint log posterior of all subjects and conditions.
+
+    Args:
+        dat (DataFrame): munged trials (one row per trial, 'correct' with NA
+            for missed responses), or counts as returned by
+            psychometric.aggregate (n_correct, n_total)
+        sigmoid (string): see psychometric.SIGMOIDS
+        condition_cols (list): columns identifying a condition, without
+            'subject' (default: those of psychometric.CONDITION_COLS in dat)
+        gamma (float): guess rate
+        max_lapse (float): largest lapse rate
+    """
+
+    def __init__(self, dat, sigmoid='norm', condition_cols=None, gamma=pm.GUESS_RATE, max_lapse=MAX_LAPSE):
+        if condition_cols is None:
+            condition_cols = [c for c in pm.CONDITION_COLS if c in dat.columns and c != 'subject']
+        if 'n_total' in dat.columns:
+            d = dat
+            k, n = d['n_correct'].values.astype(float), d['n_total'].values.astype(float)
+        else:
+            correct = dat['correct'].astype(float)
+            d = dat[correct.notna().values]
+            k, n = correct[correct.notna()].values, np.ones(len(d))
+        self.sigmoid = sigmoid
+        self.gamma = gamma
+        self.max_lapse = max_lapse
+        self.condition_cols = list(condition_cols)
+
+        subj_codes, self.subjects = pd.factorize(d['subject'].astype(str), sort=True)
+        keys = d[self.condition_cols].astype(str).agg('|'.join, axis=1) if self.condition_cols else \
+            pd.Series('', index=d.index)
+        cond_codes, cond_keys = pd.factorize(keys, sort=True)
+        first = pd.Series(np.arange(len(d))).groupby(cond_codes).first().values
+        self.conditions = d.iloc[first][self.condition_cols].reset_index(drop=True)
+        self.n_subj, self.n_cond = len(self.subjects), len(cond_keys)
+
+        self.subj = subj_codes
+        self.cond = cond_codes
+        self.cell = subj_codes * self.n_cond + cond_codes
+        self.u = pm.stimulus_scale(d['amplitude'].values.astype(float), sigmoid)
+        self.k, self.n = k, n
+        self.c = pm._scale(sigmoid)
+
+        sizes = [('m', self.n_cond), ('v', self.n_cond), ('za', self.n_subj),
+                 ('ze', self.n_subj * self.n_cond), ('zb', self.n_subj), ('q', self.n_subj),
+                 ('log_sigma_a', 1), ('log_sigma_e', 1), ('log_sigma_b', 1)]
+        self.slices = {}
+        start = 0
+        for name, size in sizes:
+            self.slices[name] = slice(start, start + size)
+            start += size
+        self.n_params = start
+
+    def unpack(self, theta):
+        """Named views of a parameter vector."""
+        return dict((name, theta[sl]) for name, sl in self.slices.items())
+
+    def _location(self, eta):
+        # mu on the stimulus scale and d mu / d eta
+        if self.sigmoid == 'weibull':
+            return eta, np.ones_like(eta)
+        mu = np.exp(eta)
+        return mu, mu
+
+    def cell_params(self, theta):
+        """Threshold location eta (log threshold), log width and lapse per subject x condition, each (n_subj, n_cond)."""
+        p = self.unpack(theta)
+        sa, se_, sb = np.exp(p['log_sigma_a'][0]), np.exp(p['log_sigma_e'][0]), np.exp(p['log_sigma_b'][0])
+        eta = p['m'][None, :] + sa * p['za'][:, None] + se_ * p['ze'].reshape(self.n_subj, self.n_cond)
+        log_w = p['v'][None, :] + sb * p['zb'][:, None]
+        lapse = self.max_lapse / (1 + np.exp(-p['q']))
+        return eta, log_w, np.broadcast_to(lapse[:, None], eta.shape)
+
+    def log_posterior(self, theta):
+        """Log posterior and its gradient.
+
+        Args:
+            theta (array): (n_params,) parameter vector (see slices)
+        Returns:
+            lp (float), grad (array)
+        """
+        p = self.unpack(theta)
+        sa, se_, sb = np.exp(p['log_sigma_a'][0]), np.exp(p['log_sigma_e'][0]), np.exp(p['log_sigma_b'][0])
+        ze = p['ze']
+        eta_cell = (p['m'][None, :] + sa * p['za'][:, None] + se_ * ze.reshape(self.n_subj, self.n_cond)).ravel()
+        logw_cell = (p['v'][None, :] + sb * p['zb'][:, None]).ravel()
+        lapse_s = self.max_lapse / (1 + np.exp(-p['q']))
+
+        # trial level
+        eta, log_w, lapse = eta_cell[self.cell], logw_cell[self.cell], lapse_s[self.subj]
+        mu, dmu = self._location(eta)
+        w = np.exp(log_w)
+        z = self.c * (self.u - mu) / w
+        f, df = pm.sigmoid_f(z, self.sigmoid)
+        scale = 1 - self.gamma - lapse
+        p_c = np.clip(self.gamma + scale * f, 1e-12, 1 - 1e-12)
+        ll = (self.k * np.log(p_c) + (self.n - self.k) * np.log1p(-p_c)).sum()
+        dll = self.k / p_c - (self.n - self.k) / (1 - p_c)
+        g_eta = dll * scale * df * (-self.c / w) * dmu
+        g_logw = dll * scale * df * (-z)
+        g_lapse = dll * (-f)
+
+        # reduce to subject x condition cells and subjects
+        n_cells = self.n_subj * self.n_cond
+        G_eta = np.bincount(self.cell, g_eta, n_cells).reshape(self.n_subj, self.n_cond)
+        G_logw = np.bincount(self.cell, g_logw, n_cells).reshape(self.n_subj, self.n_cond)
+        G_lapse = np.bincount(self.subj, g_lapse, self.n_subj)
+
+        grad = np.zeros(self.n_params)
+        g = self.unpack(grad)
+        g['m'][:] = G_eta.sum(axis=0)
+        g['za'][:] = sa * G_eta.sum(axis=1)
+        g['ze'][:] = se_ * G_eta.ravel()
+        g['v'][:] = G_logw.sum(axis=0)
+        g['zb'][:] = sb * G_logw.sum(axis=1)
+        g['q'][:] = G_lapse * lapse_s * (1 - lapse_s / self.max_lapse)
+        g['log_sigma_a'][:] = sa * (G_eta.sum(axis=1) * p['za']).sum()
+        g['log_sigma_e'][:] = se_ * (G_eta.ravel() * ze).sum()
+        g['log_sigma_b'][:] = sb * (G_logw.sum(axis=1) * p['zb']).sum()
+
+        # priors
+        lp = ll
+        for name in ('za', 'ze', 'zb'):
+            lp -= 0.5 * (p[name]**2).sum()
+            g[name][:] -= p[name]
+        for name in ('m', 'v'):
+            lp -= 0.5 * (p[name]**2).sum() / LOCATION_SD**2
+            g[name][:] -= p[name] / LOCATION_SD**2
+        q0, q_sd = LAPSE_PRIOR
+        lp -= 0.5 * ((p['q'] - q0)**2).sum() / q_sd**2
+        g['q'][:] -= (p['q'] - q0) / q_sd**2
+        for name, s in (('log_sigma_a', sa), ('log_sigma_e', se_), ('log_sigma_b', sb)):
+            # half-normal prior on sigma, plus the log Jacobian of sampling log sigma
+            lp += -0.5 * s**2 / SIGMA_SCALE**2 + np.log(s)
+            g[name][:] += -s**2 / SIGMA_SCALE**2 + 1
+        return lp, grad
+
+    def start_values(self):
+        """Population locations from the tested ranges, random effects at zero."""
+        theta = np.zeros(self.n_params)
+        p = self.unpack(theta)
+        lo = np.full(self.n_cond, np.inf)
+        hi = np.full(self.n_cond, -np.inf)
+        np.minimum.at(lo, self.cond, self.u)
+        np.maximum.at(hi, self.cond, self.u)
+        mid = (lo + hi) / 2
+        p['m'][:] = mid if self.sigmoid == 'weibull' else np.log(np.maximum(mid, 1e-6))
+        p['v'][:] = np.log(np.maximum(hi - lo, 1e-3) / 2)
+        p['q'][:] = LAPSE_PRIOR[0]
+        p['log_sigma_a'][:] = p['log_sigma_e'][:] = p['log_sigma_b'][:] = np.log(0.3)
+        return theta
+
+    def fit_map(self, theta=None, maxiter=5000):
+        """Posterior mode (L-BFGS-B on the negative log posterior).
+
+        Returns:
+            theta (array), lp (float)
+        """
+        if theta is None:
+            theta = self.start_values()
+
+        def objective(t):
+            lp, g = self.log_posterior(t)
+            return -lp, -g
+
+        res = optimize.minimize(objective, theta, jac=True, method='L-BFGS-B',
+                                options={'maxiter': maxiter, 'maxfun': 2 * maxiter, 'ftol': 1e-12, 'gtol': 1e-6})
+        return res.x, -res.fun
+
+    def sample(self, theta, n_samples=1000, n_warmup=500, n_leapfrog=20, step_size=0.01,
+               target_accept=0.8, seed=None):
+        """Hamiltonian Monte Carlo draws from the posterior.
+
+        The step size is adapted to target_accept during warm-up, and a
+        diagonal mass matrix is estimated from its middle half.
+
+        Returns:
+            samples (array): (n_samples, n_params)
+            accept (float): acceptance rate after warm-up
+        """
+        rng = np.random.RandomState(seed)
+        inv_mass = np.ones(self.n_params)
+        lp, grad = self.log_posterior(theta)
+        samples = np.empty((n_samples, self.n_params))
+        warm = []
+        n_accept = 0
+        for it in range(n_warmup + n_samples):
+            r = rng.randn(self.n_params) / np.sqrt(inv_mass)
+            h0 = lp - 0.5 * (r**2 * inv_mass).sum()
+            t, g, r_new = theta.copy(), grad, r + 0.5 * step_size * grad
+            for l in range(n_leapfrog):
+                t = t + step_size * inv_mass * r_new
+                lp_new, g = self.log_posterior(t)
+                if l < n_leapfrog - 1:
+                    r_new = r_new + step_size * g
+            r_new = r_new + 0.5 * step_size * g
+            h1 = lp_new - 0.5 * (r_new**2 * inv_mass).sum()
+            accept = np.exp(min(0., h1 - h0)) if np.isfinite(h1) else 0.
+            if rng.rand() < accept:
+                theta, lp, grad = t, lp_new, g
+                if it >= n_warmup:
+                    n_accept += 1
+            if it < n_warmup:
+                step_size *= np.exp(0.1 * (accept - target_accept))
+                if n_warmup // 4 <= it < 3 * n_warmup // 4:
+                    warm.append(theta)
+                if it == 3 * n_warmup // 4 - 1 and len(warm) > 10:
+                    # the rest of the warm-up re-tunes the step size to the new metric
+                    inv_mass = np.maximum(np.var(warm, axis=0), 1e-8)
+            else:
+                samples[it - n_warmup] = theta
+        return samples, n_accept / float(max(n_samples, 1))
+
+    def fits(self, theta, samples=None, ci=0.95):
+        """Per subject x condition fits in the format of psychometric.fit_conditions.
+
+        Thresholds are those of theta (e.g. the posterior mode); intervals are
+        the central posterior quantiles of samples (NaN without samples).
+        """
+        eta, log_w, lapse = self.cell_params(theta)
+        rows = pd.DataFrame({'subject': np.repeat(np.asarray(self.subjects), self.n_cond)})
+        for col in self.condition_cols:
+            rows[col] = np.tile(self.conditions[col].values, self.n_subj)
+        rows['threshold'] = pm.threshold_scale(self._location(eta)[0], self.sigmoid).ravel()
+        if samples is not None and len(samples):
+            a = (1 - ci) / 2
+            thr = np.stack([pm.threshold_scale(self._location(self.cell_params(s)[0])[0], self.sigmoid).ravel()
+                            for s in samples])
+            rows['threshold_low'] = np.quantile(thr, a, axis=0)
+            rows['threshold_high'] = np.quantile(thr, 1 - a, axis=0)
+        else:
+            rows['threshold_low'] = rows['threshold_high'] = np.nan
+        rows['width'] = np.exp(log_w).ravel()
+        rows['lapse'] = lapse.ravel()
+        n_trials = np.bincount(self.cell, self.n, self.n_subj * self.n_cond)
+        rows['n_trials'] = n_trials.astype(np.int64)
+        return rows[n_trials > 0].reset_index(drop=True)
+
+    def population(self, theta):
+        """Population threshold and width of every condition."""
+        p = self.unpack(theta)
+        pop = self.conditions.copy()
+        pop['threshold'] = pm.threshold_scale(self._location(p['m'])[0], self.sigmoid)
+        pop['width'] = np.exp(p['v'])
+        return pop
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hierarchical fit of all subjects and conditions.')
+    parser.add_argument('data', help='munged trials (all_data.csv or all_data.parquet)')
+    parser.add_argument('--experiment', type=int, default=1, choices=(1, 2), help='output format')
+    parser.add_argument('--sigmoid', default='norm', choices=pm.SIGMOIDS)
+    parser.add_argument('--subjects', type=int, nargs='+', default=sorted(pm.SUBJECT_NAMES))
+    parser.add_argument('--samples', type=int, default=0, help='HMC draws for the intervals (0: mode only)')
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out', default=None, help='thresholds csv (default expt_N_thresholds_hierarchical.csv)')
+    args = parser.parse_args(argv)
+
+    dat = pm.read_table(args.data)
+    dat = dat[dat['subject'].astype(int).isin(args.subjects)]
+    model = HierarchicalModel(dat, sigmoid=args.sigmoid)
+    theta, lp = model.fit_map()
+    samples = None
+    if args.samples:
+        samples, accept = model.sample(theta, args.samples, args.warmup, seed=args.seed)
+        print('HMC acceptance rate {:.2f}'.format(accept))
+    sd = np.exp([theta[model.slices[k]][0] for k in ('log_sigma_a', 'log_sigma_e', 'log_sigma_b')])
+    print('log posterior {:.1f}; subject sd {:.3f}, subject x condition sd {:.3f}, width sd {:.3f}'.format(lp, *sd))
+    table = pm.threshold_table(model.fits(theta, samples), args.experiment)
+    out = args.out or 'expt_{}_thresholds_hierarchical.csv'.format(args.experiment)
+    table.to_csv(out)
+    print('{} conditions written to {}'.format(len(table), out))
+
+
+if __name__ == '__main__':
+    main()
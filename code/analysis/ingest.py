@@ -0,0 +1,334 @@
+# coding: utf-8
+
+""" Find, parse and combine the raw session files in raw-data.
+
+All session files are found with one glob. Subject, session, experiment,
+number of distorted flankers, flanker condition and distortion type are
+parsed from the file name:
+
+    distortionData_flanked_bex_sub_2_session_1.csv                    -> experiment 1
+    0distflanker_distortionData_flanked_rf_sub_5_session_2.csv        -> experiment 3a, 0 distorted flankers
+    4exp3b_distflanker_distortionData_flanked_bex_sub_7_session_1.csv -> experiment 3b, 4 distorted flankers
+
+Files are read in parallel with explicit dtypes (and without the leading
+spaces the experiment code writes after every tab) and combined with a
+single concat.
+
+update_table keeps a combined table up to date incrementally: a state file
+next to the table records (size, mtime, content hash) of every raw file
+that went into it, and only new or modified session files are read. Rows
+are tracked by their 'session_file' column, so rows of modified or deleted
+files are replaced or dropped.
+
+Example:
+    import ingest
+    dat = ingest.load_trials(raw_dir, experiments=['3a', '3b', '3c'])
+    ingest.update_table(raw_dir, 'all_data.csv', experiments=['1'])
+"""
+
+import os
+import io
+import re
+import glob
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+FNAME_RE = re.compile(
+    r'^(?:(?P<n_dist_flanks>\d)(?:exp3(?P<sub_experiment>[bc])_)?distflanker_)?'
+    r'distortionData_(?P<flanked>flanked|unflanked)_(?P<distortion>bex|rf)'
+    r'_sub_(?P<subject>\d+)_session_(?P<session>\d+)\.csv$')
+
+DTYPES = {'subject': np.int64,
+          'session': np.int64,
+          'trial': np.int64,
+          'flanked': str,
+          'distortion': str,
+          'freq': np.int64,
+          'amplitude': np.float64,
+          'spacing': np.float64,
+          'im_name': str,
+          'targ_letter': str,
+          'targ_pos': str,
+          'response': str,
+          'eyemovement': str,
+          'RT': np.float64}
+
+# value of 'response' when the observer did not respond in time
+MISSED_RESPONSE = 'n.a.'
+
+# row order of the combined tables; trials of files that share experiment,
+# subject and session are interleaved by trial, in file name order
+SORT_KEY = ['experiment', 'subject', 'session', 'trial', 'n_dist_flanks', 'session_file']
+
+
+def parse_fname(fname):
+    """Parse a raw data file name.
+
+    Args:
+        fname (string): file name (or path) of a session file
+    Returns:
+        info (dict): experiment ('1', '3a', '3b', '3c'), n_dist_flanks,
+            flanked, distortion, subject and session; None if the name does
+            not match.
+    """
+    m = FNAME_RE.match(os.path.basename(fname))
+    if m is None:
+        return None
+    d = m.groupdict()
+    if d['n_dist_flanks'] is None:
+        experiment = '1'
+        n_dist_flanks = 0
+    else:
+        experiment = '3' + (d['sub_experiment'] or 'a')
+        n_dist_flanks = int(d['n_dist_flanks'])
+    return {'experiment': experiment,
+            'n_dist_flanks': n_dist_flanks,
+            'flanked': d['flanked'],
+            'distortion': d['distortion'],
+            'subject': int(d['subject']),
+            'session': int(d['session'])}
+
+
+def find_sessions(raw_dir, experiments=None, subjects=None):
+    """List the session files in raw_dir.
+
+    Args:
+        raw_dir (string): the raw-data directory
+        experiments (list): keep these experiments ('1', '3a', '3b', '3c'); all if None
+        subjects (list): keep these subject numbers; all if None
+    Returns:
+        sessions (DataFrame): one row per file with its path and the fields
+            parsed from the file name, sorted by path.
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(raw_dir, '*distortionData_*.csv'))):
+        info = parse_fname(path)
+        if info is None:
+            continue
+        info['path'] = path
+        rows.append(info)
+    sessions = pd.DataFrame(rows, columns=['path', 'experiment', 'n_dist_flanks', 'flanked',
+                                           'distortion', 'subject', 'session'])
+    if experiments is not None:
+        sessions = sessions[sessions['experiment'].isin(experiments)]
+    if subjects is not None:
+        sessions = sessions[sessions['subject'].isin([int(s) for s in subjects])]
+    return sessions.reset_index(drop=True)
+
+
+def read_session(path):
+    """Read one tab separated session file."""
+    return pd.read_csv(path, sep='\t', skipinitialspace=True, dtype=DTYPES)
+
+
+def add_correct(dat):
+    """Add a 'correct' column (1/0, NaN for missed responses) by comparing target and response."""
+    dat['correct'] = (dat['targ_pos'] == dat['response']).astype(float)
+    dat.loc[dat['response'] == MISSED_RESPONSE, 'correct'] = np.nan
+    return dat
+
+
+def load_trials(raw_dir, experiments=None, subjects=None, n_workers=8, sessions=None):
+    """Read and combine all trials of the matching session files.
+
+    Args:
+        raw_dir (string): the raw-data directory
+        experiments (list): experiments to load ('1', '3a', '3b', '3c'); all if None
+        subjects (list): subject numbers to load; all if None
+        n_workers (int): number of files read in parallel
+        sessions (DataFrame): the files to read (find_sessions is called if None)
+    Returns:
+        dat (DataFrame): all trials, with the columns of the raw files plus
+            'experiment', 'n_dist_flanks', 'session_file' (file name of the
+            session) and 'correct', sorted by SORT_KEY.
+    """
+    if sessions is None:
+        sessions = find_sessions(raw_dir, experiments, subjects)
+    if len(sessions) == 0:
+        raise IOError('no session files found in {}'.format(raw_dir))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as ex:
+        frames = list(ex.map(read_session, sessions['path']))
+
+    lengths = [len(f) for f in frames]
+    dat = pd.concat(frames, ignore_index=True)
+    dat['experiment'] = np.repeat(sessions['experiment'].values, lengths)
+    dat['n_dist_flanks'] = np.repeat(sessions['n_dist_flanks'].values, lengths)
+    dat['session_file'] = np.repeat([os.path.basename(p) for p in sessions['path']], lengths)
+    dat = add_correct(dat)
+
+    dat.sort_values(by=SORT_KEY, kind='mergesort', inplace=True)
+    return dat.reset_index(drop=True)
+
+
+''' --------  Incremental update  ---------'''
+
+def file_hash(path, block_size=1 << 20):
+    """sha1 of a file's contents."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_state(state_fname):
+    """The {file name: {'size', 'mtime_ns', 'sha1'}} state, empty if there is none."""
+    if not os.path.exists(state_fname):
+        return {}
+    with open(state_fname) as f:
+        return json.load(f)
+
+
+def save_state(state_fname, state):
+    tmp = state_fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, state_fname)
+
+
+def changed_sessions(sessions, state):
+    """Compare session files with a state.
+
+    Files whose size and mtime match the state are unchanged without being
+    read; the others are hashed, so a file that was only touched does not
+    count as modified.
+
+    Args:
+        sessions (DataFrame): as returned by find_sessions
+        state (dict): as returned by load_state
+    Returns:
+        new (list), modified (list), deleted (list): file names
+        state (dict): the state of the current files
+    """
+    new, modified = [], []
+    current = {}
+    for path in sessions['path']:
+        name = os.path.basename(path)
+        st = os.stat(path)
+        entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        old = state.get(name)
+        if old is not None and old['size'] == entry['size'] and old['mtime_ns'] == entry['mtime_ns']:
+            entry['sha1'] = old['sha1']
+        else:
+            entry['sha1'] = file_hash(path)
+            if old is None:
+                new.append(name)
+            elif old['sha1'] != entry['sha1']:
+                modified.append(name)
+        current[name] = entry
+    deleted = sorted(set(state) - set(current))
+    return new, modified, deleted, current
+
+
+def _sort_columns(sort_by, columns):
+    # SORT_KEY's tie-breakers complete any sort order
+    sort_by = list(sort_by) + [c for c in SORT_KEY if c not in sort_by]
+    return [c for c in sort_by if c in columns]
+
+
+def _last_row(table_fname, dtype):
+    """The last row of a csv table, read without reading the rest."""
+    with open(table_fname, 'rb') as f:
+        header = f.readline()
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = max(end - 4096, len(header))
+        while True:
+            f.seek(pos)
+            lines = f.read(end - pos).rstrip(b'\r\n').split(b'\n')
+            if len(lines) > 1 or pos == len(header):
+                break
+            pos = max(pos - 4096, len(header))
+    if not lines[-1].strip():
+        return None
+    return pd.read_csv(io.BytesIO(header + lines[-1] + b'\n'), dtype=dtype).iloc[0]
+
+
+def _sorts_after(dat, last, sort_by):
+    """Whether the first row of dat (sorted by sort_by) comes after the row last."""
+    if last is None:
+        return True
+    first = dat.iloc[0]
+    for c in sort_by:
+        if first[c] != last[c]:
+            return first[c] > last[c]
+    return False
+
+
+def update_table(raw_dir, table_fname, experiments=None, subjects=None, prepare=None,
+                 sort_by=('experiment', 'subject', 'session', 'trial'), state_fname=None,
+                 full=False, n_workers=8):
+    """Bring a combined trial table (csv) up to date with the raw data.
+
+    Only new or modified session files are read. If all changes are new
+    files whose rows sort after the table's last row, they are appended to
+    the table; otherwise the old rows of modified or deleted files are
+    dropped and the table is rewritten. Either way the table equals the
+    one rebuilt with full=True.
+
+    Args:
+        raw_dir (string): the raw-data directory
+        table_fname (string): the combined csv table
+        experiments, subjects (list): which sessions belong in the table (see find_sessions)
+        prepare (function): applied to the trials of the new sessions (as
+            returned by load_trials) before they are merged, e.g. to rename
+            or drop columns. Must keep the 'session_file' column.
+        sort_by (tuple): columns to sort the table by (completed by SORT_KEY)
+        state_fname (string): the state file (table_fname + '.state.json' if None)
+        full (bool): ignore the state and rebuild the table from all files
+        n_workers (int): number of files read in parallel
+    Returns:
+        summary (dict): lists of 'new', 'modified' and 'deleted' file names
+            and whether the table was 'appended' to or 'rewritten'.
+    """
+    if state_fname is None:
+        state_fname = table_fname + '.state.json'
+    sessions = find_sessions(raw_dir, experiments, subjects)
+    state = {} if full or not os.path.exists(table_fname) else load_state(state_fname)
+    new, modified, deleted, current = changed_sessions(sessions, state)
+    summary = {'new': new, 'modified': modified, 'deleted': deleted,
+               'appended': False, 'rewritten': False}
+    if not (new or modified or deleted):
+        if current != state:
+            # touched files: record their new mtimes, so they are not hashed again
+            save_state(state_fname, current)
+        return summary
+
+    read = set(new + modified)
+    dat = None
+    if read:
+        names = sessions['path'].map(os.path.basename)
+        dat = load_trials(raw_dir, sessions=sessions[names.isin(read)].reset_index(drop=True),
+                          n_workers=n_workers)
+        if prepare is not None:
+            dat = prepare(dat)
+
+    table_dtype = dict(DTYPES, experiment=str, session_file=str)
+    append = False
+    if state and not (modified or deleted):
+        with open(table_fname) as f:
+            old_columns = f.readline().rstrip('\r\n').split(',')
+        if list(dat.columns) == old_columns:
+            sort_by = _sort_columns(sort_by, dat.columns)
+            dat = dat.sort_values(by=sort_by, kind='mergesort')
+            append = _sorts_after(dat, _last_row(table_fname, table_dtype), sort_by)
+
+    if append:
+        dat.to_csv(table_fname, mode='a', header=False, index=False)
+        summary['appended'] = True
+    else:
+        if state:
+            old = pd.read_csv(table_fname, dtype=table_dtype)
+            old = old[~old['session_file'].isin(set(modified + deleted))]
+            dat = old if dat is None else pd.concat([old, dat], ignore_index=True)
+        sort_by = _sort_columns(sort_by, dat.columns)
+        dat.sort_values(by=sort_by, kind='mergesort', inplace=True)
+        dat.to_csv(table_fname, index=False)
+        summary['rewritten'] = True
+
+    save_state(state_fname, current)
+    return summary
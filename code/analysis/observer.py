@@ -0,0 +1,280 @@
+# coding: utf-8
+
+""" Template-matching observer for the 4AFC distortion task.
+
+The observer knows the undistorted letters. At each of the four target
+positions it cross-correlates the letter patch with every undistorted
+template, allowing shifts of up to MAX_SHIFT pixels, and takes one minus
+the best normalised correlation as the evidence that the letter there is
+distorted. Gaussian internal noise is added to the four evidence values
+and the observer picks the largest. In experiment 3b three letters are
+distorted, so the observer picks the smallest.
+
+The correlations are computed with one batched FFT over displays x
+positions x templates. Per condition a set of displays is rendered with
+stim_engine (or taken from any generated displays, see `evidence`). Then
+thousands of trials are simulated at once by drawing a display and a noise
+vector for every trial. The resulting counts have the columns of
+psychometric.aggregate, so the model's psychometric functions are fitted
+with psychometric.fit_conditions on the same amplitude ladders as the
+human data.
+
+Example:
+    python observer.py observer_counts.csv --data ../../results/experiment_1/all_data.parquet --noise 0.02 --fit observer_fits.csv
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import psychometric as pm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stimuli'))
+
+import stim_engine as se
+
+MAX_SHIFT = 8
+INTERNAL_NOISE = 0.02
+# munged experiment labels --> stim_engine experiments
+EXPERIMENT_LABELS = {'1': '1', 'a': '3a', 'b': '3b', 'c': '3c', '3a': '3a', '3b': '3b', '3c': '3c'}
+
+
+''' --------  Observer  ---------'''
+
+class TemplateObserver(object):
+    """Template mismatch evidence at the target positions of displays.
+
+    Args:
+        letters (tuple): letters whose undistorted templates the observer knows
+        max_shift (int): largest template shift (pixels) considered a match
+        noise (float): standard deviation of the internal noise
+    """
+
+    def __init__(self, letters=se.LETTERS, max_shift=MAX_SHIFT, noise=INTERNAL_NOISE):
+        self.letters = tuple(letters)
+        self.size = se.PATCH_SIZE
+        self.noise = noise
+        ink = 1 - np.stack([se.letter_template(l) for l in self.letters])
+        self.template_norm = np.sqrt((ink**2).sum(axis=(1, 2)))
+        self.template_dft = np.conj(np.fft.rfft2(ink))
+        # circular shifts of at most max_shift pixels
+        shift = np.minimum(np.arange(self.size), self.size - np.arange(self.size))
+        self.shift_mask = (shift[:, None] <= max_shift) & (shift[None, :] <= max_shift)
+        offset = np.arange(self.size) - self.size // 2
+        self.rows = np.array([int(y) + offset for x, y in se.POSITIONS])
+        self.cols = np.array([int(x) + offset for x, y in se.POSITIONS])
+
+    def patch_evidence(self, patches):
+        """Mismatch evidence of letter patches.
+
+        Args:
+            patches (float): (..., size, size) patches in [0, 1], white background
+        Returns:
+            (...) one minus the best normalised correlation with any template
+        """
+        ink = 1 - np.asarray(patches, dtype=float)
+        lead = ink.shape[:-2]
+        ink = ink.reshape((-1, self.size, self.size))
+        corr = np.fft.irfft2(np.fft.rfft2(ink)[:, None] * self.template_dft[None], s=(self.size, self.size))
+        best = np.where(self.shift_mask, corr, -np.inf).max(axis=(2, 3)) / self.template_norm
+        norm = np.sqrt((ink**2).sum(axis=(1, 2)))
+        similarity = best.max(axis=1) / np.maximum(norm, 1e-12)
+        return (1 - similarity).reshape(lead)
+
+    def evidence(self, displays):
+        """Mismatch evidence at the four target positions of displays (n, rows, cols) --> (n, 4)."""
+        displays = np.asarray(displays)
+        if displays.ndim == 2:
+            displays = displays[None]
+        return self.patch_evidence(displays[:, self.rows[:, :, None], self.cols[:, None, :]])
+
+    def simulate(self, evidence, targets, n_trials, odd_one_out=False, rng=np.random):
+        """simulate_trials with the observer's internal noise."""
+        return simulate_trials(evidence, targets, n_trials, self.noise, odd_one_out, rng)
+
+
+def simulate_trials(evidence, targets, n_trials, noise, odd_one_out=False, rng=np.random):
+    """Simulate 4AFC trials from the evidence of a set of displays.
+
+    Args:
+        evidence (float): (..., n_displays, 4) evidence of every display
+        targets (int): (..., n_displays) position index of the correct answer
+        n_trials (int): trials per leading index, each drawing a display and a noise sample
+        noise (float): standard deviation of the internal noise
+        odd_one_out (bool): pick the least (experiment 3b) instead of the most distorted
+        rng: np.random or a np.random.RandomState
+    Returns:
+        (...) number of correct trials
+    """
+    evidence = np.asarray(evidence, dtype=float)
+    lead = evidence.shape[:-2]
+    n_displays = evidence.shape[-2]
+    evidence = evidence.reshape((-1, n_displays, 4))
+    targets = np.asarray(targets).reshape((-1, n_displays))
+    idx = rng.randint(n_displays, size=(len(evidence), n_trials))
+    rows = np.arange(len(evidence))[:, None]
+    noisy = evidence[rows, idx] + noise * rng.randn(len(evidence), n_trials, 4)
+    choice = noisy.argmin(axis=2) if odd_one_out else noisy.argmax(axis=2)
+    return (choice == targets[rows, idx]).sum(axis=1).reshape(lead)
+
+
+''' --------  Displays  ---------'''
+
+def target_patches(trial):
+    """The four target patches of a trial's distorted display, in POSITIONS order, and the correct index.
+
+    Makes the draws of se.render_pair but only renders the target letters:
+    flanker patches overlap a target patch only in their blank padding.
+    """
+    np.random.seed(trial['seed'])
+    layout = se.make_layout(trial)
+    patches = np.empty((4, se.PATCH_SIZE, se.PATCH_SIZE))
+    for patch in layout['patches']:
+        if patch['role'] == 'target':
+            im = se.letter_template(patch['letter'])
+            if patch['distort']:
+                x_offset, y_offset = se.distortion_offsets(trial['dist_type'], patch['amplitude'], trial['freq'])
+                im = se.distort_patch(im, x_offset, y_offset)
+            patches[se.POSITIONS.index((patch['x'], patch['y']))] = im
+        elif patch['distort']:
+            # keep the draws of the flanker distortions in order
+            se.distortion_offsets(trial['dist_type'], patch['amplitude'], trial['freq'])
+    return patches, se.POSITION_LABELS.index(layout['targ_pos'])
+
+
+def default_ladders():
+    """Conditions and amplitude ladders of the experiment scripts."""
+    rows = []
+    for dist_type in ('bex', 'rf'):
+        for freq in se.DEFAULT_FREQS[dist_type]:
+            for flanked in ('flanked', 'unflanked'):
+                rows.append({'experiment': '1', 'flanked': flanked, 'distortion': dist_type,
+                             'n_dist_flanks': 0, 'freq': freq,
+                             'amplitudes': tuple(se.DEFAULT_AMPS[dist_type])})
+    return pd.DataFrame(rows)
+
+
+def data_ladders(dat):
+    """Conditions and amplitude ladders tested in munged trials (pooled over subjects)."""
+    dat = dat.copy()
+    dat['experiment'] = dat['experiment'].astype(str).map(EXPERIMENT_LABELS) if 'experiment' in dat else '1'
+    if 'n_dist_flanks' not in dat:
+        dat['n_dist_flanks'] = 0
+    cols = ['experiment', 'flanked', 'distortion', 'n_dist_flanks', 'freq']
+    for c in ('flanked', 'distortion'):
+        dat[c] = dat[c].astype(str).str.strip()
+    ladders = dat.groupby(cols, observed=True)['amplitude'].apply(lambda a: tuple(np.unique(a)))
+    return ladders.rename('amplitudes').reset_index()
+
+
+def condition_trials(cond, n_displays, seed=None):
+    """stim_engine trials of a condition, n_displays per amplitude."""
+    return se.plan_trials(cond['experiment'], cond['distortion'], freqs=[cond['freq']],
+                          amps=list(cond['amplitudes']), reps=n_displays,
+                          flanked=cond['flanked'] == 'flanked', distflanked=int(cond['n_dist_flanks']),
+                          seed=seed)
+
+
+def _render(trials):
+    return [target_patches(t) for t in trials]
+
+
+''' --------  Simulation  ---------'''
+
+def simulate_conditions(ladders, observer=None, n_displays=100, n_trials=5000, seed=None,
+                        n_workers=None, batch_size=64):
+    """Model counts for every condition and amplitude.
+
+    Args:
+        ladders (DataFrame): from default_ladders or data_ladders
+        observer (TemplateObserver): the observer (default settings if None)
+        n_displays (int): displays rendered per condition and amplitude
+        n_trials (int): simulated trials per condition and amplitude
+        seed (int): seed of the display and trial draws
+        n_workers (int): rendering processes (cpu count if None)
+        batch_size (int): displays per FFT batch
+    Returns:
+        counts (DataFrame): experiment, flanked, distortion, n_dist_flanks, freq,
+            amplitude, n_correct, n_total
+    """
+    if observer is None:
+        observer = TemplateObserver()
+    rng = np.random.RandomState(seed)
+    trials = ladder_trials(ladders, n_displays, rng)
+    chunks = [trials[s:s + batch_size] for s in range(0, len(trials), batch_size)]
+    pool = mp.Pool(n_workers)
+    try:
+        rendered = [r for chunk in pool.imap(_render, chunks) for r in chunk]
+    finally:
+        pool.close()
+        pool.join()
+
+    patches = np.stack([p for p, t in rendered])
+    targets = np.array([t for p, t in rendered])
+    evidence = np.concatenate([observer.patch_evidence(patches[s:s + batch_size])
+                               for s in range(0, len(patches), batch_size)])
+    return simulate_counts(ladders, evidence, targets, n_displays, n_trials, observer.noise, rng)
+
+
+def ladder_trials(ladders, n_displays, rng=np.random):
+    """stim_engine trials of all conditions, in ladder order (see condition_trials)."""
+    trials = []
+    for i, cond in ladders.iterrows():
+        trials.extend(condition_trials(cond, n_displays, seed=rng.randint(2**31 - 1)))
+    return trials
+
+
+def simulate_counts(ladders, evidence, targets, n_displays, n_trials, noise, rng=np.random):
+    """Simulated counts per condition and amplitude from the evidence of ladder_trials' displays.
+
+    Returns:
+        counts (DataFrame): see simulate_conditions
+    """
+    rows = []
+    start = 0
+    for i, cond in ladders.iterrows():
+        n_amps = len(cond['amplitudes'])
+        # plan_trials orders trials by amplitude, then repetition
+        e = evidence[start:start + n_amps * n_displays].reshape(n_amps, n_displays, 4)
+        t = targets[start:start + n_amps * n_displays].reshape(n_amps, n_displays)
+        start += n_amps * n_displays
+        n_correct = simulate_trials(e, t, n_trials, noise, odd_one_out=cond['experiment'] == '3b', rng=rng)
+        for amplitude, k in zip(cond['amplitudes'], n_correct):
+            rows.append({'experiment': cond['experiment'], 'flanked': cond['flanked'],
+                         'distortion': cond['distortion'], 'n_dist_flanks': cond['n_dist_flanks'],
+                         'freq': cond['freq'], 'amplitude': amplitude,
+                         'n_correct': int(k), 'n_total': n_trials})
+    return pd.DataFrame(rows)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Template-matching observer predictions.')
+    parser.add_argument('out', help='counts csv')
+    parser.add_argument('--data', default=None, help='munged trials whose ladders to use (script defaults if omitted)')
+    parser.add_argument('--noise', type=float, default=INTERNAL_NOISE, help='internal noise sd')
+    parser.add_argument('--max-shift', type=int, default=MAX_SHIFT)
+    parser.add_argument('--displays', type=int, default=100, help='displays per condition and amplitude')
+    parser.add_argument('--trials', type=int, default=5000, help='trials per condition and amplitude')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--fit', default=None, help='also fit psychometric functions and write them here')
+    args = parser.parse_args(argv)
+
+    ladders = default_ladders() if args.data is None else data_ladders(pm.read_table(args.data))
+    observer = TemplateObserver(max_shift=args.max_shift, noise=args.noise)
+    counts = simulate_conditions(ladders, observer, n_displays=args.displays, n_trials=args.trials,
+                                 seed=args.seed, n_workers=args.workers)
+    counts.to_csv(args.out, index=False)
+    print('{} conditions written to {}'.format(len(ladders), args.out))
+    if args.fit:
+        fits = pm.fit_conditions(counts, n_workers=args.workers)
+        fits.to_csv(args.fit, index=False)
+        print('fits written to {}'.format(args.fit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,413 @@
+# coding: utf-8
+
+""" Dependency-tracked analysis pipeline from raw-data to thresholds and figure data.
+
+Every stage declares its input and output files. The stages are:
+
+    trials_N      raw-data session files    -> results/experiment_N/all_data.csv, .parquet
+    fits_N        all_data.parquet          -> results/experiment_N/fits.csv
+    thresholds_N  fits.csv                  -> results/experiment_N/expt_N_thresholds.csv
+    figures_N     expt_N_thresholds.csv     -> results/experiment_N/figure_data.csv
+    spectral      expt_1_thresholds.csv     -> results/spectral_analysis/sf_energy.csv, ori_energy.csv
+
+for experiment 1 and experiment 2 (3a, 3b and 3c).
+
+A stage is stale when its key changed. The key is a hash of the stage's
+parameters, the source of its function, of this file (its helpers and
+settings such as EXPERIMENTS) and of the modules it uses, and the contents
+of its input files. A stage is also stale when one of its outputs is
+missing or differs from what the stage last wrote. Keys and output hashes
+are kept in a state file (results/pipeline_state.json). File hashes are
+cached by (size, mtime) like ingest.update_table does, so unchanged files
+are not read again.
+
+A stage's key is computed only after its upstream stages have finished. A
+stage that rewrites identical outputs therefore does not make its
+downstream stages stale. Changing one session file in raw-data re-runs only
+the stages of that experiment (and trials_N reads only that file, see
+ingest.update_table). Stages whose inputs are ready run in parallel in a
+process pool.
+
+Example:
+    python pipeline.py                  # run the stale stages
+    python pipeline.py --dry-run        # list what would run
+    python pipeline.py --force fits_1   # re-run a stage and whatever depends on it
+"""
+
+import os
+import sys
+import json
+import inspect
+import hashlib
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+import ingest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stimuli'))
+
+TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+PIPELINE_SOURCE = os.path.abspath(__file__)
+
+# sessions and subjects of the two munged tables, as in data_munging_expt_N.py
+EXPERIMENTS = {1: {'experiments': ['1'], 'subjects': [2, 5, 7, 8, 9],
+                   'sort_by': ['subject', 'session', 'trial']},
+               2: {'experiments': ['3a', '3b', '3c'], 'subjects': [2, 5, 7],
+                   'sort_by': ['experiment', 'subject', 'session', 'trial']}}
+
+
+class Stage(object):
+    """One step of the pipeline.
+
+    Args:
+        name (string): unique stage name
+        func (function): module-level function called as func(inputs, outputs, **params)
+        inputs (list): input files (absolute paths)
+        outputs (list): files the stage writes (absolute paths)
+        params (dict): keyword arguments of func (must be json serialisable)
+        modules (list): names of the modules whose source is part of the key
+    """
+
+    def __init__(self, name, func, inputs, outputs, params=None, modules=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.modules = list(modules)
+
+    def __repr__(self):
+        return 'Stage({!r})'.format(self.name)
+
+
+''' --------  Stage functions  ---------'''
+
+def _prepare_expt_1(dat):
+    return dat.drop(columns=['experiment', 'n_dist_flanks'])
+
+
+def _prepare_expt_2(dat):
+    # sub-experiment label as before ('a', 'b', 'c'):
+    dat['experiment'] = dat['experiment'].str[1:]
+    return dat
+
+
+def munge(inputs, outputs, experiment, raw_dir):
+    """Combined trial table of an experiment (see data_munging_expt_N.py)."""
+    import trial_store
+    csv_fname, store_fname = outputs
+    spec = EXPERIMENTS[experiment]
+    prepare = _prepare_expt_1 if experiment == 1 else _prepare_expt_2
+    summary = ingest.update_table(raw_dir, csv_fname, experiments=spec['experiments'],
+                                  subjects=spec['subjects'], prepare=prepare, sort_by=spec['sort_by'])
+    if summary['appended'] or summary['rewritten'] or not os.path.exists(store_fname):
+        trial_store.csv_to_store(csv_fname, store_fname)
+
+
+def fit(inputs, outputs, sigmoid, subjects, n_workers):
+    """Maximum likelihood fits of every subject and condition (see psychometric.py)."""
+    import psychometric as pm
+    dat = pm.read_table(inputs[0])
+    dat = dat[dat['subject'].astype(int).isin(subjects)]
+    fits = pm.fit_conditions(pm.aggregate(dat), sigmoid=sigmoid, n_workers=n_workers)
+    fits.to_csv(outputs[0], index=False)
+
+
+def thresholds(inputs, outputs, experiment):
+    """Threshold table in the format of the paper's files."""
+    import psychometric as pm
+    fits = pd.read_csv(inputs[0], dtype={'experiment': str, 'flanked': str, 'distortion': str})
+    pm.threshold_table(fits, experiment).to_csv(outputs[0])
+
+
+def figure_data(inputs, outputs, experiment):
+    """Mean log threshold over subjects, with its standard error, per plotted condition."""
+    t = pd.read_csv(inputs[0], index_col=0, dtype={'experiment': str})
+    by = ['distortion', 'flanked', 'freq'] if experiment == 1 else ['distortion', 'experiment', 'n_dist_flanks']
+    t['log_threshold'] = np.log(t['threshold'])
+    g = t.groupby(by, sort=True)['log_threshold']
+    out = g.agg(['mean', 'std', 'count']).reset_index()
+    out['sem'] = out['std'] / np.sqrt(out['count'])
+    out['threshold'] = np.exp(out['mean'])
+    out['threshold_low'] = np.exp(out['mean'] - out['sem'])
+    out['threshold_high'] = np.exp(out['mean'] + out['sem'])
+    out = out.rename(columns={'mean': 'mean_log_threshold', 'count': 'n_subjects'}).drop(columns='std')
+    out.to_csv(outputs[0], index=False)
+
+
+def spectral(inputs, outputs, reps, seed):
+    """Spatial frequency and orientation energy at the mean thresholds (see spectral_energy.py)."""
+    import spectral_energy
+    sf_energy, ori_energy = spectral_energy.run_analysis(pd.read_csv(inputs[0]), reps=reps, seed=seed)
+    sf_energy.to_csv(outputs[0])
+    ori_energy.to_csv(outputs[1])
+
+
+def default_stages(top_dir=TOP_DIR, sigmoid='norm', spectral_reps=15, n_workers=1):
+    """The stages from raw-data to figure data.
+
+    Args:
+        top_dir (string): project directory (with raw-data and results)
+        sigmoid (string): see psychometric.SIGMOIDS
+        spectral_reps (int): distortions per letter and condition of the spectral analysis
+        n_workers (int): processes of each fitting stage
+    Returns:
+        stages (list)
+    """
+    raw_dir = os.path.join(top_dir, 'raw-data')
+    stages = []
+    for expt, spec in sorted(EXPERIMENTS.items()):
+        out_dir = os.path.join(top_dir, 'results', 'experiment_{}'.format(expt))
+        raw = list(ingest.find_sessions(raw_dir, spec['experiments'], spec['subjects'])['path'])
+        trials = [os.path.join(out_dir, 'all_data.csv'), os.path.join(out_dir, 'all_data.parquet')]
+        fits = os.path.join(out_dir, 'fits.csv')
+        table = os.path.join(out_dir, 'expt_{}_thresholds.csv'.format(expt))
+        stages.append(Stage('trials_{}'.format(expt), munge, raw, trials,
+                            {'experiment': expt, 'raw_dir': raw_dir}, ['ingest', 'trial_store']))
+        stages.append(Stage('fits_{}'.format(expt), fit, trials[1:], [fits],
+                            {'sigmoid': sigmoid, 'subjects': spec['subjects'], 'n_workers': n_workers},
+                            ['psychometric', 'trial_store']))
+        stages.append(Stage('thresholds_{}'.format(expt), thresholds, [fits], [table],
+                            {'experiment': expt}, ['psychometric']))
+        stages.append(Stage('figures_{}'.format(expt), figure_data, [table],
+                            [os.path.join(out_dir, 'figure_data.csv')], {'experiment': expt}))
+    spectral_dir = os.path.join(top_dir, 'results', 'spectral_analysis')
+    stages.append(Stage('spectral', spectral, [stages[2].outputs[0]],
+                        [os.path.join(spectral_dir, 'sf_energy.csv'), os.path.join(spectral_dir, 'ori_energy.csv')],
+                        {'reps': spectral_reps, 'seed': 22239217}, ['spectral_energy', 'stim_engine']))
+    return stages
+
+
+''' --------  Hashing and state  ---------'''
+
+class FileHasher(object):
+    """sha1 of file contents, cached by (size, mtime) across runs.
+
+    Args:
+        cache (dict): {path: {'size', 'mtime_ns', 'sha1'}}, e.g. from the state file
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else {}
+
+    def __call__(self, path):
+        """The file's sha1, or None if it does not exist."""
+        if not os.path.exists(path):
+            self.cache.pop(path, None)
+            return None
+        st = os.stat(path)
+        old = self.cache.get(path)
+        if old is not None and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            return old['sha1']
+        sha1 = ingest.file_hash(path)
+        self.cache[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1}
+        return sha1
+
+
+def module_source(name):
+    """Source file of an importable module (None for built-in modules)."""
+    try:
+        return inspect.getsourcefile(importlib.import_module(name))
+    except (TypeError, ImportError):
+        return None
+
+
+def stage_key(stage, hasher):
+    """Hash of a stage's parameters, code and input contents."""
+    h = hashlib.sha1()
+    h.update(stage.name.encode())
+    h.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    h.update(inspect.getsource(stage.func).encode())
+    # stage functions call helpers and read settings of this file (e.g. _prepare_expt_2, EXPERIMENTS)
+    h.update('pipeline:{}'.format(hasher(PIPELINE_SOURCE)).encode())
+    for name in sorted(stage.modules):
+        src = module_source(name)
+        h.update('{}:{}'.format(name, hasher(src) if src else None).encode())
+    for path in sorted(stage.inputs):
+        h.update('{}:{}'.format(os.path.relpath(path, TOP_DIR), hasher(path)).encode())
+    return h.hexdigest()
+
+
+def load_state(state_fname):
+    """The pipeline state: {'stages': {name: {'key', 'outputs'}}, 'files': hash cache}."""
+    state = ingest.load_state(state_fname)
+    state.setdefault('stages', {})
+    state.setdefault('files', {})
+    return state
+
+
+def is_stale(stage, key, state, hasher):
+    """Whether a stage must run: new key, or outputs missing or changed since it wrote them."""
+    old = state['stages'].get(stage.name)
+    if old is None or old['key'] != key:
+        return True
+    return any(hasher(path) is None or hasher(path) != old['outputs'].get(path) for path in stage.outputs)
+
+
+''' --------  Scheduling  ---------'''
+
+def dependencies(stages):
+    """{stage name: set of names of the stages producing its inputs}."""
+    producer = {}
+    for s in stages:
+        for path in s.outputs:
+            if path in producer:
+                raise ValueError('{} is written by {} and {}'.format(path, producer[path], s.name))
+            producer[path] = s.name
+    deps = dict((s.name, set(producer[p] for p in s.inputs if p in producer)) for s in stages)
+    # refuse cycles
+    done, remaining = set(), dict(deps)
+    while remaining:
+        ready = [n for n, d in remaining.items() if d <= done]
+        if not ready:
+            raise ValueError('dependency cycle between {}'.format(sorted(remaining)))
+        for n in ready:
+            done.add(n)
+            del remaining[n]
+    return deps
+
+
+def downstream(deps, names):
+    """The named stages and all stages that depend on them."""
+    out = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for n, d in deps.items():
+            if n not in out and d & out:
+                out.add(n)
+                changed = True
+    return out
+
+
+def _run_stage(stage):
+    for d in set(os.path.dirname(p) for p in stage.outputs):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    stage.func(stage.inputs, stage.outputs, **stage.params)
+    return stage.name
+
+
+def run(stages, state_fname, n_workers=None, force=(), dry_run=False, log=print):
+    """Run the stale stages, in parallel where the dependencies allow.
+
+    Args:
+        stages (list): Stage objects
+        state_fname (string): state file (created if missing)
+        n_workers (int): processes (cpu count if None, 1 runs in this process)
+        force (list): names of stages to re-run regardless of their key
+        dry_run (bool): only report; downstream stages of stale ones are
+            reported as 'pending' since their keys depend on new outputs
+        log (function): called with a message per stage
+    Returns:
+        status (dict): {stage name: 'ran', 'up to date', 'failed',
+            'blocked' (an upstream stage failed) or 'pending' (dry run)}
+    """
+    deps = dependencies(stages)
+    forced = downstream(deps, force)
+    by_name = dict((s.name, s) for s in stages)
+    state = load_state(state_fname)
+    hasher = FileHasher(state['files'])
+    status, keys = {}, {}
+    pool = None if n_workers == 1 or dry_run else ProcessPoolExecutor(n_workers)
+    running = {}
+
+    def finish(name, error=None):
+        if error is not None:
+            status[name] = 'failed'
+            log('{}: failed ({})'.format(name, error))
+            return
+        stage = by_name[name]
+        state['stages'][name] = {'key': keys[name], 'outputs': dict((p, hasher(p)) for p in stage.outputs)}
+        state['files'] = hasher.cache
+        # saved after every stage, so an interrupted run keeps its progress
+        ingest.save_state(state_fname, state)
+        status[name] = 'ran'
+        log('{}: done'.format(name))
+
+    try:
+        while len(status) < len(stages):
+            progressed = False
+            for s in stages:
+                if s.name in status or s.name in running:
+                    continue
+                upstream = [status.get(d) for d in deps[s.name]]
+                if any(u in ('failed', 'blocked') for u in upstream):
+                    status[s.name] = 'blocked'
+                    progressed = True
+                    continue
+                if any(u == 'pending' for u in upstream):
+                    status[s.name] = 'pending'
+                    progressed = True
+                    continue
+                if any(u is None for u in upstream):
+                    continue
+                keys[s.name] = stage_key(s, hasher)
+                progressed = True
+                if s.name not in forced and not is_stale(s, keys[s.name], state, hasher):
+                    status[s.name] = 'up to date'
+                elif dry_run:
+                    status[s.name] = 'pending'
+                    log('{}: stale'.format(s.name))
+                elif pool is None:
+                    log('{}: running'.format(s.name))
+                    try:
+                        _run_stage(s)
+                    except Exception as e:
+                        finish(s.name, e)
+                    else:
+                        finish(s.name)
+                else:
+                    log('{}: running'.format(s.name))
+                    running[s.name] = pool.submit(_run_stage, s)
+            if running and not progressed:
+                done, _ = wait(list(running.values()), return_when=FIRST_COMPLETED)
+                for name in [n for n, f in running.items() if f in done]:
+                    f = running.pop(name)
+                    finish(name, f.exception())
+            elif not running and not progressed:
+                raise RuntimeError('no stage can run: {}'.format(sorted(set(by_name) - set(status))))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return status
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the stale stages from raw-data to figure data.')
+    parser.add_argument('stages', nargs='*', help='run only these stages and what they need (default all)')
+    parser.add_argument('--top-dir', default=TOP_DIR)
+    parser.add_argument('--state', default=None, help='state file (default results/pipeline_state.json)')
+    parser.add_argument('--sigmoid', default='norm')
+    parser.add_argument('--spectral-reps', type=int, default=15)
+    parser.add_argument('--force', nargs='+', default=[], help='re-run these stages and their downstream stages')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+
+    stages = default_stages(args.top_dir, args.sigmoid, args.spectral_reps)
+    if args.stages:
+        deps = dependencies(stages)
+        wanted, todo = set(), list(args.stages)
+        while todo:
+            n = todo.pop()
+            if n not in deps:
+                parser.error('unknown stage {} (stages: {})'.format(n, ', '.join(sorted(deps))))
+            if n not in wanted:
+                wanted.add(n)
+                todo.extend(deps[n])
+        stages = [s for s in stages if s.name in wanted]
+    state_fname = args.state or os.path.join(args.top_dir, 'results', 'pipeline_state.json')
+    status = run(stages, state_fname, n_workers=args.workers, force=args.force, dry_run=args.dry_run)
+    for name in [s.name for s in stages]:
+        print('{:14s} {}'.format(name, status[name]))
+    if any(v in ('failed', 'blocked') for v in status.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
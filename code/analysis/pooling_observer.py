@@ -0,0 +1,230 @@
+# coding: utf-8
+
+""" Summary-statistic pooling observer for crowded displays.
+
+A texture-style model of crowding: the observer only has access to
+summary statistics of oriented filter energy, pooled over regions that
+grow with eccentricity. For every target position a window holding the
+target and its four flankers is cut out of the display (downsampled by
+DOWNSAMPLE) and filtered with a bank of log-Gabor filters (PEAK_FREQS x
+N_ORIENTATIONS, quadrature pairs, so the magnitude is the local energy).
+The energies are pooled with a Gaussian weight centred on the target,
+with a standard deviation of POOL_SCALE x eccentricity along the radial
+direction and half that tangentially (Toet & Levi, 1992). Pooled
+statistics are the log mean energy of every band and the correlations of
+the orientation bands of each scale.
+
+The observer compares the statistics of each position in the distorted
+display with those of the undistorted twin and picks the position that
+differs most (the least in experiment 3b), after Gaussian internal noise.
+
+The filter bank and the pooling weights are computed once per process, and
+every display batch is filtered with one FFT per window and one inverse
+FFT per band. Trials, ladders and the simulation of 4AFC counts are those
+of observer.py, so the model is scored on the ladders of the human data.
+
+Example:
+    python pooling_observer.py pooling_counts.csv --data ../../results/experiment_1/all_data.parquet ../../results/experiment_2/all_data.parquet
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from scipy import fft
+import psychometric as pm
+import observer as ob
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stimuli'))
+
+import stim_engine as se
+
+DOWNSAMPLE = 2
+# window around a target in full-resolution pixels: target and flankers plus the pooling tails
+WINDOW = 384
+N_ORIENTATIONS = 4
+# peak frequencies (cycles per downsampled pixel) and bandwidth of the log-Gabor filters
+PEAK_FREQS = (0.32, 0.16, 0.08)
+SIGMA_ON_F = 0.55
+# pooling sd (radial) as a fraction of eccentricity; tangential sd is half of it
+POOL_SCALE = 0.25
+INTERNAL_NOISE = 0.1
+
+_banks = {}
+
+
+''' --------  Filters and pooling  ---------'''
+
+def filter_bank(size, peak_freqs=PEAK_FREQS, n_orientations=N_ORIENTATIONS, sigma_on_f=SIGMA_ON_F):
+    """One-sided log-Gabor filters in the Fourier domain, shape (n_scales, n_orientations, size, size)."""
+    f = np.fft.fftfreq(size)
+    fx, fy = np.meshgrid(f, f)
+    radius = np.hypot(fx, fy)
+    radius[0, 0] = 1.
+    theta = np.arctan2(fy, fx)
+    bank = np.empty((len(peak_freqs), n_orientations, size, size))
+    for i, f0 in enumerate(peak_freqs):
+        radial = np.exp(-np.log(radius / f0)**2 / (2 * np.log(sigma_on_f)**2))
+        radial[0, 0] = 0
+        for j in range(n_orientations):
+            d = np.angle(np.exp(1j * (theta - j * np.pi / n_orientations)))
+            # cos^2 tuning over one half plane: analytic (quadrature) responses
+            bank[i, j] = radial * np.where(np.abs(d) < np.pi / 2, np.cos(d)**2, 0)
+    return bank
+
+
+def pooling_weights(size, scale=POOL_SCALE, downsample=DOWNSAMPLE):
+    """Normalised Gaussian pooling weights (4, size, size) of the target positions, in POSITIONS order."""
+    weights = np.empty((len(se.POSITIONS), size, size))
+    offset = (np.arange(size) - size // 2) * downsample
+    xx, yy = np.meshgrid(offset, offset)
+    for p, (x, y) in enumerate(se.POSITIONS):
+        radial = np.array([x - se.FIXATION_POSITION[0], y - se.FIXATION_POSITION[1]], dtype=float)
+        ecc = np.hypot(*radial)
+        radial /= ecc
+        r = xx * radial[0] + yy * radial[1]
+        t = -xx * radial[1] + yy * radial[0]
+        sd = scale * ecc
+        w = np.exp(-0.5 * ((r / sd)**2 + (t / (sd / 2))**2))
+        weights[p] = w / w.sum()
+    return weights
+
+
+def model_bank(window=WINDOW, downsample=DOWNSAMPLE, pool_scale=POOL_SCALE):
+    """Filter bank and pooling weights for a window size (cached per process)."""
+    key = (window, downsample, pool_scale)
+    if key not in _banks:
+        size = window // downsample
+        _banks[key] = (filter_bank(size).astype(np.float32), pooling_weights(size, pool_scale, downsample))
+    return _banks[key]
+
+
+def windows(displays, window=WINDOW, downsample=DOWNSAMPLE):
+    """Windows around the target positions, block-averaged: (n, 4, window / downsample, ...)."""
+    n = len(displays)
+    out = np.empty((n, len(se.POSITIONS), window, window))
+    for p, (x, y) in enumerate(se.POSITIONS):
+        y0, x0 = int(y) - window // 2, int(x) - window // 2
+        # outside the canvas is background
+        out[:, p] = 1.
+        ys, xs = max(y0, 0), max(x0, 0)
+        ye, xe = min(y0 + window, displays.shape[1]), min(x0 + window, displays.shape[2])
+        out[:, p, ys - y0:ye - y0, xs - x0:xe - x0] = displays[:, ys:ye, xs:xe]
+    size = window // downsample
+    return out.reshape(n, len(se.POSITIONS), size, downsample, size, downsample).mean(axis=(3, 5))
+
+
+def pooled_statistics(displays, window=WINDOW, downsample=DOWNSAMPLE, pool_scale=POOL_SCALE):
+    """Pooled summary statistics at the four target positions.
+
+    Args:
+        displays (float): (n, rows, cols) displays in [0, 1]
+    Returns:
+        (n, 4, n_stats): log mean energy of every band, then the correlations
+            of the orientation bands of each scale
+    """
+    bank, weights = model_bank(window, downsample, pool_scale)
+    # single precision halves the FFT time; the statistics are pooled in double
+    dft = fft.fft2((1 - windows(np.asarray(displays, dtype=float), window, downsample)).astype(np.float32))
+    pairs = [(i, j) for i in range(N_ORIENTATIONS) for j in range(i + 1, N_ORIENTATIONS)]
+    log_means, corrs = [], []
+    for s in range(len(bank)):
+        energy = np.abs(fft.ifft2(dft[:, :, None] * bank[s][None, None]))**2   # (n, 4, ori, h, w)
+        w = weights[None, :, None]
+        mean = (energy * w).sum(axis=(-2, -1))
+        centred = energy - mean[..., None, None]
+        var = (centred**2 * w).sum(axis=(-2, -1))
+        log_means.append(np.log(mean + 1e-12))
+        for i, j in pairs:
+            cov = (centred[:, :, i] * centred[:, :, j] * weights[None]).sum(axis=(-2, -1))
+            corrs.append(cov / np.sqrt(var[:, :, i] * var[:, :, j] + 1e-24))
+    return np.concatenate([np.concatenate(log_means, axis=2), np.stack(corrs, axis=2)], axis=2)
+
+
+def statistic_distance(pairs, **kwargs):
+    """Distance between the pooled statistics of distorted and undistorted displays.
+
+    Args:
+        pairs (float): (n, 2, rows, cols) undistorted and distorted displays
+    Returns:
+        (n, 4) Euclidean distance per target position
+    """
+    pairs = np.asarray(pairs)
+    stats = pooled_statistics(pairs.reshape((-1,) + pairs.shape[2:]), **kwargs)
+    stats = stats.reshape((len(pairs), 2) + stats.shape[1:])
+    return np.sqrt(((stats[:, 1] - stats[:, 0])**2).sum(axis=2))
+
+
+def _score(trials):
+    pairs = np.empty((len(trials), 2) + se.CANVAS_SHAPE)
+    targets = []
+    for j, trial in enumerate(trials):
+        pair, meta = se.render_pair(trial, out=pairs[j])
+        targets.append(se.POSITION_LABELS.index(meta['targ_pos']))
+    return statistic_distance(pairs), np.array(targets)
+
+
+''' --------  Simulation  ---------'''
+
+def simulate_conditions(ladders, noise=INTERNAL_NOISE, n_displays=50, n_trials=5000, seed=None,
+                        n_workers=None, batch_size=8):
+    """Pooling model counts for every condition and amplitude.
+
+    Args:
+        ladders (DataFrame): from observer.default_ladders or observer.data_ladders
+        noise (float): internal noise sd on the statistic distances
+        n_displays (int): display pairs rendered per condition and amplitude
+        n_trials (int): simulated trials per condition and amplitude
+        seed (int): seed of the display and trial draws
+        n_workers (int): processes rendering and scoring display batches (cpu count if None)
+        batch_size (int): display pairs per batch
+    Returns:
+        counts (DataFrame): see observer.simulate_conditions
+    """
+    rng = np.random.RandomState(seed)
+    trials = ob.ladder_trials(ladders, n_displays, rng)
+    chunks = [trials[s:s + batch_size] for s in range(0, len(trials), batch_size)]
+    pool = mp.Pool(n_workers)
+    try:
+        scored = pool.map(_score, chunks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    evidence = np.concatenate([e for e, t in scored])
+    targets = np.concatenate([t for e, t in scored])
+    return ob.simulate_counts(ladders, evidence, targets, n_displays, n_trials, noise, rng)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summary-statistic pooling observer predictions.')
+    parser.add_argument('out', help='counts csv')
+    parser.add_argument('--data', nargs='+', default=None,
+                        help='munged trials whose ladders to use (experiment 1 script defaults if omitted)')
+    parser.add_argument('--noise', type=float, default=INTERNAL_NOISE, help='internal noise sd')
+    parser.add_argument('--displays', type=int, default=50, help='display pairs per condition and amplitude')
+    parser.add_argument('--trials', type=int, default=5000, help='trials per condition and amplitude')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--fit', default=None, help='also fit psychometric functions and write them here')
+    args = parser.parse_args(argv)
+
+    if args.data is None:
+        ladders = ob.default_ladders()
+    else:
+        ladders = pd.concat([ob.data_ladders(pm.read_table(f)) for f in args.data], ignore_index=True)
+    counts = simulate_conditions(ladders, noise=args.noise, n_displays=args.displays, n_trials=args.trials,
+                                 seed=args.seed, n_workers=args.workers)
+    counts.to_csv(args.out, index=False)
+    print('{} conditions written to {}'.format(len(ladders), args.out))
+    if args.fit:
+        fits = pm.fit_conditions(counts, n_workers=args.workers)
+        fits.to_csv(args.fit, index=False)
+        print('fits written to {}'.format(args.fit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# coding: utf-8
+
+""" Grid-based Bayesian psychometric function estimation.
+
+psignifit-style posterior over (threshold, width, lapse) on a fixed grid.
+For every amplitude ladder the log of psi and of 1 - psi is computed once
+on the grid x stimulus levels. The log likelihood of every condition
+tested on that ladder is then one matrix product of these tensors with
+the (correct, incorrect) counts, and the posteriors of all conditions are
+normalised together.
+
+Priors follow psignifit: the threshold is uniform over the tested range
+with a cosine fall-off beyond it, the width is uniform over its grid, and
+the lapse rate has a Beta(1, 10) prior.
+
+The returned fits have the columns of psychometric.fit_conditions, so
+psychometric.threshold_table formats them like the paper's threshold
+files.
+
+Example:
+    python posterior.py ../../results/experiment_1/all_data.parquet --experiment 1 --out expt_1_thresholds.csv
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import stats
+import psychometric as pm
+
+GRID_SHAPE = (120, 40, 20)  # threshold, width, lapse
+MAX_LAPSE = 0.2
+
+_tensor_cache = {}
+
+
+class LadderGrid(object):
+    """Parameter grid, prior and log psi tensors for one amplitude ladder.
+
+    Args:
+        levels (tuple): the tested amplitudes
+        sigmoid (string): see psychometric.SIGMOIDS
+        grid_shape (tuple): number of threshold, width and lapse grid points
+        gamma (float): guess rate
+        max_lapse (float): largest lapse rate on the grid
+    """
+
+    def __init__(self, levels, sigmoid='norm', grid_shape=GRID_SHAPE, gamma=pm.GUESS_RATE,
+                 max_lapse=MAX_LAPSE):
+        self.levels = np.asarray(levels, dtype=float)
+        self.sigmoid = sigmoid
+        u = pm.stimulus_scale(self.levels, sigmoid)
+        lo, hi = u.min(), u.max()
+        span = hi - lo
+        n_t, n_w, n_l = grid_shape
+
+        # threshold: the tested range plus half of it on both sides
+        self.mu = np.linspace(lo - span / 2, hi + span / 2, n_t)
+        # width: from the smallest level step to three times the range
+        min_step = np.diff(np.unique(u)).min() if len(u) > 1 else span
+        self.width = np.exp(np.linspace(np.log(min_step), np.log(3 * span), n_w))
+        self.lapse = np.linspace(0, max_lapse, n_l)
+
+        prior_t = np.ones(n_t)
+        outside = (self.mu < lo) | (self.mu > hi)
+        dist = np.where(self.mu < lo, lo - self.mu, self.mu - hi)
+        prior_t[outside] = 0.5 + 0.5 * np.cos(np.pi * dist[outside] / (span / 2))
+        prior_l = stats.beta.pdf(self.lapse, 1, 10)
+        log_prior = np.log(np.maximum(prior_t, 1e-300))[:, None, None] + \
+            np.log(prior_l)[None, None, :]
+        self.log_prior = np.broadcast_to(log_prior, grid_shape).reshape(-1)
+
+        params = np.empty(grid_shape + (3,))
+        params[..., 0] = self.mu[:, None, None]
+        params[..., 1] = np.log(self.width)[None, :, None]
+        params[..., 2] = self.lapse[None, None, :]
+        p = pm._psi_u(params.reshape(-1, 3), u[None, :], sigmoid, gamma)
+        p = np.clip(p, 1e-12, 1 - 1e-12)
+        # (n_grid, n_levels) each
+        self.log_p = np.log(p)
+        self.log_q = np.log1p(-p)
+        self.grid_shape = grid_shape
+
+    def log_posterior(self, k, n):
+        """Unnormalised log posterior of every condition.
+
+        Args:
+            k, n (array): (n_conditions, n_levels) correct and total trials, in
+                the order of self.levels
+        Returns:
+            (n_conditions, n_grid) array
+        """
+        return k @ self.log_p.T + (n - k) @ self.log_q.T + self.log_prior
+
+    def posterior(self, k, n):
+        """Normalised posterior, shape (n_conditions,) + grid_shape."""
+        lp = self.log_posterior(k, n)
+        lp -= lp.max(axis=1, keepdims=True)
+        post = np.exp(lp)
+        post /= post.sum(axis=1, keepdims=True)
+        return post.reshape((len(k),) + self.grid_shape)
+
+
+def ladder_grid(levels, sigmoid='norm', grid_shape=GRID_SHAPE, max_lapse=MAX_LAPSE):
+    """LadderGrid for a ladder, computed once per process and reused."""
+    key = (tuple(np.round(levels, 10)), sigmoid, tuple(grid_shape), max_lapse)
+    if key not in _tensor_cache:
+        _tensor_cache[key] = LadderGrid(levels, sigmoid, grid_shape, max_lapse=max_lapse)
+    return _tensor_cache[key]
+
+
+def credible_interval(grid, marginal, ci=0.95):
+    """Central credible interval of marginals on a grid (one row per condition)."""
+    cdf = np.cumsum(marginal, axis=1)
+    # grid points as the centres of equal-mass bins
+    edges = np.concatenate([[grid[0]], (grid[1:] + grid[:-1]) / 2, [grid[-1]]])
+    cdf = np.concatenate([np.zeros((len(marginal), 1)), cdf], axis=1)
+    a = (1 - ci) / 2
+    low = np.array([np.interp(a, c, edges) for c in cdf])
+    high = np.array([np.interp(1 - a, c, edges) for c in cdf])
+    return low, high
+
+
+def fit_conditions(counts, sigmoid='norm', ci=0.95, grid_shape=GRID_SHAPE, max_lapse=MAX_LAPSE,
+                   condition_cols=None, return_marginals=False):
+    """Posterior estimates for every condition of a count table.
+
+    Args:
+        counts (DataFrame): as returned by psychometric.aggregate
+        sigmoid (string): 'norm', 'logistic' or 'weibull'
+        ci (float): mass of the credible intervals
+        grid_shape (tuple): threshold, width and lapse grid points
+        max_lapse (float): largest lapse rate on the grid
+        condition_cols (list): see psychometric.aggregate
+        return_marginals (bool): also return the marginal posteriors
+    Returns:
+        fits (DataFrame): condition columns plus threshold (posterior mean),
+            threshold_low, threshold_high, threshold_map, width, lapse and
+            n_trials, as in psychometric.fit_conditions.
+        marginals (list): if return_marginals, per condition a dict of
+            grids ('threshold', 'width', 'lapse', in amplitude units for the
+            threshold) and marginal posteriors ('p_threshold', ...)
+    """
+    if condition_cols is None:
+        condition_cols = [c for c in pm.CONDITION_COLS if c in counts.columns]
+    groups = counts.groupby(condition_cols, observed=True, sort=True)
+    keys, ladders = [], []
+    for key, g in groups:
+        keys.append(key if isinstance(key, tuple) else (key,))
+        ladders.append(tuple(g['amplitude'].values))
+    fits = pd.DataFrame(keys, columns=condition_cols)
+    for col in ('threshold', 'threshold_low', 'threshold_high', 'threshold_map', 'width', 'lapse'):
+        fits[col] = np.nan
+    fits['n_trials'] = 0
+    marginals = [None] * len(fits)
+    cond_index = dict((k, i) for i, k in enumerate(keys))
+
+    # all conditions tested on the same ladder share the grid tensors:
+    by_ladder = {}
+    for i, ladder in enumerate(ladders):
+        by_ladder.setdefault(ladder, []).append(i)
+    for ladder, idx in by_ladder.items():
+        grid = ladder_grid(ladder, sigmoid, grid_shape, max_lapse)
+        k = np.empty((len(idx), len(ladder)))
+        n = np.empty((len(idx), len(ladder)))
+        for j, i in enumerate(idx):
+            g = groups.get_group(keys[i] if len(keys[i]) > 1 else keys[i][0])
+            k[j], n[j] = g['n_correct'].values, g['n_total'].values
+        post = grid.posterior(k, n)
+        p_mu = post.sum(axis=(2, 3))
+        p_w = post.sum(axis=(1, 3))
+        p_l = post.sum(axis=(1, 2))
+        low, high = credible_interval(grid.mu, p_mu, ci)
+        mean_mu = p_mu @ grid.mu
+        map_mu = grid.mu[p_mu.argmax(axis=1)]
+        fits.loc[idx, 'threshold'] = pm.threshold_scale(mean_mu, sigmoid)
+        fits.loc[idx, 'threshold_low'] = pm.threshold_scale(low, sigmoid)
+        fits.loc[idx, 'threshold_high'] = pm.threshold_scale(high, sigmoid)
+        fits.loc[idx, 'threshold_map'] = pm.threshold_scale(map_mu, sigmoid)
+        fits.loc[idx, 'width'] = p_w @ grid.width
+        fits.loc[idx, 'lapse'] = p_l @ grid.lapse
+        fits.loc[idx, 'n_trials'] = n.sum(axis=1).astype(np.int64)
+        if return_marginals:
+            for j, i in enumerate(idx):
+                marginals[i] = {'threshold': pm.threshold_scale(grid.mu, sigmoid),
+                                'width': grid.width, 'lapse': grid.lapse,
+                                'p_threshold': p_mu[j], 'p_width': p_w[j], 'p_lapse': p_l[j]}
+    if return_marginals:
+        return fits, marginals
+    return fits
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Grid posterior thresholds for all conditions.')
+    parser.add_argument('data', help='munged trials (all_data.csv or all_data.parquet)')
+    parser.add_argument('--experiment', type=int, default=1, choices=(1, 2), help='output format')
+    parser.add_argument('--sigmoid', default='norm', choices=pm.SIGMOIDS)
+    parser.add_argument('--grid', type=int, nargs=3, default=list(GRID_SHAPE),
+                        help='threshold, width and lapse grid points')
+    parser.add_argument('--subjects', type=int, nargs='+', default=sorted(pm.SUBJECT_NAMES))
+    parser.add_argument('--out', default=None, help='thresholds csv (default expt_N_thresholds.csv)')
+    args = parser.parse_args(argv)
+
+    dat = pm.read_table(args.data)
+    dat = dat[dat['subject'].astype(int).isin(args.subjects)]
+    fits = fit_conditions(pm.aggregate(dat), sigmoid=args.sigmoid, grid_shape=tuple(args.grid))
+    table = pm.threshold_table(fits, args.experiment)
+    out = args.out or 'expt_{}_thresholds.csv'.format(args.experiment)
+    table.to_csv(out)
+    print('{} conditions written to {}'.format(len(table), out))
+
+
+if __name__ == '__main__':
+    main()
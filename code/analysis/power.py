@@ -0,0 +1,197 @@
+# coding: utf-8
+
+""" Simulated-observer power analysis for amplitude ladders and repetitions.
+
+For a candidate design (amplitude ladder, trials per level, number of
+subjects) a generating psychometric function (threshold, width, lapse; see
+psychometric.py) is sampled as binomial 4AFC counts for many simulated
+experiments at once, one (n_sims, n_subjects, n_levels) array per design.
+All simulated data sets are refitted together with the batched Fisher
+scoring of bootstrap.refit, warm-started at the generating parameters and
+from a coarse grid. The result for every design is the bias and precision
+of the per-subject thresholds and of the group mean threshold.
+
+Subjects can differ: with subject_sd > 0 every simulated subject's
+threshold is the generating threshold times exp(N(0, subject_sd)).
+
+Designs are split into chunks of simulated experiments with their own
+seeds, which run in a process pool. The results therefore do not depend
+on the number of workers.
+
+Example:
+    python power.py power.csv --ladders "0.5 1 1.5 2 2.5 3 5" "0.25 0.5 1 1.5 2 2.5 3 5" --reps 5 10 20 --subjects 3 5 --threshold 1.5 --width 3 --sims 20000
+"""
+
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import psychometric as pm
+import bootstrap as bs
+
+
+''' --------  Simulation  ---------'''
+
+def generating_params(threshold, width, lapse, sigmoid='norm', n_subjects=1, subject_sd=0., rng=np.random, n_sims=1):
+    """Generating (mu, log width, lapse) of every simulated subject, shape (n_sims, n_subjects, 3)."""
+    params = np.empty((n_sims, n_subjects, 3))
+    params[..., 0] = pm.stimulus_scale(threshold, sigmoid)
+    if subject_sd > 0:
+        # log-normal spread of thresholds across subjects
+        offset = subject_sd * rng.randn(n_sims, n_subjects)
+        params[..., 0] = pm.stimulus_scale(threshold * np.exp(offset), sigmoid)
+    params[..., 1] = np.log(width)
+    params[..., 2] = lapse
+    return params
+
+
+def simulate_fits(ladder, n_per_level, params, sigmoid='norm', gamma=pm.GUESS_RATE, max_lapse=0.1, rng=np.random):
+    """Draw binomial data from generating parameters and refit all of them at once.
+
+    Args:
+        ladder (array): (n_levels,) amplitudes
+        n_per_level (int): trials per level and subject
+        params (array): (..., 3) generating parameters
+        sigmoid (string): see psychometric.SIGMOIDS
+        gamma (float): guess rate
+        max_lapse (float): upper bound of the fitted lapse rate
+        rng: np.random or a np.random.RandomState
+    Returns:
+        fitted (array): (..., 3) maximum likelihood parameters
+        at_bound (array): (...) whether the fitted threshold is at a bound
+    """
+    lead = params.shape[:-1]
+    params = params.reshape(-1, 3)
+    m = len(params)
+    x = np.broadcast_to(np.asarray(ladder, dtype=float), (m, len(ladder)))
+    n = np.full(x.shape, float(n_per_level))
+    k = rng.binomial(int(n_per_level), pm.psi(params, x, sigmoid, gamma)).astype(float)
+    u = pm.stimulus_scale(x, sigmoid)
+    bounds = pm._bounds(u, max_lapse)
+    fitted = bs.refit(params.copy(), u, k, n, sigmoid, bounds, gamma)
+    at_bound = (fitted[:, 0] <= bounds[:, 0, 0] + 1e-9) | (fitted[:, 0] >= bounds[:, 0, 1] - 1e-9)
+    return fitted.reshape(lead + (3,)), at_bound.reshape(lead)
+
+
+def _design_chunk(args):
+    ladder, n_per_level, n_subjects, n_sims, threshold, width, lapse, subject_sd, sigmoid, max_lapse, seed = args
+    rng = np.random.RandomState(seed)
+    params = generating_params(threshold, width, lapse, sigmoid, n_subjects, subject_sd, rng, n_sims)
+    fitted, at_bound = simulate_fits(ladder, n_per_level, params, sigmoid, max_lapse=max_lapse, rng=rng)
+    return (pm.threshold_scale(params[..., 0], sigmoid), pm.threshold_scale(fitted[..., 0], sigmoid), at_bound)
+
+
+def summarise(true, est, at_bound, threshold, ci=0.95):
+    """Bias and precision of simulated thresholds.
+
+    Args:
+        true, est (array): (n_sims, n_subjects) generating and fitted thresholds
+        at_bound (array): (n_sims, n_subjects) fits with the threshold at a bound
+        threshold (float): generating (population) threshold
+        ci (float): mass of the reported quantile interval
+    Returns:
+        (dict): bias, rel_bias, sd, rmse, q_low, q_high of the per-subject
+            thresholds, the same with prefix group_ for the mean over
+            subjects (against the population threshold), and at_bound
+    """
+    a = (1 - ci) / 2
+    err = est - true
+    group = est.mean(axis=1)
+    g_err = group - threshold
+    return {'bias': err.mean(), 'rel_bias': (err / true).mean(), 'sd': est.std(),
+            'rmse': np.sqrt((err**2).mean()),
+            'q_low': np.quantile(est, a), 'q_high': np.quantile(est, 1 - a),
+            'group_bias': g_err.mean(), 'group_sd': group.std(), 'group_rmse': np.sqrt((g_err**2).mean()),
+            'group_q_low': np.quantile(group, a), 'group_q_high': np.quantile(group, 1 - a),
+            'at_bound': at_bound.mean()}
+
+
+def design_grid(ladders, reps, subjects):
+    """All (ladder, reps, n_subjects) combinations as a design table."""
+    rows = [{'ladder': tuple(float(a) for a in l), 'reps': r, 'n_subjects': s}
+            for l, r, s in itertools.product(ladders, reps, subjects)]
+    return pd.DataFrame(rows)
+
+
+def power_analysis(designs, threshold, width, lapse=0.02, sigmoid='norm', n_sims=10000, sessions=1,
+                   subject_sd=0., max_lapse=0.1, ci=0.95, seed=None, n_workers=None, chunk_size=20000):
+    """Threshold bias and precision of every design.
+
+    Args:
+        designs (DataFrame): ladder (tuple of amplitudes), reps (trials per
+            level and session, like stim_gen's reps) and n_subjects
+        threshold, width, lapse (float): generating psychometric function
+            (as in psychometric.fit_conditions output)
+        sigmoid (string): see psychometric.SIGMOIDS
+        n_sims (int): simulated experiments per design
+        sessions (int): sessions per subject; trials per level are reps * sessions
+        subject_sd (float): sd of the subjects' log thresholds
+        max_lapse (float): upper bound of the fitted lapse rate
+        ci (float): mass of the reported quantile intervals
+        seed (int): seed of the per-chunk seeds
+        n_workers (int): processes (cpu count if None, 1 runs in this process)
+        chunk_size (int): simulated subject data sets per task
+    Returns:
+        results (DataFrame): the designs plus the columns of summarise
+    """
+    rng = np.random.RandomState(seed)
+    jobs, owner = [], []
+    for i, d in designs.iterrows():
+        sims_per_chunk = max(1, chunk_size // int(d['n_subjects']))
+        for start in range(0, n_sims, sims_per_chunk):
+            jobs.append((np.asarray(d['ladder']), int(d['reps']) * sessions, int(d['n_subjects']),
+                         min(sims_per_chunk, n_sims - start), threshold, width, lapse, subject_sd,
+                         sigmoid, max_lapse, rng.randint(2**31 - 1)))
+            owner.append(i)
+    if n_workers == 1 or len(jobs) == 1:
+        results = [_design_chunk(j) for j in jobs]
+    else:
+        pool = mp.Pool(n_workers)
+        try:
+            results = pool.map(_design_chunk, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    rows = []
+    owner = np.array(owner)
+    for i, d in designs.iterrows():
+        parts = [results[j] for j in np.flatnonzero(owner == i)]
+        true, est, at_bound = [np.concatenate([p[q] for p in parts]) for q in range(3)]
+        row = d.to_dict()
+        row['n_per_level'] = int(d['reps']) * sessions
+        row.update(summarise(true, est, at_bound, threshold, ci))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Threshold bias and precision of candidate designs.')
+    parser.add_argument('out', help='output csv')
+    parser.add_argument('--ladders', nargs='+', required=True, help='amplitude ladders, e.g. "0.5 1 1.5 2 2.5 3 5"')
+    parser.add_argument('--reps', type=int, nargs='+', default=[10], help='trials per level and session')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[5])
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--threshold', type=float, required=True, help='generating threshold (amplitude units)')
+    parser.add_argument('--width', type=float, required=True, help='generating width')
+    parser.add_argument('--lapse', type=float, default=0.02)
+    parser.add_argument('--subject-sd', type=float, default=0., help='sd of log thresholds across subjects')
+    parser.add_argument('--sigmoid', default='norm', choices=pm.SIGMOIDS)
+    parser.add_argument('--sims', type=int, default=10000, help='simulated experiments per design')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    designs = design_grid([[float(a) for a in l.split()] for l in args.ladders], args.reps, args.subjects)
+    results = power_analysis(designs, args.threshold, args.width, args.lapse, args.sigmoid, args.sims,
+                             args.sessions, args.subject_sd, seed=args.seed, n_workers=args.workers)
+    results['ladder'] = [' '.join('{:g}'.format(a) for a in l) for l in results['ladder']]
+    results.to_csv(args.out, index=False)
+    print('{} designs written to {}'.format(len(results), args.out))
+
+
+if __name__ == '__main__':
+    main()
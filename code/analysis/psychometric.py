@@ -0,0 +1,411 @@
+# coding: utf-8
+
+""" Batch psychometric function fitting.
+
+Python replacement for analysis.m / getpsignifitdata.m: aggregates the
+munged trial table into (condition x amplitude) counts and fits all
+conditions at once.
+
+The psychometric function is
+
+    psi(x) = gamma + (1 - gamma - lapse) * F(x; threshold, width)
+
+with guess rate gamma = 0.25 (4AFC). As in psignifit, the threshold is the
+amplitude where F = 0.5 and the width is the distance between F = 0.05 and
+F = 0.95. Sigmoids are 'norm' (cumulative Gaussian, the psignifit option
+used for the paper), 'logistic' and 'weibull' (threshold and width on log
+amplitude).
+
+The negative log likelihood and its gradient are computed for all
+conditions of a chunk in one array expression; the chunk's parameters are
+optimised jointly with L-BFGS-B, and chunks are fitted in a process pool.
+Confidence intervals are Wald intervals from the expected Fisher
+information.
+
+Example:
+    python psychometric.py ../../results/experiment_1/all_data.parquet --experiment 1 --out expt_1_thresholds.csv
+"""
+
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from scipy import optimize, stats
+
+GUESS_RATE = 0.25
+PIX_PER_DEG = 41.5
+SUBJECT_NAMES = {2: 'TW', 5: 'ST', 7: 'AM', 8: 'RM', 9: 'MF'}
+DISTORTION_NAMES = {'bex': 'BPN', 'rf': 'RF'}
+
+# columns that identify a condition (those present in the table are used):
+CONDITION_COLS = ['experiment', 'subject', 'flanked', 'distortion', 'n_dist_flanks', 'freq']
+
+# F(z) at z = +-1 is 0.95 / 0.05, i.e. z = C * (u - mu) / width
+WIDTH_ALPHA = 0.05
+SIGMOIDS = ('norm', 'logistic', 'weibull')
+
+
+''' --------  Data  ---------'''
+
+def aggregate(dat, condition_cols=None):
+    """Count correct and total trials per condition and amplitude.
+
+    Args:
+        dat (DataFrame): munged trials with an 'amplitude' and a 'correct'
+            column (missed responses, NaN / NA in 'correct', are left out)
+        condition_cols (list): columns identifying a condition (default: those
+            of CONDITION_COLS in dat)
+    Returns:
+        counts (DataFrame): condition columns, amplitude, n_correct, n_total.
+    """
+    if condition_cols is None:
+        condition_cols = [c for c in CONDITION_COLS if c in dat.columns]
+    correct = dat['correct'].astype(float)
+    valid = correct.notna()
+    d = dat.loc[valid, condition_cols + ['amplitude']].copy()
+    d['n_correct'] = correct[valid].values
+    counts = d.groupby(condition_cols + ['amplitude'], observed=True, sort=True)['n_correct'] \
+        .agg(['sum', 'count']).reset_index()
+    counts.rename(columns={'sum': 'n_correct', 'count': 'n_total'}, inplace=True)
+    counts['n_correct'] = counts['n_correct'].astype(np.int64)
+    return counts
+
+
+def to_arrays(counts, condition_cols=None):
+    """Pack counts into (n_conditions, n_levels) arrays.
+
+    Conditions with fewer levels are padded with zero trials, which do not
+    contribute to the likelihood.
+
+    Returns:
+        conditions (DataFrame): one row per condition
+        x, k, n (array): amplitudes, correct and total trials
+    """
+    if condition_cols is None:
+        condition_cols = [c for c in CONDITION_COLS if c in counts.columns]
+    groups = counts.groupby(condition_cols, observed=True, sort=True)
+    n_levels = groups.size().max()
+    x = np.ones((groups.ngroups, n_levels))
+    k = np.zeros((groups.ngroups, n_levels))
+    n = np.zeros((groups.ngroups, n_levels))
+    keys = []
+    for i, (key, g) in enumerate(groups):
+        m = len(g)
+        x[i, :m] = g['amplitude'].values
+        x[i, m:] = g['amplitude'].values[-1]
+        k[i, :m] = g['n_correct'].values
+        n[i, :m] = g['n_total'].values
+        keys.append(key if isinstance(key, tuple) else (key,))
+    conditions = pd.DataFrame(keys, columns=condition_cols)
+    return conditions, x, k, n
+
+
+''' --------  Psychometric functions  ---------'''
+
+def _scale(sigmoid):
+    if sigmoid == 'norm':
+        return stats.norm.ppf(1 - WIDTH_ALPHA) - stats.norm.ppf(WIDTH_ALPHA)
+    if sigmoid == 'logistic':
+        return 2 * np.log(1 / WIDTH_ALPHA - 1)
+    if sigmoid == 'weibull':
+        return np.log(-np.log(WIDTH_ALPHA)) - np.log(-np.log(1 - WIDTH_ALPHA))
+    raise ValueError('unknown sigmoid: {}'.format(sigmoid))
+
+
+def stimulus_scale(x, sigmoid):
+    """The axis the sigmoid is defined on (log amplitude for the Weibull)."""
+    if sigmoid == 'weibull':
+        return np.log(x)
+    return x
+
+
+def sigmoid_f(z, sigmoid):
+    """F and dF/dz for the standardised argument z = C * (u - mu) / width."""
+    if sigmoid == 'norm':
+        return stats.norm.cdf(z), stats.norm.pdf(z)
+    if sigmoid == 'logistic':
+        f = 1 / (1 + np.exp(-z))
+        return f, f * (1 - f)
+    # Weibull as a Gumbel on log amplitude, F = 0.5 at z = 0:
+    e = np.exp(np.clip(z, -50, 50)) * np.log(2)
+    f = -np.expm1(-e)
+    return f, (1 - f) * e
+
+
+def psi(params, x, sigmoid, gamma=GUESS_RATE):
+    """Proportion correct at amplitudes x.
+
+    Args:
+        params (array): (..., 3) of (mu, log width, lapse); mu is the threshold
+            on the stimulus scale (log threshold for the Weibull)
+        x (array): amplitudes, broadcastable against params[..., :1]
+    """
+    return _psi_u(params, stimulus_scale(x, sigmoid), sigmoid, gamma)
+
+
+def _psi_u(params, u, sigmoid, gamma=GUESS_RATE):
+    mu, log_w, lapse = params[..., 0:1], params[..., 1:2], params[..., 2:3]
+    z = _scale(sigmoid) * (u - mu) / np.exp(log_w)
+    f, _ = sigmoid_f(z, sigmoid)
+    return gamma + (1 - gamma - lapse) * f
+
+
+def nll_and_grad(params, u, k, n, sigmoid, gamma=GUESS_RATE):
+    """Negative log likelihood per condition and its gradient.
+
+    Args:
+        params (array): (n_conditions, 3) of (mu, log width, lapse)
+        u (array): (n_conditions, n_levels) stimulus levels (see stimulus_scale)
+        k, n (array): correct and total trials
+    Returns:
+        nll (array): (n_conditions,)
+        grad (array): (n_conditions, 3)
+        dpsi (array): (n_conditions, n_levels, 3) derivatives of psi
+        p (array): psi at every level
+    """
+    mu, log_w, lapse = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    c = _scale(sigmoid)
+    w = np.exp(log_w)
+    z = c * (u - mu) / w
+    f, df = sigmoid_f(z, sigmoid)
+    p = np.clip(gamma + (1 - gamma - lapse) * f, 1e-12, 1 - 1e-12)
+    nll = -(k * np.log(p) + (n - k) * np.log1p(-p)).sum(axis=1)
+
+    dpsi = np.empty(u.shape + (3,))
+    dpsi[..., 0] = (1 - gamma - lapse) * df * (-c / w)
+    dpsi[..., 1] = (1 - gamma - lapse) * df * (-z)
+    dpsi[..., 2] = -f
+    dnll_dp = -(k / p - (n - k) / (1 - p))
+    grad = (dnll_dp[..., None] * dpsi).sum(axis=1)
+    return nll, grad, dpsi, p
+
+
+''' --------  Fitting  ---------'''
+
+def _bounds(u, max_lapse):
+    lo, hi = u.min(axis=1), u.max(axis=1)
+    span = np.maximum(hi - lo, 1e-3)
+    b = np.empty((len(u), 3, 2))
+    b[:, 0, 0], b[:, 0, 1] = lo - span, hi + span
+    b[:, 1, 0], b[:, 1, 1] = np.log(span / 50), np.log(span * 10)
+    b[:, 2, 0], b[:, 2, 1] = 0, max_lapse
+    return b
+
+
+def start_values(u, k, n, sigmoid, bounds, lapse=0.02, n_mu=21, n_w=8):
+    """Best point of a coarse (mu, width) grid for every condition."""
+    frac_mu = np.linspace(0, 1, n_mu)
+    frac_w = np.linspace(0, 1, n_w)
+    lo, hi = u.min(axis=1), u.max(axis=1)
+    mu = lo[:, None] + (hi - lo)[:, None] * frac_mu                      # (c, n_mu)
+    log_w = bounds[:, 1, 0][:, None] + np.log(5) + \
+        (bounds[:, 1, 1] - bounds[:, 1, 0] - np.log(5))[:, None] * frac_w  # (c, n_w)
+    grid = np.empty((len(u), n_mu, n_w, 3))
+    grid[..., 0] = mu[:, :, None]
+    grid[..., 1] = log_w[:, None, :]
+    grid[..., 2] = lapse
+    p = np.clip(_psi_u(grid, u[:, None, None, :], sigmoid), 1e-12, 1 - 1e-12)
+    ll = (k[:, None, None, :] * np.log(p) + (n - k)[:, None, None, :] * np.log1p(-p)).sum(axis=-1)
+    best = ll.reshape(len(u), -1).argmax(axis=1)
+    return grid.reshape(len(u), -1, 3)[np.arange(len(u)), best]
+
+
+def minimize_nll(start, u, k, n, sigmoid, bounds, gamma=GUESS_RATE):
+    """Joint L-BFGS-B minimisation of the summed nll of all conditions.
+
+    Args:
+        start (array): (n_conditions, 3) start values (clipped to the bounds)
+        u, k, n (array): (n_conditions, n_levels) stimulus levels, correct and total trials
+        sigmoid (string): see SIGMOIDS
+        bounds (array): (n_conditions, 3, 2) parameter bounds
+        gamma (float): guess rate
+    Returns:
+        params (array): (n_conditions, 3) fitted parameters
+    """
+    start = np.clip(start, bounds[..., 0], bounds[..., 1])
+    shape = start.shape
+
+    def objective(theta):
+        nll, grad, _, _ = nll_and_grad(theta.reshape(shape), u, k, n, sigmoid, gamma)
+        return nll.sum(), grad.ravel()
+
+    res = optimize.minimize(objective, start.ravel(), jac=True, method='L-BFGS-B',
+                            bounds=bounds.reshape(-1, 2),
+                            options={'maxiter': 2000, 'maxfun': 5000, 'ftol': 1e-12, 'gtol': 1e-8})
+    return res.x.reshape(shape)
+
+
+def fit_arrays(x, k, n, sigmoid='norm', gamma=GUESS_RATE, max_lapse=0.1, start=None):
+    """Maximum likelihood fit of all conditions in one joint optimisation.
+
+    Args:
+        x, k, n (array): (n_conditions, n_levels) amplitudes, correct and total trials
+        sigmoid (string): 'norm', 'logistic' or 'weibull'
+        gamma (float): guess rate
+        max_lapse (float): upper bound of the lapse rate
+        start (array): (n_conditions, 3) start values (grid search if None)
+    Returns:
+        params (array): (n_conditions, 3) of (mu, log width, lapse)
+        nll (array): negative log likelihood per condition
+        cov (array): (n_conditions, 3, 3) inverse expected Fisher information
+    """
+    u = stimulus_scale(x, sigmoid)
+    bounds = _bounds(u, max_lapse)
+    if start is None:
+        start = start_values(u, k, n, sigmoid, bounds)
+    params = minimize_nll(start, u, k, n, sigmoid, bounds, gamma)
+    nll, _, dpsi, p = nll_and_grad(params, u, k, n, sigmoid, gamma)
+    info = np.einsum('cl,cli,clj->cij', n / (p * (1 - p)), dpsi, dpsi)
+    cov = np.linalg.pinv(info)
+    return params, nll, cov
+
+
+def _fit_chunk(args):
+    x, k, n, sigmoid, gamma, max_lapse = args
+    return fit_arrays(x, k, n, sigmoid, gamma, max_lapse)
+
+
+def fit_conditions(counts, sigmoid='norm', gamma=GUESS_RATE, max_lapse=0.1, ci=0.95,
+                   n_workers=None, chunk_size=16, condition_cols=None):
+    """Fit a psychometric function to every condition of a count table.
+
+    Args:
+        counts (DataFrame): as returned by aggregate
+        sigmoid (string): 'norm', 'logistic' or 'weibull'
+        gamma (float): guess rate (0.25 for 4AFC)
+        max_lapse (float): upper bound of the lapse rate
+        ci (float): coverage of the confidence intervals
+        n_workers (int): processes (cpu count if None, 1 fits in this process)
+        chunk_size (int): conditions optimised jointly per task
+        condition_cols (list): see aggregate
+    Returns:
+        fits (DataFrame): condition columns plus threshold, threshold_low,
+            threshold_high, width, lapse, nll and n_trials.
+    """
+    conditions, x, k, n = to_arrays(counts, condition_cols)
+    jobs = [(x[i:i + chunk_size], k[i:i + chunk_size], n[i:i + chunk_size], sigmoid, gamma, max_lapse)
+            for i in range(0, len(x), chunk_size)]
+    if n_workers == 1 or len(jobs) == 1:
+        results = [_fit_chunk(j) for j in jobs]
+    else:
+        pool = mp.Pool(n_workers)
+        try:
+            results = pool.map(_fit_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    params = np.concatenate([r[0] for r in results])
+    nll = np.concatenate([r[1] for r in results])
+    cov = np.concatenate([r[2] for r in results])
+
+    z = stats.norm.ppf(0.5 + ci / 2)
+    mu = params[:, 0]
+    se = np.sqrt(np.maximum(cov[:, 0, 0], 0))
+    fits = conditions.copy()
+    fits['threshold'], fits['threshold_low'], fits['threshold_high'] = \
+        threshold_scale(np.stack([mu, mu - z * se, mu + z * se]), sigmoid)
+    fits['width'] = np.exp(params[:, 1])
+    fits['lapse'] = params[:, 2]
+    fits['nll'] = nll
+    fits['n_trials'] = n.sum(axis=1).astype(np.int64)
+    return fits
+
+
+def threshold_scale(mu, sigmoid):
+    """Thresholds in amplitude units from mu."""
+    if sigmoid == 'weibull':
+        return np.exp(mu)
+    return mu
+
+
+''' --------  Output  ---------'''
+
+def bpn_freq(freq):
+    """BPN filter frequency (cycles per letter patch) in c/deg, as reported in the paper."""
+    return np.floor(np.asarray(freq, dtype=float) * 20 / 3 + 1e-9) / 10
+
+
+def threshold_table(fits, experiment):
+    """Format fits like results/r-analysis-final-paper/expt_*_thresholds.csv.
+
+    BPN thresholds are converted from pixels to degrees and BPN frequencies
+    to c/deg; subjects are labelled by initials and sensitivity is
+    1 / threshold.
+
+    Args:
+        fits (DataFrame): as returned by fit_conditions (or any table with
+            the same threshold columns)
+        experiment (int): 1 or 2
+    Returns:
+        table (DataFrame): in the column order and row order of the paper's files.
+    """
+    t = pd.DataFrame()
+    t['subject'] = [SUBJECT_NAMES.get(int(s), str(s)) for s in fits['subject']]
+    bex = (fits['distortion'].astype(str) == 'bex').values
+    to_deg = np.where(bex, 1 / PIX_PER_DEG, 1.)
+    thr = fits['threshold'].values * to_deg
+    low = fits['threshold_low'].values * to_deg
+    high = fits['threshold_high'].values * to_deg
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sens = 1 / thr
+        sens_low = np.where(high > 0, 1 / high, np.nan)
+        sens_high = np.where(low > 0, 1 / low, np.nan)
+    if experiment == 1:
+        t['flanked'] = fits['flanked'].astype(str).values
+        freq = fits['freq'].values.astype(float)
+        t['freq'] = np.where(bex, bpn_freq(freq), freq)
+    t['sens'] = sens
+    t['sensconfi_low'] = sens - sens_low
+    t['sensconfi_high'] = sens_high - sens
+    t['threshold'] = thr
+    t['threshconfi_low'] = thr - low
+    t['threshconfi_high'] = high - thr
+    t['distortion'] = [DISTORTION_NAMES[d] for d in fits['distortion'].astype(str)]
+    if experiment == 1:
+        t['log_freq'] = np.log(t['freq'])
+        t['_flanked_order'] = (t['flanked'] == 'flanked').astype(int)
+        t.sort_values(['distortion', 'subject', '_flanked_order', 'freq'], kind='mergesort', inplace=True)
+        t.drop(columns='_flanked_order', inplace=True)
+    else:
+        t['n_dist_flanks'] = fits['n_dist_flanks'].values.astype(np.int64)
+        t['experiment'] = [str(e)[-1] for e in fits['experiment']]
+        t.sort_values(['distortion', 'subject', 'experiment', 'n_dist_flanks'], kind='mergesort', inplace=True)
+    cols = ['sens', 'sensconfi_low', 'sensconfi_high', 'threshold', 'threshconfi_low', 'threshconfi_high']
+    t[cols] = t[cols].round(6)
+    t.index = np.arange(1, len(t) + 1)
+    return t
+
+
+def read_table(fname):
+    """Read munged trials from all_data.csv or all_data.parquet."""
+    if fname.endswith('.parquet'):
+        import trial_store
+        return trial_store.read_trials(fname)
+    return pd.read_csv(fname, dtype={'targ_pos': str, 'response': str, 'experiment': str})
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit psychometric functions to all conditions.')
+    parser.add_argument('data', help='munged trials (all_data.csv or all_data.parquet)')
+    parser.add_argument('--experiment', type=int, default=1, choices=(1, 2), help='output format')
+    parser.add_argument('--sigmoid', default='norm', choices=SIGMOIDS)
+    parser.add_argument('--max-lapse', type=float, default=0.1)
+    parser.add_argument('--subjects', type=int, nargs='+', default=sorted(SUBJECT_NAMES))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default=None, help='thresholds csv (default expt_N_thresholds.csv)')
+    args = parser.parse_args(argv)
+
+    dat = read_table(args.data)
+    dat = dat[dat['subject'].astype(int).isin(args.subjects)]
+    counts = aggregate(dat)
+    fits = fit_conditions(counts, sigmoid=args.sigmoid, max_lapse=args.max_lapse, n_workers=args.workers)
+    table = threshold_table(fits, args.experiment)
+    out = args.out or 'expt_{}_thresholds.csv'.format(args.experiment)
+    table.to_csv(out)
+    print('{} conditions written to {}'.format(len(table), out))
+
+
+if __name__ == '__main__':
+    main()
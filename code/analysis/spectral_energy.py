@@ -0,0 +1,242 @@
+# coding: utf-8
+
+""" Batched spatial frequency and orientation energy of image stacks.
+
+Replaces the per-image loop of spectral_content_analysis.ipynb. A stack of
+patches (or displays) is transformed with one batched real FFT, and the
+amplitude spectra are binned into integer radial frequency bands (cycles
+per image) and orientation bands with precomputed bin index maps and a
+single np.bincount per stack.
+
+run_analysis repeats the notebook's analysis: the undistorted letters and
+`reps` distortions of every letter at the mean thresholds of
+expt_1_thresholds.csv (plus the largest amplitudes tested), with the
+distortions of stim_engine. It writes the notebook's sf_energy.csv and
+ori_energy.csv (letter_type, letter, flanked, freq, distortion, rep, x, y).
+
+Example:
+    python spectral_energy.py ../../results/r-analysis-final-paper/expt_1_thresholds.csv ../../results/spectral_analysis --reps 100
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stimuli'))
+
+PIX_PER_DEG = 41.5
+# largest amplitudes tested in experiment 1 (BPN in deg, as in the thresholds file)
+MAX_THRESHOLDS = {'BPN': 5 / PIX_PER_DEG, 'RF': 0.32}
+
+
+''' --------  Spectra  ---------'''
+
+class BinMaps(object):
+    """Radial frequency and orientation bin index maps for rfft2 spectra.
+
+    Args:
+        shape (tuple): image shape (rows, cols)
+        n_ori (int): orientation bands over [0, 180) degrees
+        max_freq (int): highest radial band in cycles per image (min(shape) // 2 if None)
+
+    Attributes:
+        freq (array): centre of each radial band (cycles per image)
+        ang (array): centre of each orientation band (degrees)
+    """
+
+    def __init__(self, shape, n_ori=36, max_freq=None):
+        rows, cols = shape
+        self.shape = tuple(shape)
+        fy = np.fft.fftfreq(rows) * rows
+        fx = np.fft.rfftfreq(cols) * cols
+        fxx, fyy = np.meshgrid(fx, fy)
+        radius = np.hypot(fxx, fyy)
+        if max_freq is None:
+            max_freq = min(shape) // 2
+        self.n_freq = max_freq
+        self.n_ori = n_ori
+
+        r_idx = np.rint(radius).astype(np.int64) - 1   # band 0 is 1 cycle per image
+        ang = np.degrees(np.arctan2(fyy, fxx)) % 180
+        o_idx = np.floor(ang / (180. / n_ori)).astype(np.int64) % n_ori
+        valid = (r_idx >= 0) & (r_idx < max_freq)       # no DC, no corners beyond max_freq
+
+        # columns other than DC and Nyquist stand for two conjugate coefficients
+        weight = np.full(fxx.shape, 2.)
+        weight[:, 0] = 1
+        if cols % 2 == 0:
+            weight[:, -1] = 1
+
+        self.r_idx = np.where(valid, r_idx, max_freq).ravel()   # max_freq: discard bin
+        self.o_idx = np.where(valid, o_idx, n_ori).ravel()
+        self.weight = weight.ravel()
+        self.freq_count = np.bincount(self.r_idx, self.weight, max_freq + 1)[:max_freq]
+        self.ori_count = np.bincount(self.o_idx, self.weight, n_ori + 1)[:n_ori]
+        self.freq = np.arange(1, max_freq + 1, dtype=float)
+        self.ang = (np.arange(n_ori) + 0.5) * 180. / n_ori
+
+    def _bin(self, spectra, idx, n_bins, count, statistic):
+        n = len(spectra)
+        flat = (idx[None, :] + np.arange(n)[:, None] * (n_bins + 1)).ravel()
+        w = (spectra.reshape(n, -1) * self.weight).ravel()
+        out = np.bincount(flat, w, n * (n_bins + 1)).reshape(n, n_bins + 1)[:, :n_bins]
+        if statistic == 'mean':
+            out = out / count
+        return out
+
+    def bin_freq(self, spectra, statistic='mean'):
+        """(n, n_freq) energy per radial band of (n,) + rfft shape spectra."""
+        return self._bin(spectra, self.r_idx, self.n_freq, self.freq_count, statistic)
+
+    def bin_ori(self, spectra, statistic='mean'):
+        """(n, n_ori) energy per orientation band."""
+        return self._bin(spectra, self.o_idx, self.n_ori, self.ori_count, statistic)
+
+
+def amplitude_spectra(ims, subtract_mean=True):
+    """Amplitude spectra of a stack of images with one batched rfft2.
+
+    Args:
+        ims (float): (n, rows, cols) images
+        subtract_mean (bool): remove each image's mean luminance first
+    Returns:
+        (n, rows, cols // 2 + 1) amplitude spectra
+    """
+    ims = np.asarray(ims, dtype=float)
+    if subtract_mean:
+        ims = ims - ims.mean(axis=(1, 2), keepdims=True)
+    return np.abs(np.fft.rfft2(ims))
+
+
+def spectral_energy(ims, n_ori=36, statistic='mean', maps=None):
+    """Radial frequency and orientation energy of a stack of images.
+
+    Args:
+        ims (float): (n, rows, cols) images (or a single image)
+        n_ori (int): number of orientation bands
+        statistic (string): 'mean' or 'sum' of the amplitudes in a band
+        maps (BinMaps): precomputed maps (made for ims' shape if None)
+    Returns:
+        res (dict): 'freq' (n_freq,), 'freq_amp' (n, n_freq), 'ang' (n_ori,), 'ang_amp' (n, n_ori)
+    """
+    ims = np.asarray(ims, dtype=float)
+    if ims.ndim == 2:
+        ims = ims[None]
+    if maps is None:
+        maps = BinMaps(ims.shape[1:], n_ori)
+    spectra = amplitude_spectra(ims)
+    return {'freq': maps.freq, 'freq_amp': maps.bin_freq(spectra, statistic),
+            'ang': maps.ang, 'ang_amp': maps.bin_ori(spectra, statistic)}
+
+
+def to_frames(res, meta):
+    """Tidy sf and orientation tables from spectral_energy output.
+
+    Args:
+        res (dict): as returned by spectral_energy
+        meta (DataFrame): one row per image
+    Returns:
+        sf, ori (DataFrame): meta columns repeated per band, plus x (band) and y (energy)
+    """
+    out = []
+    for x_key, y_key in (('freq', 'freq_amp'), ('ang', 'ang_amp')):
+        n_bands = len(res[x_key])
+        df = meta.loc[meta.index.repeat(n_bands)].reset_index(drop=True)
+        df['x'] = np.tile(res[x_key], len(meta))
+        df['y'] = res[y_key].ravel()
+        out.append(df)
+    return out[0], out[1]
+
+
+''' --------  Notebook analysis  ---------'''
+
+def mean_thresholds(thresholds):
+    """Mean threshold per flanked, freq and distortion, plus the largest amplitudes tested ('max')."""
+    m = thresholds.groupby(['flanked', 'freq', 'distortion']).threshold.mean().reset_index()
+    extra = [{'flanked': 'max', 'freq': f, 'distortion': d, 'threshold': MAX_THRESHOLDS[d]}
+             for d in MAX_THRESHOLDS for f in np.unique(m.loc[m['distortion'] == d, 'freq'])]
+    return pd.concat([m, pd.DataFrame(extra)], ignore_index=True)
+
+
+def distorted_stack(conditions, letters, reps, seed=None):
+    """Undistorted letters and distorted copies for every condition.
+
+    Returns:
+        ims (array): (n, 92, 92) patches
+        meta (DataFrame): letter_type, letter, flanked, freq, distortion, rep per patch
+    """
+    import stim_engine as se
+    np.random.seed(seed)
+    ims, rows = [], []
+    for letter in letters:
+        im = se.letter_template(letter)
+        for c in conditions.itertuples():
+            info = {'letter': letter, 'flanked': c.flanked, 'freq': c.freq, 'distortion': c.distortion}
+            ims.append(im)
+            rows.append(dict(info, letter_type='Undistorted', rep=np.nan))
+            if c.distortion == 'BPN':
+                dist_type, amplitude = 'bex', c.threshold * PIX_PER_DEG  # thresholds --> pixel units
+            elif c.distortion == 'RF':
+                dist_type, amplitude = 'rf', c.threshold
+            else:
+                raise ValueError('distortion not known: {}'.format(c.distortion))
+            for rep in range(reps):
+                x_offset, y_offset = se.distortion_offsets(dist_type, amplitude, c.freq)
+                ims.append(se.distort_patch(im, x_offset, y_offset))
+                rows.append(dict(info, letter_type='Distorted', rep=rep))
+    meta = pd.DataFrame(rows, columns=['letter_type', 'letter', 'flanked', 'freq', 'distortion', 'rep'])
+    return np.stack(ims), meta
+
+
+def run_analysis(thresholds, letters=('K', 'H', 'D', 'N'), reps=15, seed=22239217, n_ori=36,
+                 batch_size=4096):
+    """The spectral analysis of the notebook.
+
+    Args:
+        thresholds (DataFrame): expt_1_thresholds.csv
+        letters (tuple): letters to analyse
+        reps (int): distortions per letter and condition
+        seed (int): random seed
+        n_ori (int): orientation bands
+        batch_size (int): images per FFT batch
+    Returns:
+        sf_energy, ori_energy (DataFrame)
+    """
+    conditions = mean_thresholds(thresholds)
+    ims, meta = distorted_stack(conditions, letters, reps, seed)
+    maps = BinMaps(ims.shape[1:], n_ori)
+    freq_amp, ang_amp = [], []
+    for start in range(0, len(ims), batch_size):
+        res = spectral_energy(ims[start:start + batch_size], maps=maps)
+        freq_amp.append(res['freq_amp'])
+        ang_amp.append(res['ang_amp'])
+    res = {'freq': maps.freq, 'freq_amp': np.concatenate(freq_amp),
+           'ang': maps.ang, 'ang_amp': np.concatenate(ang_amp)}
+    return to_frames(res, meta)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Spatial frequency and orientation energy of distorted letters.')
+    parser.add_argument('thresholds', help='expt_1_thresholds.csv')
+    parser.add_argument('out_dir')
+    parser.add_argument('--reps', type=int, default=15)
+    parser.add_argument('--letters', nargs='+', default=['K', 'H', 'D', 'N'])
+    parser.add_argument('--n-ori', type=int, default=36)
+    parser.add_argument('--seed', type=int, default=22239217)
+    args = parser.parse_args(argv)
+
+    sf_energy, ori_energy = run_analysis(pd.read_csv(args.thresholds), letters=args.letters,
+                                         reps=args.reps, seed=args.seed, n_ori=args.n_ori)
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    sf_energy.to_csv(os.path.join(args.out_dir, 'sf_energy.csv'))
+    ori_energy.to_csv(os.path.join(args.out_dir, 'ori_energy.csv'))
+    print('{} images analysed'.format(len(sf_energy) // len(sf_energy['x'].unique())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+# coding: utf-8
+
+""" Precomputed spectral profiles of every stored stimulus.
+
+spectral_content_analysis.ipynb regenerates distortions and recomputes
+their spectra whenever a question comes up. Here the radial frequency and
+orientation energy profiles (spectral_energy.py) are computed once for
+every trial of a stimulus source, for four images per trial:
+
+    display    the undistorted and the distorted 1024 x 1024 display
+    target     the undistorted and the distorted 92 x 92 target patch
+
+A source is a sparse store (sparse_store.py) or a directory of png pairs
+(undistorted/ and distorted/, with or without a manifest.csv). Trials are
+processed in batches over a process pool. The results are written to
+<source>/spectral_index/ as float32 matrices, with rows aligned with the
+source's manifest:
+
+    display.npy     (n_trials, 2, n_freq_display + n_ori)   undistorted, distorted
+    target.npy      (n_trials, 2, n_freq_target + n_ori)
+    conditions.csv  one row per trial: im_name, flanked, distortion, freq,
+                    amplitude, rep, targ_pos, targ_letter (and the other
+                    manifest columns)
+    bins.json       band centres and the column ranges of both profiles
+
+SpectralIndex memory-maps the matrices, so queries by condition are
+boolean masks over conditions.csv and a gather of rows.
+
+Example:
+    python spectral_index.py ../stimuli/images --workers 8
+    import spectral_index as spi
+    index = spi.SpectralIndex('../stimuli/images')
+    rows, sf = index.profiles('target', 'freq', distortion='bex', freq=6)
+    means = index.mean_profiles(['flanked', 'amplitude'], 'display', 'ori', distortion='rf')
+"""
+
+import os
+import sys
+import re
+import json
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from spectral_energy import BinMaps, amplitude_spectra
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stimuli'))
+
+N_ORI = 36
+INDEX_DIR = 'spectral_index'
+KINDS = ('display', 'target')
+# target position of a file name without a manifest
+NAME_RE = re.compile(r'^(?P<flanked>flanked|unflanked)_(?P<distortion>bex|rf)_freq_(?P<freq>[\d.]+)'
+                     r'_amplitude_(?P<amplitude>[\d.]+)_rep_(?P<rep>\d+)_(?P<targ_pos>[tlbr])_(?P<targ_letter>[A-Z])')
+
+_maps = {}
+
+
+def bin_maps(shape, n_ori=N_ORI):
+    """BinMaps for an image shape (cached per process)."""
+    key = (tuple(shape), n_ori)
+    if key not in _maps:
+        _maps[key] = BinMaps(shape, n_ori)
+    return _maps[key]
+
+
+def profiles(ims, n_ori=N_ORI):
+    """Radial frequency then orientation mean amplitude of a stack, (n, n_freq + n_ori) float32."""
+    maps = bin_maps(ims.shape[1:], n_ori)
+    spectra = amplitude_spectra(ims)
+    return np.concatenate([maps.bin_freq(spectra), maps.bin_ori(spectra)], axis=1).astype(np.float32)
+
+
+''' --------  Sources  ---------'''
+
+def is_store(source):
+    return os.path.exists(os.path.join(source, 'layout.npz'))
+
+
+def source_conditions(source):
+    """One row per trial of a source, in manifest order."""
+    import pair_metrics
+    if is_store(source) or os.path.exists(os.path.join(source, 'manifest.csv')):
+        conditions = pd.read_csv(os.path.join(source, 'manifest.csv'))
+        if 'dist_type' in conditions.columns:
+            conditions = conditions.rename(columns={'dist_type': 'distortion'})
+        if conditions['flanked'].dtype == bool or conditions['flanked'].astype(str).isin(['True', 'False']).all():
+            conditions['flanked'] = np.where(conditions['flanked'].astype(str) == 'True', 'flanked', 'unflanked')
+        return conditions
+    rows = []
+    for im_name, und_name in pair_metrics.image_dir_names(source):
+        m = NAME_RE.match(im_name)
+        if m is None:
+            raise ValueError('cannot parse stimulus name: {}'.format(im_name))
+        row = dict(m.groupdict(), im_name=im_name, undistorted_name=und_name)
+        rows.append(row)
+    conditions = pd.DataFrame(rows)
+    for c in ('freq', 'amplitude'):
+        conditions[c] = conditions[c].astype(float)
+    conditions['rep'] = conditions['rep'].astype(int)
+    return conditions
+
+
+def _load_pairs(source, indices, names):
+    from skimage import io
+    if is_store(source):
+        from sparse_store import SparseStore
+        store = SparseStore(source)
+        pairs = np.empty((len(indices), 2) + store.canvas_shape)
+        store.reconstruct_batch(indices, distorted=False, out=pairs[:, 0])
+        store.reconstruct_batch(indices, distorted=True, out=pairs[:, 1])
+        return pairs
+    pairs = None
+    for j, (im_name, und_name) in enumerate(names):
+        for k, fname in enumerate((os.path.join(source, 'undistorted', und_name),
+                                   os.path.join(source, 'distorted', im_name))):
+            im = io.imread(fname)
+            if pairs is None:
+                pairs = np.empty((len(names), 2) + im.shape[:2])
+            pairs[j, k] = im / 255.
+    return pairs
+
+
+def _index_batch(args):
+    import pair_metrics
+    import stim_engine as se
+    source, indices, names, targ_pos, n_ori = args
+    pairs = _load_pairs(source, indices, names)
+    n = len(pairs)
+    display = profiles(pairs.reshape((-1,) + pairs.shape[2:]), n_ori).reshape(n, 2, -1)
+    patches = pair_metrics.regions(pairs, 'targ')          # (n, 2, 4, size, size)
+    pos = np.array([se.POSITION_LABELS.index(p) for p in targ_pos])
+    target = patches[np.arange(n), :, pos]                  # (n, 2, size, size)
+    target = profiles(target.reshape((-1,) + target.shape[2:]), n_ori).reshape(n, 2, -1)
+    return indices, display, target
+
+
+def build_index(source, batch_size=8, n_workers=None, n_ori=N_ORI):
+    """Compute and write the spectral index of a source.
+
+    Args:
+        source (string): sparse store or png pair directory
+        batch_size (int): trials per task
+        n_workers (int): processes (cpu count if None, 1 runs in this process)
+        n_ori (int): orientation bands
+    Returns:
+        SpectralIndex
+    """
+    conditions = source_conditions(source)
+    names = list(zip(conditions['im_name'], conditions['undistorted_name']))
+    jobs = [(source, list(range(s, min(s + batch_size, len(conditions)))), names[s:s + batch_size],
+             list(conditions['targ_pos'][s:s + batch_size]), n_ori)
+            for s in range(0, len(conditions), batch_size)]
+    out_dir = os.path.join(source, INDEX_DIR)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    out = {}
+    if n_workers == 1:
+        results = (_index_batch(j) for j in jobs)
+        pool = None
+    else:
+        pool = mp.Pool(n_workers)
+        results = pool.imap_unordered(_index_batch, jobs)
+    try:
+        for indices, display, target in results:
+            for kind, values in (('display', display), ('target', target)):
+                if kind not in out:
+                    out[kind] = np.lib.format.open_memmap(os.path.join(out_dir, kind + '.npy.tmp'), mode='w+',
+                                                          dtype=np.float32, shape=(len(conditions),) + values.shape[1:])
+                out[kind][indices] = values
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    bins = {'n_ori': n_ori, 'ang': list((np.arange(n_ori) + 0.5) * 180. / n_ori)}
+    for kind in KINDS:
+        out[kind].flush()
+        n_freq = out[kind].shape[-1] - n_ori
+        bins[kind] = {'freq': list(np.arange(1, n_freq + 1, dtype=float)),
+                      'freq_cols': [0, n_freq], 'ori_cols': [n_freq, n_freq + n_ori]}
+        del out[kind]
+        os.replace(os.path.join(out_dir, kind + '.npy.tmp'), os.path.join(out_dir, kind + '.npy'))
+    conditions.to_csv(os.path.join(out_dir, 'conditions.csv'), index=False)
+    with open(os.path.join(out_dir, 'bins.json'), 'w') as f:
+        json.dump(bins, f)
+    return SpectralIndex(source)
+
+
+''' --------  Queries  ---------'''
+
+class SpectralIndex(object):
+    """Read access to a spectral index.
+
+    Args:
+        source (string): the indexed source (or its spectral_index directory)
+    """
+
+    def __init__(self, source):
+        index_dir = source if os.path.basename(os.path.normpath(source)) == INDEX_DIR else \
+            os.path.join(source, INDEX_DIR)
+        self.index_dir = index_dir
+        self.conditions = pd.read_csv(os.path.join(index_dir, 'conditions.csv'))
+        with open(os.path.join(index_dir, 'bins.json')) as f:
+            self.bins = json.load(f)
+        self.matrices = dict((k, np.load(os.path.join(index_dir, k + '.npy'), mmap_mode='r')) for k in KINDS)
+        self.ang = np.array(self.bins['ang'])
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def freq(self, kind):
+        """Radial band centres (cycles per image) of a kind's profiles."""
+        return np.array(self.bins[kind]['freq'])
+
+    def select(self, **conditions):
+        """Row positions of the trials matching all conditions (a value or a list of values each)."""
+        mask = np.ones(len(self.conditions), dtype=bool)
+        for col, value in conditions.items():
+            values = self.conditions[col]
+            wanted = value if isinstance(value, (list, tuple, np.ndarray)) else [value]
+            if values.dtype.kind in 'biuf':
+                mask &= np.isclose(values.values[:, None], np.asarray(wanted, dtype=float)[None]).any(axis=1)
+            else:
+                mask &= values.astype(str).isin([str(w) for w in wanted]).values
+        return np.flatnonzero(mask)
+
+    def profiles(self, kind='target', spectrum='freq', distorted=True, **conditions):
+        """Profiles of the matching trials.
+
+        Args:
+            kind (string): 'display' or 'target'
+            spectrum (string): 'freq' (radial bands) or 'ori' (orientation bands)
+            distorted (bool): the distorted (True), undistorted (False) or both (None) images
+            conditions: see select
+        Returns:
+            rows (DataFrame): conditions of the matching trials
+            profiles (array): (n, n_bands) float32, or (n, 2, n_bands) if distorted is None
+        """
+        idx = self.select(**conditions)
+        lo, hi = self.bins[kind][spectrum + '_cols']
+        m = self.matrices[kind]
+        values = np.asarray(m[idx, :, lo:hi]) if distorted is None else np.asarray(m[idx, int(distorted), lo:hi])
+        return self.conditions.iloc[idx].reset_index(drop=True), values
+
+    def mean_profiles(self, by, kind='target', spectrum='freq', distorted=True, **conditions):
+        """Mean profile per group of the matching trials.
+
+        Returns:
+            groups (DataFrame): the by columns and n per group
+            means (array): (n_groups, n_bands), or (n_groups, 2, n_bands) if distorted is None
+        """
+        rows, values = self.profiles(kind, spectrum, distorted, **conditions)
+        codes, groups = pd.MultiIndex.from_frame(rows[list(by)]).factorize(sort=True)
+        n = np.bincount(codes, minlength=len(groups))
+        flat = values.reshape(len(values), -1).astype(np.float64)
+        sums = np.zeros((len(groups), flat.shape[1]))
+        np.add.at(sums, codes, flat)
+        means = (sums / n[:, None]).reshape((len(groups),) + values.shape[1:])
+        out = pd.DataFrame(list(groups), columns=list(by))
+        out['n'] = n
+        return out, means
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Spectral profiles of every stimulus of a source.')
+    parser.add_argument('source', help='sparse store or directory with undistorted/ and distorted/ pngs')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--n-ori', type=int, default=N_ORI)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    index = build_index(args.source, args.batch_size, args.workers, args.n_ori)
+    print('{} trials indexed in {}'.format(len(index), index.index_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+# coding: utf-8
+
+""" Join trials to properties of the stimulus images they showed.
+
+Every trial row names its distorted display (im_name). Which stimulus
+directory holds it depends on the experiment (and, for experiment 3a, on
+the number of distorted flankers), so a stimulus is identified by the key
+'<directory>/<im_name>'. StimulusIndex hashes the keys of a trial table
+once (pd.factorize), which gives every trial the code of its stimulus and
+every stimulus the rows of its trials.
+
+Image features come in groups:
+
+    pair          difference metrics of the distorted display and its
+                  undistorted twin: RMS, SSIM and octave band energy of the
+                  target and flanker regions (see stimuli/pair_metrics.py)
+    clutter       feature congestion of the distorted display (see
+                  clutter.py; subband entropy is not computed there)
+    displacement  displacement field statistics of target and flankers,
+                  from the manifest.csv of a directory written by
+                  stim_pool.py (NaN for the original experiment images,
+                  whose fields were not kept)
+
+Features are computed the first time a stimulus is requested, in batches
+over a process pool, and cached on disk in one Parquet file per group and
+directory (<cache_dir>/<group>_v<version>/<directory>.parquet). Later
+requests only compute what is missing. join adds the requested groups to
+a trial table with one gather per column, and regress fits a trial-level
+logistic regression on them.
+
+Example:
+    import stim_features as sf
+    dat = sf.join(pm.read_table('all_data.parquet'), groups=['pair', 'clutter'])
+    sf.regress(dat, ['targ_rms', 'FC'], by=['distortion'])
+"""
+
+import os
+import sys
+import csv
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from skimage import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stimuli'))
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+STIM_DIR = os.path.join(this_dir, os.pardir, 'stimuli')
+CACHE_DIR = os.path.join(this_dir, os.pardir, os.pardir, 'results', 'stim_features')
+
+# stimulus directory by (experiment, n_dist_flanks); experiment 1 tables have neither column
+STIMULUS_DIRS = {('1', 0): 'images',
+                 ('a', 0): 'exp3img0flankersdistorted',
+                 ('a', 2): 'exp3img2flankersdistorted',
+                 ('a', 4): 'exp3img4flankersdistorted',
+                 ('b', 4): 'exp3bimg4flankersdistorted',
+                 ('c', 4): 'exp3cimg4flankerdistorted'}
+
+# bump a group's version when its features change, so stale caches are not read
+GROUP_VERSIONS = {'pair': 1, 'clutter': 2, 'displacement': 1}
+
+
+def group_columns(group):
+    """Feature columns of a group."""
+    if group == 'pair':
+        import pair_metrics
+        return pair_metrics.metric_names()
+    if group == 'clutter':
+        return ['FC']
+    if group == 'displacement':
+        import stim_engine as se
+        return list(se.DISPLACEMENT_STATS)
+    raise ValueError('feature group not known: {}'.format(group))
+
+
+''' --------  Index  ---------'''
+
+def stimulus_keys(trials):
+    """'<directory>/<im_name>' of every trial."""
+    n = len(trials)
+    expt = trials['experiment'].astype(str).values if 'experiment' in trials.columns else np.full(n, '1')
+    n_dist = trials['n_dist_flanks'].values.astype(int) if 'n_dist_flanks' in trials.columns else np.zeros(n, int)
+    codes, combos = pd.factorize(pd.MultiIndex.from_arrays([expt, n_dist]))
+    dirs = []
+    for e, d in combos:
+        if (e, d) not in STIMULUS_DIRS:
+            raise ValueError('no stimulus directory for experiment {} with {} distorted flankers'.format(e, d))
+        dirs.append(STIMULUS_DIRS[(e, d)] + '/')
+    prefix = np.array(dirs, dtype=object)[codes]
+    return prefix + trials['im_name'].astype(str).values.astype(object)
+
+
+class StimulusIndex(object):
+    """Hash index of a trial table on its stimuli.
+
+    Args:
+        trials (DataFrame): munged trials (im_name, plus experiment and
+            n_dist_flanks for experiment 2)
+    """
+
+    def __init__(self, trials):
+        self.codes, keys = pd.factorize(stimulus_keys(trials))
+        self.keys = np.asarray(keys, dtype=object)
+        self._lookup = dict((k, i) for i, k in enumerate(self.keys))
+        # trial rows grouped by stimulus (CSR layout)
+        self._order = np.argsort(self.codes, kind='stable')
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(self.codes, minlength=len(self.keys)))])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._lookup
+
+    def rows(self, key):
+        """Positions of the trials that showed a stimulus."""
+        i = self._lookup[key]
+        return self._order[self._offsets[i]:self._offsets[i + 1]]
+
+    def counts(self):
+        """Number of trials per stimulus, in the order of keys."""
+        return np.diff(self._offsets)
+
+
+''' --------  Feature computation  ---------'''
+
+def _pair_batch(args):
+    import pair_metrics
+    directory, names = args
+    pairs = None
+    for j, im_name in enumerate(names):
+        for k, fname in enumerate((os.path.join(directory, 'undistorted', pair_metrics.undistorted_name(im_name)),
+                                   os.path.join(directory, 'distorted', im_name))):
+            im = io.imread(fname)
+            if pairs is None:
+                pairs = np.empty((len(names), 2) + im.shape[:2])
+            pairs[j, k] = im / 255.
+    m = pair_metrics.pair_metrics(pairs)
+    return np.stack([m[c] for c in pair_metrics.metric_names()], axis=1)
+
+
+def _clutter_batch(args):
+    import clutter
+    directory, names = args
+    fc = clutter.clutter_batch([os.path.join(directory, 'distorted', n) for n in names])
+    return fc[:, None]
+
+
+def _displacement(directory, names):
+    cols = group_columns('displacement')
+    out = np.full((len(names), len(cols)), np.nan)
+    manifest = os.path.join(directory, 'manifest.csv')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            rows = dict((r['im_name'], r) for r in csv.DictReader(f))
+        for i, n in enumerate(names):
+            r = rows.get(n)
+            if r is not None:
+                out[i] = [float(r[c]) if r.get(c) not in (None, '') else np.nan for c in cols]
+    return out
+
+
+def compute_features(group, directory, names, batch_size=8, n_workers=None):
+    """Features of some images of one stimulus directory.
+
+    Args:
+        group (string): see GROUP_VERSIONS
+        directory (string): stimulus directory (with distorted/ and undistorted/)
+        names (list): im_name of the distorted displays
+        batch_size (int): images per task
+        n_workers (int): processes (cpu count if None, 1 runs in this process)
+    Returns:
+        (len(names), n_columns) array
+    """
+    names = list(names)
+    if group == 'displacement':
+        return _displacement(directory, names)
+    func = {'pair': _pair_batch, 'clutter': _clutter_batch}[group]
+    jobs = [(directory, names[i:i + batch_size]) for i in range(0, len(names), batch_size)]
+    if not jobs:
+        return np.zeros((0, len(group_columns(group))))
+    if n_workers == 1 or len(jobs) == 1:
+        results = [func(j) for j in jobs]
+    else:
+        pool = mp.Pool(n_workers)
+        try:
+            results = pool.map(func, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return np.concatenate(results)
+
+
+class FeatureCache(object):
+    """Lazily computed image features, cached on disk.
+
+    Args:
+        cache_dir (string): cache directory (created when needed)
+        stim_dir (string): directory holding the stimulus directories
+        n_workers (int): processes computing missing features
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, stim_dir=STIM_DIR, n_workers=None):
+        self.cache_dir = cache_dir
+        self.stim_dir = stim_dir
+        self.n_workers = n_workers
+        self._tables = {}
+
+    def _fname(self, group, directory):
+        return os.path.join(self.cache_dir, '{}_v{}'.format(group, GROUP_VERSIONS[group]), directory + '.parquet')
+
+    def table(self, group, directory):
+        """Cached features of a directory (im_name index), empty if nothing is cached."""
+        key = (group, directory)
+        if key not in self._tables:
+            fname = self._fname(group, directory)
+            if os.path.exists(fname):
+                self._tables[key] = pd.read_parquet(fname).set_index('im_name')
+            else:
+                self._tables[key] = pd.DataFrame(columns=group_columns(group),
+                                                 index=pd.Index([], name='im_name'), dtype=float)
+        return self._tables[key]
+
+    def features(self, keys, group):
+        """Features of stimuli, computing and caching those not cached yet.
+
+        Args:
+            keys (array): '<directory>/<im_name>' stimulus keys
+            group (string): feature group
+        Returns:
+            (len(keys), n_columns) float array, in the order of keys
+        """
+        keys = np.asarray(keys, dtype=object)
+        cols = group_columns(group)
+        out = np.full((len(keys), len(cols)), np.nan)
+        split = pd.Series(keys).str.split('/', n=1, expand=True)
+        for directory, idx in split.groupby(0).groups.items():
+            idx = np.asarray(idx)
+            names = split.loc[idx, 1].values
+            table = self.table(group, directory)
+            missing = pd.unique(names[~pd.Index(names).isin(table.index)])
+            if len(missing):
+                values = compute_features(group, os.path.join(self.stim_dir, directory), missing,
+                                          n_workers=self.n_workers)
+                new = pd.DataFrame(values, columns=cols, index=pd.Index(missing, name='im_name'))
+                table = new if len(table) == 0 else pd.concat([table, new])
+                self._tables[(group, directory)] = table
+                fname = self._fname(group, directory)
+                if not os.path.exists(os.path.dirname(fname)):
+                    os.makedirs(os.path.dirname(fname))
+                table.reset_index().to_parquet(fname + '.tmp', index=False)
+                os.replace(fname + '.tmp', fname)
+            out[idx] = table[cols].values[table.index.get_indexer(names)]
+        return out
+
+
+''' --------  Join and regression  ---------'''
+
+def join(trials, groups=('pair', 'clutter', 'displacement'), cache=None):
+    """Add image features to a trial table.
+
+    Features are looked up once per distinct stimulus and gathered to the
+    trials by their index codes.
+
+    Args:
+        trials (DataFrame): munged trials
+        groups (list): feature groups (see GROUP_VERSIONS)
+        cache (FeatureCache): default: FeatureCache()
+    Returns:
+        trials (DataFrame): a copy with the feature columns added
+    """
+    if cache is None:
+        cache = FeatureCache()
+    index = StimulusIndex(trials)
+    out = trials.copy()
+    for group in groups:
+        values = cache.features(index.keys, group)[index.codes]
+        for j, c in enumerate(group_columns(group)):
+            out[c] = values[:, j]
+    return out
+
+
+def logistic_fit(X, y, n_iter=50, tol=1e-10):
+    """Logistic regression by iteratively reweighted least squares.
+
+    Returns:
+        beta (array), se (array): coefficients and their standard errors
+    """
+    beta = np.zeros(X.shape[1])
+    for i in range(n_iter):
+        p = 1 / (1 + np.exp(-X.dot(beta)))
+        w = np.maximum(p * (1 - p), 1e-12)
+        info = (X * w[:, None]).T.dot(X)
+        step = np.linalg.solve(info, X.T.dot(y - p))
+        beta += step
+        if np.abs(step).max() < tol:
+            break
+    p = 1 / (1 + np.exp(-X.dot(beta)))
+    info = (X * (p * (1 - p))[:, None]).T.dot(X)
+    return beta, np.sqrt(np.diag(np.linalg.inv(info)))
+
+
+def regress(joined, predictors, by=None, standardise=True):
+    """Trial-level logistic regression of 'correct' on image features.
+
+    Args:
+        joined (DataFrame): trials with features (see join)
+        predictors (list): feature (or trial) columns
+        by (list): fit separately per group of these columns
+        standardise (bool): z-score the predictors within each fit
+    Returns:
+        coefs (DataFrame): one row per fit and term (intercept first) with
+            estimate, se, z and n_trials
+    """
+    correct = joined['correct'].astype(float)
+    dat = joined[correct.notna().values & joined[predictors].notna().all(axis=1).values]
+    groups = [((), dat)] if not by else dat.groupby(by, observed=True, sort=True)
+    rows = []
+    for key, g in groups:
+        key = key if isinstance(key, tuple) else (key,)
+        X = g[predictors].values.astype(float)
+        if standardise:
+            X = (X - X.mean(axis=0)) / np.where(X.std(axis=0) > 0, X.std(axis=0), 1)
+        X = np.column_stack([np.ones(len(X)), X])
+        beta, se_ = logistic_fit(X, g['correct'].astype(float).values)
+        for term, b, s in zip(['intercept'] + list(predictors), beta, se_):
+            row = dict(zip(by or [], key))
+            row.update({'term': term, 'estimate': b, 'se': s, 'z': b / s, 'n_trials': len(g)})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    import psychometric as pm
+    parser = argparse.ArgumentParser(description='Join image features to trials.')
+    parser.add_argument('data', help='munged trials (all_data.csv or all_data.parquet)')
+    parser.add_argument('out', help='output .parquet file')
+    parser.add_argument('--groups', nargs='+', default=['pair', 'clutter', 'displacement'],
+                        choices=sorted(GROUP_VERSIONS))
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    dat = pm.read_table(args.data)
+    joined = join(dat, args.groups, FeatureCache(args.cache_dir, n_workers=args.workers))
+    joined.to_parquet(args.out, index=False)
+    print('{} trials of {} stimuli written to {}'.format(len(joined), len(StimulusIndex(dat)), args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# coding: utf-8
+
+""" Out-of-core ingestion of raw session files with flat memory.
+
+The munging scripts read every session file into one DataFrame and sort
+it, so their memory grows with the number of files. Here the session files
+are streamed through a fixed-size pipeline instead. Every file is read in
+chunks of at most `chunk_rows` rows; at most `window` files are read ahead
+(in a thread pool), each at most one chunk ahead of the writer. Each chunk
+is:
+
+    - annotated like ingest.load_trials (experiment, n_dist_flanks,
+      session_file, correct),
+    - added to per-condition sufficient statistics (ConditionStats: trials,
+      responded, correct, number, sum and sum of squares of the RTs, per
+      experiment x subject x flanked x distortion x n_dist_flanks x freq x
+      amplitude), and
+    - appended to a Parquet file per session in a Hive-partitioned
+      dataset, <out_dir>/trials/experiment=<e>/subject=<s>/<session>.parquet.
+
+Memory therefore depends on the chunk size and the number of conditions,
+not on the number of files. Experiments keep their raw labels ('1', '3a',
+'3b', '3c').
+
+Updates are incremental, like ingest.update_table. A state file records
+the hash of every ingested session file. A new file is streamed and its
+statistics added. A modified or deleted file has the statistics of its
+old partition file subtracted, and that file is removed, before a
+modified file is streamed again. Nothing else is read.
+
+Example:
+    python stream_ingest.py ../../raw-data ../../results/stream --experiments 1
+    import stream_ingest as si
+    counts = si.read_stats('../../results/stream').counts()     # for psychometric.fit_conditions
+    dat = si.read_partitioned('../../results/stream', filters=[('subject', '==', '2')])
+"""
+
+import os
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import ingest
+import trial_store
+
+STAT_KEYS = ['experiment', 'subject', 'flanked', 'distortion', 'n_dist_flanks', 'freq', 'amplitude']
+# same statistics as condition_cube.py
+STATS = ['count', 'n_responded', 'correct', 'n_rt', 'rt_sum', 'rt_sumsq']
+PARTITIONS = ['experiment', 'subject']
+
+# one schema for every partition file, so the dataset reads as one table
+FILE_SCHEMA = pa.schema(
+    [(c, pa.dictionary(pa.int32(), pa.string())) for c in trial_store.CATEGORICAL if c not in PARTITIONS] +
+    [(c, pa.float64()) for c in trial_store.FLOAT] +
+    [(c, pa.int64()) for c in trial_store.INT] +
+    [('im_name', pa.string()), ('correct', pa.bool_())])
+PARTITION_SCHEMA = pa.schema([(c, pa.string()) for c in PARTITIONS])
+
+
+class ConditionStats(object):
+    """Sufficient statistics per condition, updated chunk by chunk.
+
+    Conditions are added as they appear; memory grows with the number of
+    conditions only.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._keys = []
+        self._values = np.zeros((1024, len(STATS)))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, dat, sign=1):
+        """Add (sign=1) or subtract (sign=-1) the trials of a chunk."""
+        if len(dat) == 0:
+            return
+        correct = dat['correct'].astype(float)
+        rt = dat['RT'].astype(float)
+        finite = np.isfinite(rt.values)
+        part = pd.DataFrame({'count': 1., 'n_responded': correct.notna().values.astype(float),
+                             'correct': correct.fillna(0).values,
+                             'n_rt': finite.astype(float), 'rt_sum': np.where(finite, rt.values, 0),
+                             'rt_sumsq': np.where(finite, rt.values, 0)**2})
+        for c in STAT_KEYS:
+            part[c] = dat[c].astype(str).values if c in ('experiment', 'subject') else dat[c].values
+        g = part.groupby(STAT_KEYS, sort=False, observed=True)[STATS].sum()
+        rows = np.empty(len(g), dtype=int)
+        for i, key in enumerate(g.index):
+            j = self._index.get(key)
+            if j is None:
+                j = self._index[key] = len(self._keys)
+                self._keys.append(key)
+                if j >= len(self._values):
+                    self._values = np.concatenate([self._values, np.zeros_like(self._values)])
+            rows[i] = j
+        self._values[rows] += sign * g.values
+
+    def to_frame(self):
+        """One row per condition with the statistics (conditions without trials are left out)."""
+        values = self._values[:len(self._keys)]
+        out = pd.DataFrame(self._keys, columns=STAT_KEYS)
+        for j, s in enumerate(STATS):
+            out[s] = values[:, j] if s.startswith('rt_s') else np.rint(values[:, j]).astype(np.int64)
+        out = out[out['count'] > 0]
+        return out.sort_values(STAT_KEYS, kind='mergesort').reset_index(drop=True)
+
+    @classmethod
+    def from_frame(cls, frame):
+        stats = cls()
+        stats._keys = list(frame[STAT_KEYS].itertuples(index=False, name=None))
+        stats._index = dict((k, i) for i, k in enumerate(stats._keys))
+        stats._values = np.zeros((max(1024, 2 * len(frame)), len(STATS)))
+        stats._values[:len(frame)] = frame[STATS].values
+        return stats
+
+    def counts(self):
+        """Correct and total trials per condition and amplitude, like psychometric.aggregate."""
+        f = self.to_frame()
+        f = f[f['n_responded'] > 0].rename(columns={'correct': 'n_correct', 'n_responded': 'n_total'})
+        return f[STAT_KEYS + ['n_correct', 'n_total']].reset_index(drop=True)
+
+    def moments(self):
+        """Accuracy and RT mean and sd per condition."""
+        f = self.to_frame()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f['accuracy'] = f['correct'] / f['n_responded']
+            f['rt_mean'] = f['rt_sum'] / f['n_rt']
+            f['rt_sd'] = np.sqrt(np.maximum(f['rt_sumsq'] - f['rt_sum']**2 / f['n_rt'], 0) / (f['n_rt'] - 1))
+        return f
+
+
+''' --------  Streaming  ---------'''
+
+def partition_path(out_dir, session_file):
+    """Partition file of a session file."""
+    info = ingest.parse_fname(session_file)
+    return os.path.join(out_dir, 'trials', 'experiment={}'.format(info['experiment']),
+                        'subject={}'.format(info['subject']), os.path.splitext(session_file)[0] + '.parquet')
+
+
+def _chunks(path, info, chunk_rows):
+    name = os.path.basename(path)
+    reader = pd.read_csv(path, sep='\t', skipinitialspace=True, dtype=ingest.DTYPES, chunksize=chunk_rows)
+    for chunk in reader:
+        chunk['experiment'] = info['experiment']
+        chunk['n_dist_flanks'] = info['n_dist_flanks']
+        chunk['session_file'] = name
+        yield ingest.add_correct(chunk)
+
+
+def _to_table(chunk):
+    t = trial_store.typed(chunk)
+    cols = [f.name for f in FILE_SCHEMA]
+    return pa.Table.from_pandas(t[cols], preserve_index=False).cast(FILE_SCHEMA)
+
+
+def stream_sessions(sessions, out_dir, stats, chunk_rows=50000, window=4):
+    """Stream session files into partition files and statistics.
+
+    Args:
+        sessions (DataFrame): as returned by ingest.find_sessions
+        out_dir (string): dataset directory
+        stats (ConditionStats): updated in place
+        chunk_rows (int): rows per chunk
+        window (int): files read ahead, each at most one chunk ahead of the
+            writer, so at most window + 1 chunks are in memory
+    Returns:
+        n_rows (int)
+    """
+    jobs = iter([(r.path, r._asdict(), chunk_rows) for r in sessions.itertuples(index=False)])
+    n_rows = 0
+    # (job, chunk iterator, future of its next chunk) of the files being read,
+    # each at most one chunk ahead of the writer
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=window) as ex:
+        while True:
+            while len(pending) < window:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                chunks = _chunks(*job)
+                pending.append((job, chunks, ex.submit(next, chunks, None)))
+            if not pending:
+                break
+            job, chunks, ahead = pending.popleft()
+            fname = partition_path(out_dir, os.path.basename(job[0]))
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            writer = pq.ParquetWriter(fname + '.tmp', FILE_SCHEMA, compression='zstd')
+            try:
+                chunk = ahead.result()
+                while chunk is not None:
+                    ahead = ex.submit(next, chunks, None)
+                    stats.update(chunk)
+                    writer.write_table(_to_table(chunk))
+                    n_rows += len(chunk)
+                    chunk = ahead.result()
+            finally:
+                writer.close()
+            os.replace(fname + '.tmp', fname)
+    return n_rows
+
+
+def remove_session(out_dir, session_file, stats, chunk_rows=50000):
+    """Subtract the statistics of a session's partition file and delete it."""
+    fname = partition_path(out_dir, session_file)
+    if not os.path.exists(fname):
+        return
+    info = ingest.parse_fname(session_file)
+    f = pq.ParquetFile(fname)
+    for batch in f.iter_batches(batch_size=chunk_rows):
+        chunk = batch.to_pandas()
+        chunk['experiment'] = info['experiment']
+        chunk['subject'] = info['subject']
+        stats.update(chunk, sign=-1)
+    os.remove(fname)
+
+
+def read_stats(out_dir):
+    """The ConditionStats of a dataset."""
+    fname = os.path.join(out_dir, 'stats.parquet')
+    if not os.path.exists(fname):
+        return ConditionStats()
+    return ConditionStats.from_frame(pd.read_parquet(fname))
+
+
+def update_dataset(raw_dir, out_dir, experiments=None, subjects=None, full=False, chunk_rows=50000, window=4):
+    """Bring a partitioned dataset and its statistics up to date with the raw data.
+
+    Args:
+        raw_dir (string): the raw-data directory
+        out_dir (string): dataset directory (trials/, stats.parquet, state.json)
+        experiments, subjects (list): which sessions to ingest (see ingest.find_sessions)
+        full (bool): ignore the state and rebuild from all files
+        chunk_rows (int): rows per chunk
+        window (int): files read ahead
+    Returns:
+        summary (dict): lists of 'new', 'modified' and 'deleted' file names and 'n_rows' streamed
+    """
+    state_fname = os.path.join(out_dir, 'state.json')
+    stats_fname = os.path.join(out_dir, 'stats.parquet')
+    if full and os.path.exists(os.path.join(out_dir, 'trials')):
+        import shutil
+        shutil.rmtree(os.path.join(out_dir, 'trials'))
+    state = {} if full or not os.path.exists(stats_fname) else ingest.load_state(state_fname)
+    stats = ConditionStats() if full else read_stats(out_dir)
+    sessions = ingest.find_sessions(raw_dir, experiments, subjects)
+    new, modified, deleted, current = ingest.changed_sessions(sessions, state)
+    summary = {'new': new, 'modified': modified, 'deleted': deleted, 'n_rows': 0}
+    if not (new or modified or deleted) and os.path.exists(stats_fname):
+        return summary
+
+    for name in modified + deleted:
+        remove_session(out_dir, name, stats, chunk_rows)
+    names = sessions['path'].map(os.path.basename)
+    todo = sessions[names.isin(set(new + modified))].reset_index(drop=True)
+    summary['n_rows'] = stream_sessions(todo, out_dir, stats, chunk_rows, window)
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    stats.to_frame().to_parquet(stats_fname + '.tmp', index=False)
+    os.replace(stats_fname + '.tmp', stats_fname)
+    ingest.save_state(state_fname, current)
+    return summary
+
+
+def read_partitioned(out_dir, columns=None, filters=None):
+    """Read (part of) the partitioned trials; filters on experiment and subject skip whole directories.
+
+    Args:
+        columns (list): columns to read (all if None)
+        filters (list): (column, op, value) tuples, ANDed, as in trial_store.read_trials
+    Returns:
+        dat (DataFrame)
+    """
+    dataset = ds.dataset(os.path.join(out_dir, 'trials'), format='parquet',
+                         partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'))
+    expr = None
+    for col, op, value in filters or []:
+        field = ds.field(col)
+        e = {'==': field == value, '!=': field != value, '<': field < value, '<=': field <= value,
+             '>': field > value, '>=': field >= value, 'in': field.isin(value)}[op]
+        expr = e if expr is None else expr & e
+    table = dataset.to_table(columns=columns, filter=expr)
+    return table.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream session files into a partitioned dataset and statistics.')
+    parser.add_argument('raw_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--experiments', nargs='+', default=None, help='e.g. 1 3a 3b 3c (default all)')
+    parser.add_argument('--subjects', type=int, nargs='+', default=None)
+    parser.add_argument('--chunk-rows', type=int, default=50000)
+    parser.add_argument('--window', type=int, default=4, help='files read ahead')
+    parser.add_argument('--full', action='store_true', help='rebuild from all session files')
+    args = parser.parse_args(argv)
+
+    summary = update_dataset(args.raw_dir, args.out_dir, args.experiments, args.subjects, args.full,
+                             args.chunk_rows, args.window)
+    print('{} new, {} modified, {} deleted session files; {} rows streamed'.format(
+        len(summary['new']), len(summary['modified']), len(summary['deleted']), summary['n_rows']))
+
+
+if __name__ == '__main__':
+    main()
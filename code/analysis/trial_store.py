@@ -0,0 +1,107 @@
+# coding: utf-8
+
+""" Typed columnar (Parquet) store of munged trials.
+
+The munging scripts write all_data.parquet next to all_data.csv. Columns
+have fixed types, so readers do no string parsing:
+
+    categorical: subject, flanked, distortion, targ_letter, targ_pos,
+                 response, eyemovement, experiment, session_file
+    float:       freq, amplitude, spacing, RT
+    int:         session, trial, n_dist_flanks
+    boolean:     correct (nullable; NA for missed responses)
+
+read_trials loads only the requested columns and pushes filters down to
+the file, so row groups that cannot match are never read.
+
+Example:
+    import trial_store
+    dat = trial_store.read_trials('all_data.parquet',
+                                  columns=['subject', 'amplitude', 'correct'],
+                                  filters=[('distortion', '==', 'bex'), ('freq', '==', 6)])
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# categories that are known in advance, so files written at different
+# times share the same dictionary:
+CATEGORIES = {'flanked': ['flanked', 'unflanked'],
+              'distortion': ['bex', 'rf'],
+              'targ_letter': ['D', 'H', 'K', 'N'],
+              'targ_pos': ['t', 'l', 'b', 'r']}
+
+CATEGORICAL = ['subject', 'flanked', 'distortion', 'targ_letter', 'targ_pos',
+               'response', 'eyemovement', 'experiment', 'session_file']
+FLOAT = ['freq', 'amplitude', 'spacing', 'RT']
+INT = ['session', 'trial', 'n_dist_flanks']
+
+
+def typed(dat):
+    """Return a copy of a munged trial table with the store's column types."""
+    dat = dat.copy()
+    for col in CATEGORICAL:
+        if col not in dat.columns:
+            continue
+        if col in CATEGORIES:
+            dat[col] = pd.Categorical(dat[col].astype(str), categories=CATEGORIES[col])
+        else:
+            values = dat[col].astype(str)
+            dat[col] = pd.Categorical(values, categories=_sorted_categories(values.unique()))
+    for col in FLOAT:
+        if col in dat.columns:
+            dat[col] = dat[col].astype(np.float64)
+    for col in INT:
+        if col in dat.columns:
+            dat[col] = dat[col].astype(np.int64)
+    if 'im_name' in dat.columns:
+        dat['im_name'] = dat['im_name'].astype(str)
+    if 'correct' in dat.columns:
+        correct = dat['correct']
+        dat['correct'] = pd.array(np.where(correct.isna(), None, correct == 1), dtype='boolean')
+    return dat
+
+
+def _sorted_categories(values):
+    # numeric labels (subject numbers) in numeric order
+    try:
+        return sorted(values, key=int)
+    except ValueError:
+        return sorted(values)
+
+
+def write_trials(dat, fname, row_group_size=8192):
+    """Write a munged trial table as Parquet.
+
+    Args:
+        dat (DataFrame): trials, e.g. as returned by ingest.load_trials
+        fname (string): output .parquet file
+        row_group_size (int): rows per row group (the unit filters can skip)
+    """
+    table = pa.Table.from_pandas(typed(dat), preserve_index=False)
+    pq.write_table(table, fname, row_group_size=row_group_size, compression='zstd')
+
+
+def read_trials(fname, columns=None, filters=None):
+    """Read (part of) a trial store.
+
+    Args:
+        fname (string): .parquet file written by write_trials
+        columns (list): columns to load (all if None)
+        filters (list): pyarrow filters, e.g. [('subject', 'in', ['2', '5'])];
+            rows not matching are skipped while reading
+    Returns:
+        dat (DataFrame): categorical columns as pandas categoricals,
+            'correct' as nullable boolean.
+    """
+    table = pq.read_table(fname, columns=columns, filters=filters)
+    return table.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+
+
+def csv_to_store(csv_fname, fname):
+    """Convert a munged all_data.csv into a trial store."""
+    dat = pd.read_csv(csv_fname, dtype={'subject': str, 'targ_pos': str, 'response': str,
+                                        'experiment': str})
+    write_trials(dat, fname)
@@ -0,0 +1,189 @@
+'''	++++++++++++++++++     READ ME     ++++++++++++++++++
+Glyph atlas: a letter set rasterized once, templates at any pixel size.
+
+The experiment scripts take their letters from pu.im_data.sloan_letters()
+and resize them to 64 pixels wherever they are needed. An atlas holds a
+letter set as one packed (n_letters, size, size) array at high resolution
+(the Sloan images, or glyphs rasterized from a font file) with a dict from
+letter to row, so a glyph is found in O(1).
+
+Templates of any pixel size are computed once per size for the whole set
+and cached. With mip=True they are resampled from a mip pyramid of the
+atlas (each level the 2x2 box average of the one above, built on first
+use): the smallest level that is still at least as large as the requested
+size is resized with anti-aliasing, so a template never integrates over
+more than twice its own pixel size. With mip=False every template is
+resized straight from the source, exactly like the experiment scripts do;
+this is what stim_engine uses by default, so its pixels do not change.
+
+e.g.
+    atlas = GlyphAtlas.from_font('DejaVuSans-Bold.ttf', 'ABCDEFGH', size=512)
+    im = atlas.template('A', 48)
+    se.set_atlas(atlas, letter_size=48)     # stim_engine draws from it
+
+Atlases can be saved to and loaded from .npz files.
+'''
+
+import hashlib
+import numpy as np
+from skimage import transform
+
+
+class GlyphAtlas(object):
+    """A letter set packed into one array, with cached templates per size.
+
+    Args:
+        glyphs (dict): letter -> 2d image in [0, 1] (black letter on white),
+            all of the same square shape
+        mip (bool): resample templates from the mip pyramid (True) or
+            straight from the source images (False)
+    """
+
+    def __init__(self, glyphs, mip=True):
+        letters = list(glyphs.keys())
+        shapes = set(np.shape(glyphs[l]) for l in letters)
+        if len(shapes) != 1:
+            raise ValueError('all glyphs must have the same shape, got {}'.format(sorted(shapes)))
+        shape = shapes.pop()
+        if len(shape) != 2 or shape[0] != shape[1]:
+            raise ValueError('glyphs must be square 2d images, got {}'.format(shape))
+        self.letters = letters
+        self.index = dict((l, i) for i, l in enumerate(letters))
+        self.pixels = np.stack([np.asarray(glyphs[l], dtype=np.float64) for l in letters])
+        self.mip = mip
+        self._levels = [self.pixels]
+        self._templates = {}
+        self._key = None
+
+    @property
+    def size(self):
+        """Side length of the source glyphs in pixels."""
+        return self.pixels.shape[1]
+
+    @property
+    def key(self):
+        """Hash of the glyph pixels and the resampling mode."""
+        if self._key is None:
+            h = hashlib.sha1(np.ascontiguousarray(self.pixels).tobytes())
+            h.update(repr((self.letters, self.mip)).encode('utf-8'))
+            self._key = h.hexdigest()
+        return self._key
+
+    def __len__(self):
+        return len(self.letters)
+
+    def __contains__(self, letter):
+        return letter in self.index
+
+    def level(self, k):
+        """Level k of the mip pyramid, (n_letters, size / 2**k, size / 2**k) (cached)."""
+        while len(self._levels) <= k:
+            above = self._levels[-1]
+            if above.shape[1] < 2:
+                raise ValueError('the pyramid has no level {}'.format(k))
+            # odd sizes are padded with white background before halving
+            self._levels.append(transform.downscale_local_mean(above, (1, 2, 2), cval=1.))
+        return self._levels[k]
+
+    def level_for(self, size):
+        """Index of the smallest pyramid level at least size pixels wide."""
+        k, level_size = 0, self.size
+        while (level_size + 1) // 2 >= size and level_size > 1:
+            level_size = (level_size + 1) // 2
+            k += 1
+        return k
+
+    def templates(self, size):
+        """Templates of all letters at size x size pixels, (n_letters, size, size) (cached).
+
+        Rows are in the order of self.letters.
+        """
+        size = int(size)
+        if size not in self._templates:
+            source = self.level(self.level_for(size)) if self.mip else self.pixels
+            out = np.empty((len(self), size, size))
+            for i, im in enumerate(source):
+                if im.shape == (size, size):
+                    out[i] = im
+                elif self.mip:
+                    out[i] = transform.resize(im, (size, size), anti_aliasing=True)
+                else:
+                    out[i] = transform.resize(im, (size, size))
+            self._templates[size] = out
+        return self._templates[size]
+
+    def template(self, letter, size):
+        """The template of a letter at size x size pixels."""
+        if letter not in self.index:
+            raise KeyError('{} is not in the atlas ({})'.format(letter, ''.join(self.letters)))
+        return self.templates(size)[self.index[letter]]
+
+    def save(self, fname):
+        """Write the packed glyphs to an .npz file."""
+        np.savez_compressed(fname, pixels=self.pixels, letters=np.array(self.letters), mip=self.mip)
+
+    @classmethod
+    def load(cls, fname, mip=None):
+        """Read an atlas written by save (mip overrides the saved resampling mode)."""
+        with np.load(fname, allow_pickle=False) as f:
+            glyphs = dict((str(l), im) for l, im in zip(f['letters'], f['pixels']))
+            saved_mip = bool(f['mip'])
+        return cls(glyphs, saved_mip if mip is None else mip)
+
+    @classmethod
+    def from_sloan(cls, mip=True):
+        """The Sloan letters of psyutils."""
+        import psyutils as pu
+        return cls(pu.im_data.sloan_letters(), mip)
+
+    @classmethod
+    def from_font(cls, font_file, letters, size=512, mip=True):
+        """Rasterize letters of a TrueType/OpenType font (requires Pillow).
+
+        Every glyph is scaled so that the largest glyph of the set fills the
+        size x size square, and centred on its ink. Relative glyph sizes of
+        the font are kept.
+
+        Args:
+            font_file (string): font file (or a name Pillow can find)
+            letters (iterable): the characters to rasterize
+            size (int): side length of the atlas glyphs in pixels
+            mip (bool): see GlyphAtlas
+        """
+        return cls(rasterize_font(font_file, letters, size), mip)
+
+
+def rasterize_font(font_file, letters, size=512, supersample=4):
+    """Glyphs of a font as black-on-white images in [0, 1].
+
+    The glyphs are drawn at supersample times the final resolution and
+    box-averaged down, which anti-aliases their edges.
+
+    Returns:
+        dict: letter -> (size, size) float image
+    """
+    try:
+        from PIL import Image, ImageDraw, ImageFont
+    except ImportError:
+        raise ImportError('rasterizing fonts requires Pillow (pip install pillow)')
+    big = size * supersample
+    font = ImageFont.truetype(font_file, big)
+    inks = {}
+    for letter in letters:
+        canvas = Image.new('L', (2 * big, 2 * big), 0)
+        ImageDraw.Draw(canvas).text((big // 2, big // 2), letter, fill=255, font=font)
+        ink = np.asarray(canvas, dtype=np.float64) / 255.
+        rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+        if len(rows) == 0:
+            raise ValueError('{!r} has no glyph in {}'.format(letter, font_file))
+        inks[letter] = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    scale = float(big) / max(max(ink.shape) for ink in inks.values())
+    glyphs = {}
+    for letter, ink in inks.items():
+        shape = tuple(max(1, int(round(s * scale))) for s in ink.shape)
+        ink = transform.resize(ink, shape, anti_aliasing=True)
+        square = np.zeros((big, big))
+        y0, x0 = (big - shape[0]) // 2, (big - shape[1]) // 2
+        square[y0:y0 + shape[0], x0:x0 + shape[1]] = ink
+        glyphs[letter] = 1. - transform.downscale_local_mean(square, (supersample, supersample))
+    return glyphs
@@ -0,0 +1,248 @@
+'''	++++++++++++++++++     READ ME     ++++++++++++++++++
+Image-difference metrics between the undistorted and distorted display of a trial.
+
+For every pair the target region (the four 92x92 letter patches at
+se.POSITIONS) and the flanker region (the 16 flanker patches around them)
+are cut out of both displays with one fancy-indexing gather, and within
+each region we compute:
+
+    rms             RMS pixel difference
+    ssim            mean structural similarity (Gaussian window, sigma 1.5)
+    band_<lo>_<hi>  energy of the distorted minus that of the undistorted
+                    region in octave bands of <lo> to <hi> cycles per patch
+
+Pairs are processed in batches (B, 2, 1024, 1024), so every metric is one
+vectorized expression over B x patches. The results are a table keyed by
+im_name (the distorted file name, as in the trial files), one column per
+region and metric, written as Parquet.
+
+Pairs come from a sparse store (sparse_store.py), from a directory of
+png pairs (undistorted/ and distorted/, as written by stim_pool.py or the
+experiment scripts), or are scored during generation with
+'python stim_pool.py ... --metrics'.
+
+e.g. 'python pair_metrics.py images pair_metrics_exp1.parquet'
+     'python pair_metrics.py store_exp1 pair_metrics_store.parquet'
+'''
+
+import os
+import csv
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from skimage import io
+import stim_engine as se
+
+SSIM_SIGMA = 1.5
+SSIM_C1 = 0.01**2
+SSIM_C2 = 0.03**2
+# octave band edges in cycles per patch
+BAND_EDGES = (1, 2, 4, 8, 16, 32, 64)
+REGIONS = ('targ', 'flank')
+
+_region_index = {}
+_band_index = {}
+
+
+def metric_names():
+    """Metric columns, in table order."""
+    names = []
+    for region in REGIONS:
+        names.extend([region + '_rms', region + '_ssim'])
+        names.extend('{}_band_{}_{}'.format(region, lo, hi)
+                     for lo, hi in zip(BAND_EDGES[:-1], BAND_EDGES[1:]))
+    return names
+
+
+def region_index(region, size=se.PATCH_SIZE):
+    """Row and column indices (n_patches, size) of the patches of a region (cached)."""
+    if region not in _region_index:
+        if region == 'targ':
+            centres = se.POSITIONS
+        else:
+            centres = [p for x, y in se.POSITIONS for p in se.flanker_pos(x, y, se.SPACING)]
+        offset = np.arange(size) - size // 2
+        rows = np.array([int(y) + offset for x, y in centres])
+        cols = np.array([int(x) + offset for x, y in centres])
+        _region_index[region] = (rows, cols)
+    return _region_index[region]
+
+
+def regions(pairs, region):
+    """Patches of a region from a batch of pairs, shape (B, 2, n_patches, size, size)."""
+    rows, cols = region_index(region)
+    return pairs[:, :, rows[:, :, None], cols[:, None, :]]
+
+
+def band_index(size=se.PATCH_SIZE):
+    """Octave band of every rfft2 coefficient of a patch (len(BAND_EDGES) - 1: none) and conjugate weights."""
+    if size not in _band_index:
+        fy = np.fft.fftfreq(size) * size
+        fx = np.fft.rfftfreq(size) * size
+        radius = np.hypot(*np.meshgrid(fx, fy))
+        band = np.searchsorted(BAND_EDGES, radius, side='right') - 1
+        band[(radius < BAND_EDGES[0]) | (band >= len(BAND_EDGES) - 1)] = len(BAND_EDGES) - 1
+        # columns other than DC and Nyquist stand for two conjugate coefficients
+        weight = np.full(radius.shape, 2.)
+        weight[:, 0] = 1
+        if size % 2 == 0:
+            weight[:, -1] = 1
+        _band_index[size] = (band.ravel(), weight.ravel())
+    return _band_index[size]
+
+
+def band_energy(patches):
+    """Energy per octave band summed over the patches of a region.
+
+    Args:
+        patches (float): (..., n_patches, size, size)
+    Returns:
+        (..., n_bands) energy (squared amplitude per pixel)
+    """
+    size = patches.shape[-1]
+    band, weight = band_index(size)
+    n_bands = len(BAND_EDGES) - 1
+    power = np.abs(np.fft.rfft2(patches))**2 * weight.reshape(size, -1) / float(size**2)
+    lead = power.shape[:-3]
+    power = power.reshape((-1, power.shape[-3] * power.shape[-2] * power.shape[-1]))
+    n = len(power)
+    n_coef = len(band)
+    idx = (np.tile(band, power.shape[1] // n_coef)[None, :] + np.arange(n)[:, None] * (n_bands + 1)).ravel()
+    energy = np.bincount(idx, power.ravel(), n * (n_bands + 1)).reshape(n, n_bands + 1)[:, :n_bands]
+    return energy.reshape(lead + (n_bands,)) / float(size**2)
+
+
+def ssim(a, b, sigma=SSIM_SIGMA):
+    """Mean SSIM of image stacks a and b (..., size, size) in [0, 1], over the last two axes."""
+    blur_sigma = (0,) * (a.ndim - 2) + (sigma, sigma)
+
+    def blur(x):
+        return ndimage.gaussian_filter(x, blur_sigma, mode='reflect', truncate=3.5)
+
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a**2
+    var_b = blur(b * b) - mu_b**2
+    cov = blur(a * b) - mu_a * mu_b
+    s = ((2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)) / \
+        ((mu_a**2 + mu_b**2 + SSIM_C1) * (var_a + var_b + SSIM_C2))
+    # like skimage.metrics.structural_similarity, ignore the border the window overhangs
+    pad = int(3.5 * sigma + 0.5)
+    return s[..., pad:-pad, pad:-pad].mean(axis=(-2, -1))
+
+
+def pair_metrics(pairs):
+    """Difference metrics of a batch of display pairs.
+
+    Args:
+        pairs (float): (B, 2, rows, cols) undistorted and distorted displays in [0, 1]
+    Returns:
+        metrics (dict): (B,) array per column of metric_names()
+    """
+    pairs = np.asarray(pairs, dtype=float)
+    if pairs.ndim == 3:
+        pairs = pairs[None]
+    out = {}
+    for region in REGIONS:
+        r = regions(pairs, region)
+        undistorted, distorted = r[:, 0], r[:, 1]
+        out[region + '_rms'] = np.sqrt(((distorted - undistorted)**2).mean(axis=(1, 2, 3)))
+        out[region + '_ssim'] = ssim(undistorted, distorted).mean(axis=1)
+        # energy of the letters, not of the white background
+        diff = band_energy(1 - distorted) - band_energy(1 - undistorted)
+        for k, (lo, hi) in enumerate(zip(BAND_EDGES[:-1], BAND_EDGES[1:])):
+            out['{}_band_{}_{}'.format(region, lo, hi)] = diff[:, k]
+    return out
+
+
+''' --------  Sources  ---------'''
+
+def store_pairs(store, batch_size=16):
+    """Batches (names, pairs) of a sparse_store.SparseStore."""
+    for start in range(0, len(store), batch_size):
+        indices = range(start, min(start + batch_size, len(store)))
+        pairs = np.empty((len(indices), 2) + store.canvas_shape)
+        store.reconstruct_batch(indices, distorted=False, out=pairs[:, 0])
+        store.reconstruct_batch(indices, distorted=True, out=pairs[:, 1])
+        yield [store.manifest[i]['im_name'] for i in indices], pairs
+
+
+def undistorted_name(im_name):
+    """File name of the undistorted twin of a distorted display."""
+    for dist_type in ('bex', 'rf'):
+        tag = '_' + dist_type + '_'
+        if tag in im_name:
+            return im_name.replace(tag, '_' + dist_type + '_undistorted_', 1)
+    raise ValueError('distortiontype not known: {}'.format(im_name))
+
+
+def image_dir_names(image_dir):
+    """(im_name, undistorted_name) of the pairs in an image directory, from its manifest if it has one."""
+    manifest = os.path.join(image_dir, 'manifest.csv')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            return [(r['im_name'], r['undistorted_name']) for r in csv.DictReader(f)]
+    names = sorted(os.path.basename(f) for f in glob.glob(os.path.join(image_dir, 'distorted', '*.png')))
+    return [(n, undistorted_name(n)) for n in names]
+
+
+def image_dir_pairs(image_dir, batch_size=16):
+    """Batches (names, pairs) of the png pairs in image_dir/undistorted and image_dir/distorted."""
+    names = image_dir_names(image_dir)
+    for start in range(0, len(names), batch_size):
+        batch = names[start:start + batch_size]
+        pairs = None
+        for j, (im_name, und_name) in enumerate(batch):
+            for k, fname in enumerate((os.path.join(image_dir, 'undistorted', und_name),
+                                       os.path.join(image_dir, 'distorted', im_name))):
+                im = io.imread(fname)
+                if pairs is None:
+                    pairs = np.empty((len(batch), 2) + im.shape[:2])
+                pairs[j, k] = im / 255.
+        yield [n for n, u in batch], pairs
+
+
+def metrics_table(batches):
+    """Metrics of a stream of (names, pairs) batches as one table keyed by im_name."""
+    names, columns = [], dict((c, []) for c in metric_names())
+    for batch_names, pairs in batches:
+        names.extend(batch_names)
+        m = pair_metrics(pairs)
+        for c in columns:
+            columns[c].append(m[c])
+    table = pd.DataFrame({'im_name': names})
+    for c in columns:
+        table[c] = np.concatenate(columns[c]) if columns[c] else np.zeros(0)
+    return table
+
+
+def write_metrics(fname, table):
+    """Write a metrics table (DataFrame or list of meta rows) as Parquet."""
+    if not isinstance(table, pd.DataFrame):
+        table = pd.DataFrame([dict((c, row.get(c)) for c in ['im_name'] + metric_names())
+                              for row in table])
+    table.to_parquet(fname, index=False)
+    return table
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Difference metrics of undistorted/distorted display pairs.')
+    parser.add_argument('source', help='sparse store or directory with undistorted/ and distorted/ pngs')
+    parser.add_argument('out', help='output .parquet file')
+    parser.add_argument('--batch-size', type=int, default=16)
+    args = parser.parse_args(argv)
+
+    if os.path.exists(os.path.join(args.source, 'layout.npz')):
+        from sparse_store import SparseStore
+        batches = store_pairs(SparseStore(args.source), args.batch_size)
+    else:
+        batches = image_dir_pairs(args.source, args.batch_size)
+    table = write_metrics(args.out, metrics_table(batches))
+    print('{} pairs written to {}'.format(len(table), args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+'''	++++++++++++++++++     READ ME     ++++++++++++++++++
+Bank of pre-rendered distorted letter patches and fast display assembly.
+
+A display is 4 target and (if flanked) 16 flanker 92x92 patches pasted at
+fixed offsets, and only the distorted patches are random. The bank renders
+K independent distorted patches per (letter, dist_type, freq, amplitude)
+once. Displays are then assembled by drawing the layout and a bank entry
+for every distorted patch from a seeded RandomState, so building a large
+stimulus set (or one per participant) is a matter of memory copies.
+
+Assembled displays are statistically equivalent to rendered ones but not
+pixel-identical: the random draws differ from stim_gen, and patches are
+stored as 8 bit by default.
+
+A bank records the engine version and glyphs (se.glyph_key) it was built
+with. Loading it, or assembling from it, after either has changed (e.g.
+after se.set_atlas) raises a ValueError; build a new bank instead.
+
+e.g. 'python patch_bank.py bank_exp1.npz bex rf -k 200 --seed 1'
+builds a bank for the default frequencies and amplitudes of both
+distortion types, and
+
+'python stim_pool.py 1 bex --flanked --bank bank_exp1.npz'
+
+assembles stimuli from it.
+'''
+
+import json
+import argparse
+import multiprocessing as mp
+import numpy as np
+import stim_engine as se
+
+
+def bank_conditions(trials):
+    """The (dist_type, freq, amplitude) conditions needed to assemble trials."""
+    conds = set()
+    for trial in trials:
+        conds.add((trial['dist_type'], trial['freq'], trial['amplitude']))
+        if trial['flanked'] and trial['distflanked']:
+            conds.add((trial['dist_type'], trial['freq'], trial['flank_amplitude']))
+    return sorted(conds)
+
+
+def _render_patches(args):
+    letter, dist_type, freq, amplitude, k, seed, dtype = args
+    np.random.seed(seed)
+    template = se.letter_template(letter)
+    out = np.empty((k, se.PATCH_SIZE, se.PATCH_SIZE), dtype=dtype)
+    x_offsets = np.empty((k, se.PATCH_SIZE, se.PATCH_SIZE))
+    y_offsets = np.empty((k, se.PATCH_SIZE, se.PATCH_SIZE))
+    for j in range(k):
+        x_offsets[j], y_offsets[j] = se.distortion_offsets(dist_type, amplitude, freq)
+        out[j] = _encode(se.distort_patch(template, x_offsets[j], y_offsets[j]), dtype)
+    return out, se.field_summaries(x_offsets, y_offsets)
+
+
+def _encode(im, dtype):
+    if np.dtype(dtype) == np.uint8:
+        return np.clip(np.round(im * 255), 0, 255)
+    return im
+
+
+def _glyph_key():
+    return json.dumps(se.glyph_key(), sort_keys=True)
+
+
+def build_bank(fname, conditions, k=100, letters=se.LETTERS + se.FLANKERS,
+               seed=None, dtype=np.uint8, n_workers=None):
+    """Render k distorted patches per letter and condition and save them.
+
+    Args:
+        fname (string): output .npz file
+        conditions (list): (dist_type, freq, amplitude) tuples, e.g. from bank_conditions
+        k (int): number of patches per letter and condition
+        letters (tuple): letters to render
+        seed (int): seed for the per-chunk seeds
+        dtype: np.uint8 (compact, quantized to 1/255) or np.float32
+        n_workers (int): number of processes (cpu count if None)
+    Returns:
+        bank (PatchBank): the saved bank.
+    """
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=(len(conditions), len(letters)))
+    jobs = [(letter, c[0], c[1], c[2], k, int(seeds[i, j]), dtype)
+            for i, c in enumerate(conditions) for j, letter in enumerate(letters)]
+    # filled in place as chunks arrive, so the bank is held in memory only once
+    patches = np.empty((len(conditions), len(letters), k, se.PATCH_SIZE, se.PATCH_SIZE), dtype=dtype)
+    summaries = np.empty((len(conditions), len(letters), k, len(se.FIELD_SUMMARY)))
+    pool = mp.Pool(n_workers)
+    try:
+        for n, (chunk, summary) in enumerate(pool.imap(_render_patches, jobs)):
+            i, j = divmod(n, len(letters))
+            patches[i, j] = chunk
+            summaries[i, j] = summary
+    finally:
+        pool.close()
+        pool.join()
+
+    templates = np.stack([se.letter_template(l) for l in letters])
+    np.savez(fname,
+             patches=patches,
+             field_summaries=summaries,
+             letters=np.array(letters),
+             dist_types=np.array([c[0] for c in conditions]),
+             freqs=np.array([c[1] for c in conditions], dtype=float),
+             amplitudes=np.array([c[2] for c in conditions], dtype=float),
+             templates=templates,
+             fixation=se.fixation_template(),
+             engine_version=np.array(se.ENGINE_VERSION),
+             glyph_key=np.array(_glyph_key()))
+    return PatchBank(fname)
+
+
+class PatchBank(object):
+    """A saved patch bank.
+
+    Args:
+        fname (string): .npz file written by build_bank
+
+    Example:
+        bank = PatchBank('bank_exp1.npz')
+        trials = se.plan_trials('1', 'bex', flanked=True, seed=3)
+        pair, meta = bank.assemble_pair(trials[0])
+    """
+
+    def __init__(self, fname):
+        with np.load(fname) as f:
+            self.patches = f['patches']
+            self.letters = [str(l) for l in f['letters']]
+            self.conditions = [(str(d), float(fr), float(a)) for d, fr, a in
+                               zip(f['dist_types'], f['freqs'], f['amplitudes'])]
+            self.templates = f['templates']
+            self.fixation = f['fixation']
+            self.engine_version = str(f['engine_version'])
+            # banks from before glyph atlases were built with the default glyphs
+            self.glyph_key = str(f['glyph_key']) if 'glyph_key' in f.files else json.dumps(None)
+            # displacement field summaries of every patch (missing in older banks)
+            self.summaries = f['field_summaries'] if 'field_summaries' in f.files else None
+        self.k = self.patches.shape[2]
+        self._cond_idx = dict((c, i) for i, c in enumerate(self.conditions))
+        self._letter_idx = dict((l, i) for i, l in enumerate(self.letters))
+        self.fname = fname
+        self.check_engine()
+
+    def check_engine(self):
+        """Raise ValueError if stim_engine no longer draws the pixels the bank was built with."""
+        if self.engine_version != se.ENGINE_VERSION:
+            raise ValueError('{} was built with engine version {}, the engine is at version {}'.format(
+                self.fname, self.engine_version, se.ENGINE_VERSION))
+        if self.glyph_key != _glyph_key():
+            raise ValueError('{} was built with other glyphs than the current ones ({} instead of {})'.format(
+                self.fname, self.glyph_key, _glyph_key()))
+
+    def _index(self, letter, dist_type, freq, amplitude, j):
+        try:
+            c = self._cond_idx[(dist_type, float(freq), float(amplitude))]
+        except KeyError:
+            raise KeyError('condition not in bank: {} {} {}'.format(dist_type, freq, amplitude))
+        return c, self._letter_idx[letter], j
+
+    def patch(self, letter, dist_type, freq, amplitude, j):
+        """Entry j of a letter and condition, as float in [0, 1]."""
+        im = self.patches[self._index(letter, dist_type, freq, amplitude, j)]
+        if im.dtype == np.uint8:
+            return im / 255.
+        return im
+
+    def assemble_display(self, layout, trial, big_array, distorted, rng, stats=None):
+        """Paint a display from bank entries, drawing one entry per distorted patch from rng.
+
+        If stats is a list, (role, field summary) is appended for every
+        distorted patch (when the bank has summaries).
+        """
+        big_array[...] = 1.
+        for patch in layout['patches']:
+            if distorted and patch['distort']:
+                idx = self._index(patch['letter'], trial['dist_type'], trial['freq'],
+                                  patch['amplitude'], rng.randint(self.k))
+                im = self.patches[idx]
+                im = im / 255. if im.dtype == np.uint8 else im
+                if stats is not None and self.summaries is not None:
+                    stats.append((patch['role'], self.summaries[idx]))
+            else:
+                im = self.templates[self._letter_idx[patch['letter']]]
+            se.paste(im, big_array, patch['x'], patch['y'])
+        se.paste(self.fixation, big_array, se.FIXATION_POSITION[0], se.FIXATION_POSITION[1])
+        return big_array
+
+    def assemble_pair(self, trial, out=None):
+        """Assemble the undistorted and distorted display of a trial (see se.render_pair)."""
+        # the atlas may have been changed since the bank was loaded
+        self.check_engine()
+        if out is None:
+            out = np.empty((2,) + se.CANVAS_SHAPE)
+        rng = np.random.RandomState(trial['seed'])
+        layout = se.make_layout(trial, rng)
+        stats = []
+        self.assemble_display(layout, trial, out[0], False, rng)
+        self.assemble_display(layout, trial, out[1], True, rng, stats)
+        meta = se.trial_meta(trial, layout)
+        if self.summaries is not None:
+            meta.update(se.displacement_stats([r for r, s in stats], [s for r, s in stats]))
+        meta['source'] = 'bank'
+        return out, meta
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a bank of distorted letter patches.')
+    parser.add_argument('fname', help='output .npz file')
+    parser.add_argument('distortiontypes', nargs='+', choices=('bex', 'rf'))
+    parser.add_argument('--freqs', type=float, nargs='+', help='frequencies (script defaults if omitted)')
+    parser.add_argument('--amps', type=float, nargs='+', help='amplitudes (script defaults if omitted)')
+    parser.add_argument('-k', type=int, default=100, help='patches per letter and condition')
+    parser.add_argument('--float', action='store_true', help='store float32 instead of 8 bit patches')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    conditions = []
+    for dist_type in args.distortiontypes:
+        freqs = args.freqs or se.DEFAULT_FREQS[dist_type]
+        amps = args.amps or se.DEFAULT_AMPS[dist_type]
+        if dist_type in se.FLANKER_AMPS and args.amps is None:
+            amps = amps + [se.FLANKER_AMPS[dist_type]]
+        conditions.extend((dist_type, float(f), float(a)) for f in freqs for a in amps)
+    bank = build_bank(args.fname, conditions, k=args.k, seed=args.seed,
+                      dtype=np.float32 if args.float else np.uint8, n_workers=args.workers)
+    print('{} patches written to {}'.format(bank.patches.shape[0] * bank.patches.shape[1] * bank.k,
+                                            args.fname))
+
+
+if __name__ == '__main__':
+    main()
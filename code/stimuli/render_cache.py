@@ -0,0 +1,195 @@
+'''	++++++++++++++++++     READ ME     ++++++++++++++++++
+Content-addressed on-disk cache of rendered display pairs.
+
+Every entry is keyed by a hash of everything that determines its pixels:
+the engine version, the letter sets (and the glyph atlas, if not the
+default one), the display layout, the distortion type, frequency and
+amplitude, which flankers are distorted (and how strongly) and the seed. Experiment labels and repetition numbers only
+change file names, not pixels, so e.g. a flanked display of experiment 1
+and one of experiment 3a with distflanked=0 share an entry when they share
+a seed.
+
+Entries are compressed .npz files in the cache directory. A hit refreshes
+the entry's modification time; when the directory grows beyond max_bytes
+the least recently used entries are removed. Each RenderCache keeps a
+running total of its own writes and recounts the directory (which other
+processes may write to) every RECOUNT_EVERY puts and when the total
+exceeds max_bytes. Eviction then frees the cache down to EVICT_TO of
+max_bytes.
+
+Example:
+    cache = RenderCache('/tmp/stim_cache', max_bytes=2*1024**3)
+    pair, meta = cached_render_pair(trial, cache)
+'''
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import stim_engine as se
+
+
+# puts between recounts of the directory size; between recounts only this
+# process's writes are counted
+RECOUNT_EVERY = 100
+# fraction of max_bytes that eviction frees the cache down to
+EVICT_TO = 0.9
+
+
+def _hash(fields):
+    text = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _with_glyphs(fields):
+    # default atlas keys are left out, so that existing entries stay valid
+    glyphs = se.glyph_key()
+    if glyphs is not None:
+        fields['glyphs'] = glyphs
+    return fields
+
+
+def display_key(trial):
+    """Hash of the parameters that determine the pixels of a trial's display pair."""
+    flanker_set = None
+    if trial['flanked']:
+        flanker_set = {'distflanked': trial['distflanked'],
+                       'flank_amplitude': trial['flank_amplitude'] if trial['distflanked'] else None}
+    fields = {'kind': 'display',
+              'engine_version': se.ENGINE_VERSION,
+              'letters': se.LETTERS,
+              'flankers': se.FLANKERS if trial['flanked'] else None,
+              'layout': {'canvas': se.CANVAS_SHAPE, 'positions': se.POSITIONS,
+                         'spacing': se.SPACING, 'fixation': se.FIXATION_POSITION},
+              'dist_type': trial['dist_type'],
+              'freq': float(trial['freq']),
+              'amplitude': float(trial['amplitude']),
+              'n_dist_targets': trial['n_dist_targets'],
+              'flanker_set': flanker_set,
+              'seed': int(trial['seed'])}
+    return _hash(_with_glyphs(fields))
+
+
+class RenderCache(object):
+    """Size-bounded LRU cache of numpy arrays in a directory.
+
+    Args:
+        cache_dir (string): the cache directory (created if needed)
+        max_bytes (int): evict least recently used entries above this size
+    """
+
+    def __init__(self, cache_dir, max_bytes=2*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._size = None
+        self._puts = 0
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """Return the dict of arrays stored under key, or None."""
+        fname = self.path(key)
+        try:
+            with np.load(fname) as f:
+                arrays = {k: f[k] for k in f.files}
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            # mark as recently used
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return arrays
+
+    def put(self, key, **arrays):
+        """Store arrays under key (atomically, so concurrent processes are safe)."""
+        fname = self.path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        try:
+            old_size = os.path.getsize(fname)
+        except OSError:
+            old_size = 0
+        os.replace(tmp, fname)
+        self._puts += 1
+        if self._size is None or self._puts % RECOUNT_EVERY == 0:
+            # other processes (e.g. stim_pool workers) write to the same directory
+            self._size = self.size()
+        else:
+            self._size += os.path.getsize(fname) - old_size
+        if self._size > self.max_bytes:
+            self._size = self.size()
+            if self._size > self.max_bytes:
+                # down to a low-water mark, so that a full cache is not scanned on every put
+                self.evict(int(EVICT_TO * self.max_bytes))
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def size(self):
+        """Total size of the cache entries in bytes."""
+        return sum(e[1] for e in self._entries())
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used entries until the cache fits max_bytes."""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+    def clear(self):
+        self.evict(0)
+
+
+def cached_render_pair(trial, cache, out=None):
+    """se.render_pair, returning the stored pair when the cache has it.
+
+    Args:
+        trial (dict): a trial as returned by se.plan_trials
+        cache (RenderCache): the cache
+        out (float): array of shape (2,) + CANVAS_SHAPE to fill (allocated if None)
+    Returns:
+        out, meta: as se.render_pair. The meta of a hit is rebuilt for the
+        given trial, so file names follow its experiment and repetition;
+        the displacement statistics are stored with the entry.
+    """
+    if out is None:
+        out = np.empty((2,) + se.CANVAS_SHAPE)
+    key = display_key(trial)
+    hit = cache.get(key)
+    if hit is not None:
+        out[...] = hit['pair']
+        layout = json.loads(str(hit['layout']))
+        meta = se.trial_meta(trial, layout)
+        if 'stats' in hit:
+            meta.update(json.loads(str(hit['stats'])))
+        return out, meta
+
+    out, meta = se.render_pair(trial, out=out)
+    layout = {'targ_pos': meta['targ_pos'], 'targ_letter': meta['targ_letter']}
+    stats = dict((k, meta[k]) for k in se.DISPLACEMENT_STATS)
+    cache.put(key, pair=out, layout=np.array(json.dumps(layout)), stats=np.array(json.dumps(stats)))
+    return out, meta
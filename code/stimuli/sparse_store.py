@@ -0,0 +1,290 @@
+'''	++++++++++++++++++     READ ME     ++++++++++++++++++
+Sparse stimulus store: layouts plus distorted patches instead of canvases.
+
+Over 95% of every 1024x1024 display is white background, and the
+undistorted and distorted display of a trial only differ inside the
+distorted patches. A store records each trial as its layout (which letter
+template is pasted where, in placement order, and the fixation cross) plus
+references to the distorted patches, which are the only pixels stored.
+Both displays of a trial are rebuilt from the store on load, singly or in
+batches.
+
+A store is a directory:
+    templates.npy   undistorted letter patches (float64)
+    fixation.npy    fixation cross
+    layout.npz      per trial: letter ids, centres and patch references
+    patches.npy     the distorted patches (uint8 by default, memory-mapped on load)
+    manifest.csv    one row per trial (as written by stim_pool.py)
+
+e.g. 'python sparse_store.py build store_exp1 1 bex --flanked --seed 1'
+     'python sparse_store.py export store_exp1 images_exp1'
+
+With float64 patches, reconstructed displays equal se.render_pair exactly.
+'''
+
+import os
+import io
+import csv
+import shutil
+import argparse
+import multiprocessing as mp
+import numpy as np
+import stim_engine as se
+from stim_pool import write_manifest, number
+
+NO_PATCH = -1
+
+
+def render_sparse(trial):
+    """Render the distorted patches of a trial without painting the canvases.
+
+    Makes the same random draws as se.render_pair.
+
+    Args:
+        trial (dict): a trial as returned by se.plan_trials
+    Returns:
+        layout (dict): the trial layout (see se.make_layout)
+        patches (dict): distorted patch (float) by index into layout['patches']
+        meta (dict): se.trial_meta of the trial plus its displacement statistics
+    """
+    np.random.seed(trial['seed'])
+    layout = se.make_layout(trial)
+    patches = {}
+    fields = []
+    for idx, patch in enumerate(layout['patches']):
+        if patch['distort']:
+            x_offset, y_offset = se.distortion_offsets(trial['dist_type'], patch['amplitude'], trial['freq'])
+            patches[idx] = se.distort_patch(se.letter_template(patch['letter']), x_offset, y_offset)
+            fields.append((idx, x_offset, y_offset))
+    meta = se.trial_meta(trial, layout)
+    meta.update(se.display_stats(layout, fields))
+    return layout, patches, meta
+
+
+class SparseWriter(object):
+    """Collect trials and write them as a sparse store.
+
+    Patches are appended to patches.npy as they are added, so memory does
+    not grow with the number of patches; the layouts and the manifest are
+    written on close.
+
+    Args:
+        store_dir (string): the store directory (created if needed)
+        dtype: np.uint8 (quantized to 1/255, like the saved pngs) or a float type
+
+    Example:
+        w = SparseWriter('store_exp1')
+        for trial in trials:
+            w.add(*render_sparse(trial))
+        w.close()
+    """
+
+    def __init__(self, store_dir, dtype=np.uint8):
+        self.store_dir = store_dir
+        self.dtype = np.dtype(dtype)
+        self.letters = list(se.LETTERS + se.FLANKERS)
+        self.ops = []
+        self.refs = []
+        self.rows = []
+        self.n_patches = 0
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self._patch_fname = os.path.join(store_dir, 'patches.npy')
+        self._patch_file = open(self._patch_fname + '.tmp', 'wb')
+        # header for zero patches; rewritten with the final count on close
+        self._patch_file.write(self._patch_header(0))
+        self._header_len = self._patch_file.tell()
+
+    def add(self, layout, patches, meta):
+        ops = np.zeros((len(layout['patches']), 3), dtype=np.int32)
+        refs = np.full(len(layout['patches']), NO_PATCH, dtype=np.int32)
+        for idx, patch in enumerate(layout['patches']):
+            ops[idx] = (self.letters.index(patch['letter']), int(patch['x']), int(patch['y']))
+            if idx in patches:
+                refs[idx] = self.n_patches
+                self._patch_file.write(np.ascontiguousarray(self._encode(patches[idx])).tobytes())
+                self.n_patches += 1
+        self.ops.append(ops)
+        self.refs.append(refs)
+        self.rows.append(meta)
+
+    def _encode(self, im):
+        if self.dtype == np.uint8:
+            return np.clip(np.round(im * 255), 0, 255).astype(np.uint8)
+        return im.astype(self.dtype)
+
+    def _patch_header(self, n):
+        buf = io.BytesIO()
+        np.lib.format.write_array_header_1_0(buf, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                   'fortran_order': False,
+                                                   'shape': (n, se.PATCH_SIZE, se.PATCH_SIZE)})
+        return buf.getvalue()
+
+    def _close_patches(self):
+        header = self._patch_header(self.n_patches)
+        f = self._patch_file
+        if len(header) == self._header_len:
+            f.seek(0)
+            f.write(header)
+            f.close()
+        else:
+            # the header grew (padding is to 64 bytes, so only for absurd counts): copy the data
+            f.close()
+            with open(self._patch_fname + '.tmp', 'rb') as src, open(self._patch_fname + '.tmp2', 'wb') as dst:
+                dst.write(header)
+                src.seek(self._header_len)
+                shutil.copyfileobj(src, dst)
+            os.replace(self._patch_fname + '.tmp2', self._patch_fname + '.tmp')
+        os.replace(self._patch_fname + '.tmp', self._patch_fname)
+
+    def close(self):
+        self._close_patches()
+        # an empty plan gives zero-length arrays
+        n_ops = max((len(o) for o in self.ops), default=0)
+        ops = np.zeros((len(self.ops), n_ops, 3), dtype=np.int32)
+        refs = np.full((len(self.ops), n_ops), NO_PATCH, dtype=np.int32)
+        counts = np.zeros(len(self.ops), dtype=np.int32)
+        for i, (o, r) in enumerate(zip(self.ops, self.refs)):
+            ops[i, :len(o)] = o
+            refs[i, :len(r)] = r
+            counts[i] = len(o)
+
+        np.save(os.path.join(self.store_dir, 'templates.npy'),
+                np.stack([se.letter_template(l) for l in self.letters]))
+        np.save(os.path.join(self.store_dir, 'fixation.npy'), se.fixation_template())
+        np.savez(os.path.join(self.store_dir, 'layout.npz'),
+                 ops=ops, refs=refs, n_ops=counts, letters=np.array(self.letters),
+                 canvas_shape=np.array(se.CANVAS_SHAPE),
+                 fixation_position=np.array(se.FIXATION_POSITION),
+                 engine_version=np.array(se.ENGINE_VERSION))
+        write_manifest(os.path.join(self.store_dir, 'manifest.csv'), self.rows)
+
+
+class SparseStore(object):
+    """Read access to a sparse store.
+
+    Args:
+        store_dir (string): directory written by SparseWriter
+
+    Example:
+        store = SparseStore('store_exp1')
+        im = store.reconstruct(0)
+        batch = store.reconstruct_batch(range(16), distorted=False)
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.templates = np.load(os.path.join(store_dir, 'templates.npy'))
+        self.fixation = np.load(os.path.join(store_dir, 'fixation.npy'))
+        self.patches = np.load(os.path.join(store_dir, 'patches.npy'), mmap_mode='r')
+        with np.load(os.path.join(store_dir, 'layout.npz')) as f:
+            self.ops = f['ops']
+            self.refs = f['refs']
+            self.n_ops = f['n_ops']
+            self.letters = [str(l) for l in f['letters']]
+            self.canvas_shape = tuple(f['canvas_shape'])
+            self.fixation_position = tuple(f['fixation_position'])
+        with open(os.path.join(store_dir, 'manifest.csv')) as f:
+            self.manifest = list(csv.DictReader(f))
+
+    def __len__(self):
+        return len(self.ops)
+
+    def _patch(self, ref):
+        im = self.patches[ref]
+        if im.dtype == np.uint8:
+            return im / 255.
+        return im
+
+    def paint(self, i, big_array, distorted=True):
+        """Paint display i of the store into big_array."""
+        big_array[...] = 1.
+        ops, refs = self.ops[i], self.refs[i]
+        for k in range(self.n_ops[i]):
+            letter, x, y = ops[k]
+            if distorted and refs[k] != NO_PATCH:
+                im = self._patch(refs[k])
+            else:
+                im = self.templates[letter]
+            se.paste(im, big_array, x, y)
+        se.paste(self.fixation, big_array, self.fixation_position[0], self.fixation_position[1])
+        return big_array
+
+    def reconstruct(self, i, distorted=True):
+        """The full canvas of display i."""
+        return self.paint(i, np.empty(self.canvas_shape), distorted)
+
+    def reconstruct_batch(self, indices, distorted=True, out=None):
+        """Full canvases of several displays, shape (len(indices),) + canvas shape."""
+        indices = list(indices)
+        if out is None:
+            out = np.empty((len(indices),) + self.canvas_shape)
+        for j, i in enumerate(indices):
+            self.paint(i, out[j], distorted)
+        return out
+
+
+def build_store(trials, store_dir, dtype=np.uint8, n_workers=None):
+    """Render trials in a process pool and write them as a sparse store."""
+    writer = SparseWriter(store_dir, dtype=dtype)
+    pool = mp.Pool(n_workers)
+    try:
+        for index, (layout, patches, meta) in enumerate(pool.imap(render_sparse, trials, chunksize=4)):
+            meta['index'] = index
+            writer.add(layout, patches, meta)
+    finally:
+        pool.close()
+        pool.join()
+    writer.close()
+    return SparseStore(store_dir)
+
+
+def export_pngs(store, out_dir, batch_size=16):
+    """Write every trial of a store as a png pair, like stim_gen."""
+    for start in range(0, len(store), batch_size):
+        indices = range(start, min(start + batch_size, len(store)))
+        undistorted = store.reconstruct_batch(indices, distorted=False)
+        distorted = store.reconstruct_batch(indices, distorted=True)
+        for j, i in enumerate(indices):
+            se.save_pair((undistorted[j], distorted[j]), store.manifest[i], out_dir)
+
+
+''' --------  Main function  ---------'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or export a sparse stimulus store.')
+    sub = parser.add_subparsers(dest='command')
+    build = sub.add_parser('build')
+    build.add_argument('store_dir')
+    build.add_argument('experiment', choices=se.EXPERIMENTS)
+    build.add_argument('distortiontype', choices=('bex', 'rf'))
+    build.add_argument('--flanked', action='store_true')
+    build.add_argument('--distflanked', type=int, default=2, choices=(0, 2, 4))
+    build.add_argument('--freqs', type=number, nargs='+')
+    build.add_argument('--amps', type=number, nargs='+')
+    build.add_argument('--reps', type=int, default=10)
+    build.add_argument('--seed', type=int, default=None)
+    build.add_argument('--float', action='store_true', help='store float32 patches')
+    build.add_argument('--workers', type=int, default=None)
+    export = sub.add_parser('export')
+    export.add_argument('store_dir')
+    export.add_argument('out_dir')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        trials = se.plan_trials(args.experiment, args.distortiontype, freqs=args.freqs, amps=args.amps,
+                                reps=args.reps, flanked=args.flanked, distflanked=args.distflanked,
+                                seed=args.seed)
+        store = build_store(trials, args.store_dir, dtype=np.float32 if args.float else np.uint8,
+                            n_workers=args.workers)
+        print('{} trials written to {}'.format(len(store), args.store_dir))
+    elif args.command == 'export':
+        store = SparseStore(args.store_dir)
+        export_pngs(store, args.out_dir)
+        print('{} png pairs written to {}'.format(len(store), args.out_dir))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,562 @@
+'''	++++++++++++++++++     READ ME     ++++++++++++++++++
+Importable stimulus rendering engine for experiments 1 and 3a-3c.
+
+The experiment scripts (experiment1.py, experiment3a.py, ...) parse
+sys.argv at import time, so their helper functions cannot be reused.
+This module renders the same displays from a trial description:
+
+    trials = plan_trials('1', 'bex', flanked=True, reps=1, seed=1)
+    pair, meta = render_pair(trials[0])
+
+pair[0] is the undistorted and pair[1] the distorted display. meta also
+holds summary statistics of the displacement fields applied to the target
+and flanker patches (see displacement_stats). Letter templates are drawn
+from a glyph atlas (glyph_atlas.py; by default the Sloan letters, resized
+like in the experiment scripts, see set_atlas). Letter and
+fixation templates, distortion filters and cosine windows are computed
+once per process and reused, and displays are painted into a canvas
+supplied by the caller (e.g. a slot in shared memory, see stim_pool.py).
+
+Random draws are made from the global numpy random state in the same
+order as stim_gen in the experiment scripts. A trial's seed is passed to
+np.random.seed before rendering, so a given seed always produces the same
+pair of displays, regardless of which process renders it.
+'''
+
+import os
+import numpy as np
+from skimage import io, exposure, transform
+import psyutils as pu
+from glyph_atlas import GlyphAtlas
+
+## bump whenever a change alters the rendered pixels
+ENGINE_VERSION = '1'
+
+## letter dictionary of Sloan letters
+letter_dict = pu.im_data.sloan_letters()
+
+CANVAS_SHAPE = (1024, 1024)
+# letters are resized to 64 pixels and padded by 14 pixels at each side
+LETTER_SIZE = 64
+PATCH_SIZE = 92
+RAMP = 14
+FIXATION_POSITION = (512, 512)
+
+#!!!DO NOT CHANGE THE ORDER: top, left, bottom, right !!!
+# eccentricity = 8deg = 320pixel (40 pixel/deg)
+POSITIONS = ((512, 192), (192, 512), (512, 832), (832, 512))
+POSITION_LABELS = ("t", "l", "b", "r")
+#spacing between letters and flankers in pixels
+SPACING = 320*0.25
+LETTERS = ("D", "H", "K", "N")
+FLANKERS = ("C", "O", "R", "Z")
+
+# default frequencies and amplitudes of the experiment scripts
+DEFAULT_FREQS = {'bex': [2, 4, 6, 8, 16, 32],
+                 'rf': [2, 3, 4, 5, 8, 12]}
+DEFAULT_AMPS = {'bex': [0.5, 1, 1.5, 2, 2.5, 3, 5],
+                'rf': [0.01, 0.0617, 0.1133, 0.1650, 0.2167, 0.2683, 0.32]}
+# fixed flanker amplitude of experiment 3c
+FLANKER_AMPS = {'bex': 6, 'rf': 0.425}
+
+# displacement field summaries (see field_summaries), and the displacement
+# in pixels above which a pixel counts as moved
+FIELD_SUMMARY = ('mean_sq', 'max', 'strain', 'moved')
+MOVED_PIXELS = 1.
+# per-display statistics recorded in the trial meta (see displacement_stats)
+DISPLACEMENT_STATS = tuple(prefix + '_' + name for prefix in ('targ', 'flank')
+                           for name in ('disp_rms', 'disp_max', 'strain', 'moved'))
+
+EXPERIMENTS = ('1', '3a', '3b', '3c')
+
+
+''' --------  Trial planning  ---------'''
+
+def random_arr(start, stop, number, rng=np.random):
+    """Get 'number' random int arrays, each including the numbers from start to stop in a randomized order.
+
+    Draws from rng exactly like random_arr in the experiment scripts.
+
+    Args:
+        start (int): minimum value
+        stop (int): maximum value
+        number (int): number of arrays needed
+        rng: np.random or a np.random.RandomState
+    Returns:
+        rand_arr (int): array with 'number' randomized int arrays, each with values from start to stop
+    """
+    rand_arr = np.ones((number, stop-start), dtype=int)
+    for i in range(0, number):
+        rand = np.arange(start, stop)
+        rng.shuffle(rand)
+        rand_arr[i] = rand
+    return(rand_arr)
+
+
+def randi(start, stop, number, rng=np.random):
+    """Get 'number' different random ints between start and stop.
+
+    Draws from rng exactly like randi in experiment3a.py.
+
+    Args:
+        start (int): minimum value
+        stop (int): maximum value (exclusive)
+        number (int): number of different values
+        rng: np.random or a np.random.RandomState
+    Returns:
+        randnum (list): the random ints in the order they were drawn.
+    """
+    if stop-start < number:
+        raise ValueError("not possible to choose " + str(number) +
+                         " different numbers in this range")
+    randnum = []
+    while len(randnum) < number:
+        t = rng.randint(start, stop)
+        if not t in randnum:
+            randnum.append(t)
+    return randnum
+
+
+def flanker_pos(x, y, spacing):
+    """Get flanker positions (left, bottom, right, top) of a letter at position (x,y)."""
+    return ((x-spacing, y), (x, y+spacing), (x+spacing, y), (x, y-spacing))
+
+
+def plan_trials(experiment, dist_type, freqs=None, amps=None, reps=10,
+                flanked=True, distflanked=2, flank_amplitude=None, seed=None):
+    """List the trials that stim_gen would create for one experiment.
+
+    Args:
+        experiment (string): '1', '3a', '3b' or '3c'
+        dist_type (string): 'bex' or 'rf'
+        freqs (list): distortion frequencies (defaults of the experiment scripts if None)
+        amps (list): distortion amplitudes (defaults of the experiment scripts if None)
+        reps (int): number of repetitions per frequency/amplitude pair
+        flanked (bool): flanked or unflanked displays (experiment 1 only)
+        distflanked (int): number of distorted flankers per target, 0, 2 or 4 (experiment 3 only)
+        flank_amplitude (float): flanker amplitude for experiment 3c
+            (FLANKER_AMPS if None). Other experiments distort flankers
+            with the target amplitude.
+        seed (int): seed for the per-trial seeds.
+    Returns:
+        trials (list): one dict per trial, in the order of stim_gen.
+
+    Example:
+        trials = plan_trials('3a', 'rf', freqs=[4], distflanked=4, seed=2)
+    """
+    if experiment not in EXPERIMENTS:
+        raise ValueError('experiment not known: {}'.format(experiment))
+    if dist_type not in ('bex', 'rf'):
+        raise ValueError('distortiontype not known: {}'.format(dist_type))
+    if freqs is None:
+        freqs = DEFAULT_FREQS[dist_type]
+    if amps is None:
+        amps = DEFAULT_AMPS[dist_type]
+
+    if experiment == '1':
+        distflanked = 0
+    else:
+        flanked = True
+    n_dist_targets = 3 if experiment == '3b' else 1
+
+    n_trials = len(freqs) * len(amps) * reps
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=n_trials)
+
+    trials = []
+    for freq in freqs:
+        for amplitude in amps:
+            for rep in range(0, reps):
+                if experiment == '3c':
+                    this_flank_amp = FLANKER_AMPS[dist_type] if flank_amplitude is None else flank_amplitude
+                else:
+                    this_flank_amp = amplitude
+                trials.append({'experiment': experiment,
+                               'flanked': flanked,
+                               'dist_type': dist_type,
+                               'freq': freq,
+                               'amplitude': amplitude,
+                               'flank_amplitude': this_flank_amp,
+                               'distflanked': distflanked,
+                               'n_dist_targets': n_dist_targets,
+                               'rep': rep,
+                               'seed': int(seeds[len(trials)])})
+    return trials
+
+
+def make_layout(trial, rng=np.random):
+    """Draw the random layout of a trial.
+
+    The draws happen in the same order as in stim_gen/flanked_array:
+    letter and flanker positions, the target(s), then the distorted
+    flankers once for the undistorted and once for the distorted display.
+
+    Args:
+        trial (dict): a trial as returned by plan_trials
+        rng: np.random or a np.random.RandomState
+    Returns:
+        layout (dict): 'patches' lists every letter in the order it is
+            placed (later letters overwrite earlier ones where they overlap),
+            'targ_pos' and 'targ_letter' name the target as in the file names.
+    """
+    letters = LETTERS
+    pos_rand = random_arr(0, len(letters), 5, rng)
+
+    if trial['n_dist_targets'] == 1:
+        targ = [rng.randint(0, len(letters))]
+        named = targ[0]
+    else:
+        # experiment 3b: all letters except the target are distorted
+        targ = randi(0, len(letters), trial['n_dist_targets'], rng)
+        named = [i for i in range(len(letters)) if i not in targ][0]
+
+    dist_flankers = [[], [], [], []]
+    if trial['flanked']:
+        if trial['distflanked'] == 2:
+            # the undistorted display draws its own flankers first
+            for draw in range(2):
+                dist_flankers = [randi(0, 4, 2, rng) for j in range(4)]
+        elif trial['distflanked'] == 4:
+            dist_flankers = [[0, 1, 2, 3] for j in range(4)]
+
+    flanker_positions = [flanker_pos(x, y, SPACING) for x, y in POSITIONS]
+
+    patches = []
+    for i in range(0, len(letters)):
+        x, y = POSITIONS[pos_rand[0][i]]
+        patches.append({'letter': letters[i], 'x': x, 'y': y, 'role': 'target',
+                        'distort': i in targ, 'amplitude': trial['amplitude']})
+        if not trial['flanked']:
+            continue
+        for j in range(0, 4):
+            x, y = flanker_positions[j][pos_rand[j+1][i]]
+            patches.append({'letter': FLANKERS[i], 'x': x, 'y': y, 'role': 'flanker',
+                            'distort': i in dist_flankers[j],
+                            'amplitude': trial['flank_amplitude']})
+
+    return {'patches': patches,
+            'targ_pos': POSITION_LABELS[pos_rand[0][named]],
+            'targ_letter': letters[named]}
+
+
+''' --------  Templates, filters and windows  ---------'''
+
+_templates = {}
+_filters = {}
+_windows = {}
+_rf_grids = {}
+
+## glyph atlas the letter templates are drawn from (None: the Sloan letters
+# of letter_dict, resampled straight from the source; see set_atlas)
+_atlas = None
+_default_atlas = None
+_letter_size = LETTER_SIZE
+
+
+def glyph_atlas():
+    """The glyph atlas letter templates are drawn from."""
+    global _default_atlas
+    if _atlas is not None:
+        return _atlas
+    if _default_atlas is None:
+        _default_atlas = GlyphAtlas(letter_dict, mip=False)
+    return _default_atlas
+
+
+def set_atlas(atlas=None, letter_size=LETTER_SIZE):
+    """Draw letter templates from another glyph atlas and/or at another size.
+
+    Call before rendering (and before starting worker processes, which
+    inherit the atlas when forked). atlas=None restores the Sloan letters.
+
+    Args:
+        atlas (GlyphAtlas): holding every letter of LETTERS and FLANKERS that is used
+        letter_size (int): letter size in pixels, at most PATCH_SIZE - 2*RAMP
+    """
+    global _atlas, _letter_size
+    if letter_size > PATCH_SIZE - 2 * RAMP:
+        raise ValueError('letter_size must be at most {}'.format(PATCH_SIZE - 2 * RAMP))
+    _atlas = atlas
+    _letter_size = int(letter_size)
+    for key in [k for k in _templates if k != 'fixation']:
+        del _templates[key]
+
+
+def glyph_key():
+    """Identifies a non-default atlas and letter size for cache keys (None for the default)."""
+    if _atlas is None and _letter_size == LETTER_SIZE:
+        return None
+    return {'atlas': glyph_atlas().key, 'letter_size': _letter_size}
+
+
+def letter_template(letter):
+    """The undistorted, padded 92x92 patch of a letter (cached)."""
+    if letter not in _templates:
+        # letter resized to have a padding area of 14 pixels at each side
+        im = glyph_atlas().template(letter, _letter_size)
+        pad = np.ones((PATCH_SIZE, PATCH_SIZE))
+        _templates[letter] = pu.image.put_rect_in_rect(im, pad)
+    return _templates[letter]
+
+
+def fixation_template():
+    """The resized fixation cross (cached)."""
+    if 'fixation' not in _templates:
+        im = pu.misc.fixation_cross()
+        pad = np.ones((272, 272))
+        im = pu.image.put_rect_in_rect(im, pad)
+        _templates['fixation'] = transform.resize(im, (24, 24))
+    return _templates['fixation']
+
+
+def cos_window(size):
+    """Cosine window that reduces to zero over the padding region (cached)."""
+    if size not in _windows:
+        _windows[size] = pu.image.cos_win_2d(im_x=size, ramp=RAMP)
+    return _windows[size]
+
+
+def bex_filter(size, f_peak):
+    """Log-exponential filter for the bandpass noise offsets (cached)."""
+    key = (size, f_peak)
+    if key not in _filters:
+        _filters[key] = pu.image.make_filter(im_x=size, filt_type="log_exp",
+                                             f_peak=f_peak, bw=0.5)
+    return _filters[key]
+
+
+def rf_grid(size):
+    """Cartesian grid, radial distance and angle used by the RF distortion (cached)."""
+    if size not in _rf_grids:
+        x = np.linspace(-20, 20, num=size)
+        xx, yy = np.meshgrid(x, x)
+        rad_dist = (xx**2 + yy**2)**0.5
+        _rf_grids[size] = (rad_dist, np.arctan2(xx, -yy))
+    return _rf_grids[size]
+
+
+''' --------  Distortions  ---------'''
+
+def bex_offsets(scale, f_peak, size=PATCH_SIZE):
+    """Positional offsets of the bandpass noise (Bex, 2010) distortion.
+
+    Args:
+        scale (float): amplitude of distortion in pixels.
+        f_peak (float): peak frequency of the filter.
+        size (int): side length of the patch.
+    Returns:
+        x_offset, y_offset (float): horizontal and vertical offsets in pixels.
+    """
+    filt = bex_filter(size, f_peak)
+    cos_win = cos_window(size)
+    x_offset = pu.image.make_filtered_noise(filt) * cos_win * scale
+    y_offset = pu.image.make_filtered_noise(filt) * cos_win * scale
+    return x_offset, y_offset
+
+
+def rf_offsets(amplitude, frequency, size=PATCH_SIZE):
+    """Positional offsets of the radial frequency (Dickinson et al., 2010) distortion.
+
+    Args:
+        amplitude (float): modulation amplitude as a proportion of the radius.
+        frequency (float): the frequency of modulation in 2*pi radians.
+        size (int): side length of the patch.
+    Returns:
+        x_offset, y_offset (float): horizontal and vertical offsets in pixels.
+    """
+    rad_dist, base_angle = rf_grid(size)
+    # randomise phase
+    rand_num = np.random.rand()*2*np.pi
+    ang_dist = ((rand_num + base_angle) % (2*np.pi)) - np.pi
+    rf_dist = rad_dist*(1+amplitude*(np.sin(frequency*ang_dist)))
+    delta_rad = rf_dist - rad_dist
+    cos_win = cos_window(size)
+    x_offset = delta_rad * np.cos(ang_dist) * cos_win
+    y_offset = delta_rad * np.sin(ang_dist) * cos_win
+    return x_offset, y_offset
+
+
+def distortion_offsets(dist_type, amplitude, freq, size=PATCH_SIZE):
+    """Offsets of a 'bex' or 'rf' distortion, see bex_offsets and rf_offsets."""
+    if dist_type == 'bex':
+        return bex_offsets(amplitude, freq, size)
+    elif dist_type == 'rf':
+        return rf_offsets(amplitude, freq, size)
+    raise ValueError('distortiontype not known: {}'.format(dist_type))
+
+
+def field_summaries(x_offsets, y_offsets):
+    """Per-field summaries of displacement fields, computed for a stack at once.
+
+    Args:
+        x_offsets, y_offsets (float): (k, size, size) offsets in pixels
+    Returns:
+        (k, 4) array with the columns of FIELD_SUMMARY: mean squared and max
+        displacement, mean absolute local strain (Frobenius norm of the
+        symmetric displacement gradient) and the fraction of pixels moved
+        by more than MOVED_PIXELS.
+    """
+    x_offsets = np.asarray(x_offsets, dtype=float).reshape((-1,) + np.shape(x_offsets)[-2:])
+    y_offsets = np.asarray(y_offsets, dtype=float).reshape(x_offsets.shape)
+    d2 = x_offsets**2 + y_offsets**2
+    dxy, dxx = np.gradient(x_offsets, axis=(1, 2))
+    dyy, dyx = np.gradient(y_offsets, axis=(1, 2))
+    exy = 0.5 * (dxy + dyx)
+    strain = np.sqrt(dxx**2 + dyy**2 + 2 * exy**2)
+    k = len(d2)
+    return np.column_stack([d2.reshape(k, -1).mean(axis=1),
+                            np.sqrt(d2.reshape(k, -1).max(axis=1)),
+                            strain.reshape(k, -1).mean(axis=1),
+                            (d2 > MOVED_PIXELS**2).reshape(k, -1).mean(axis=1)])
+
+
+def displacement_stats(roles, summaries):
+    """Displacement statistics of the distorted patches of a display.
+
+    Args:
+        roles (list): 'target' or 'flanker' for every distorted patch
+        summaries (float): (n_patches, 4) rows of field_summaries
+    Returns:
+        stats (dict): for prefix 'targ' and 'flank', <prefix>_disp_rms and
+            <prefix>_disp_max (pixels), <prefix>_strain and <prefix>_moved
+            (fraction of pixels moved more than MOVED_PIXELS) over all
+            distorted patches of that role; NaN if there are none.
+    """
+    summaries = np.asarray(summaries, dtype=float).reshape(-1, len(FIELD_SUMMARY))
+    roles = np.asarray(roles, dtype=str)
+    values = []
+    for role in ('target', 'flanker'):
+        s = summaries[roles == role]
+        if len(s):
+            # all patches have the same size, so pixel means pool as patch means
+            values.extend((np.sqrt(s[:, 0].mean()), s[:, 1].max(), s[:, 2].mean(), s[:, 3].mean()))
+        else:
+            values.extend((np.nan,) * 4)
+    stats = dict((k, float(v)) for k, v in zip(DISPLACEMENT_STATS, values))
+    return stats
+
+
+def distort_patch(im, x_offset, y_offset):
+    """Apply positional offsets to an image."""
+    return pu.image.grid_distort(im, x_offset=x_offset, y_offset=y_offset,
+                                 method="linear", fill_method=1)
+
+
+''' --------  Rendering  ---------'''
+
+def paste(im, big_array, x, y):
+    """Place im centred at (x,y) into big_array, in place.
+
+    Same placement as pu.image.put_rect_in_rect, without copying big_array.
+    """
+    h, w = im.shape
+    y0 = int(y) - h // 2
+    x0 = int(x) - w // 2
+    big_array[y0:y0+h, x0:x0+w] = im
+    return big_array
+
+
+def render_display(layout, trial, big_array, distorted=True, fields=None):
+    """Paint one display of a trial into big_array.
+
+    Args:
+        layout (dict): the trial layout from make_layout
+        trial (dict): the trial
+        big_array (float): canvas of CANVAS_SHAPE, overwritten
+        distorted (bool): apply the distortions or render the undistorted twin
+        fields (list): if given, (patch index, x_offset, y_offset) is appended
+            for every distorted patch.
+    Returns:
+        big_array (float): the display.
+    """
+    big_array[...] = 1.
+    for idx, patch in enumerate(layout['patches']):
+        im = letter_template(patch['letter'])
+        if distorted and patch['distort']:
+            x_offset, y_offset = distortion_offsets(trial['dist_type'], patch['amplitude'], trial['freq'])
+            im = distort_patch(im, x_offset, y_offset)
+            if fields is not None:
+                fields.append((idx, x_offset, y_offset))
+        paste(im, big_array, patch['x'], patch['y'])
+    paste(fixation_template(), big_array, FIXATION_POSITION[0], FIXATION_POSITION[1])
+    return big_array
+
+
+def image_name(trial, targ_pos, targ_letter, distorted=True):
+    """File name of a display, as written by stim_gen."""
+    dist_type_out = trial['dist_type'] if distorted else trial['dist_type'] + '_undistorted'
+    name = (("flanked_" if trial['flanked'] else "unflanked_") + dist_type_out +
+            '_freq_' + str(trial['freq']) + "_amplitude_" + str(trial['amplitude']) +
+            "_rep_" + str(trial['rep']) + "_" + targ_pos + "_" + targ_letter)
+    if trial['flanked']:
+        name += "_" + str(SPACING/40)
+    if trial['experiment'] == '3c':
+        name += "_ampflank_" + str(trial['flank_amplitude'])
+    return name + ".png"
+
+
+def trial_meta(trial, layout):
+    """Flat description of a rendered trial (one manifest row)."""
+    meta = dict(trial)
+    meta['targ_pos'] = layout['targ_pos']
+    meta['targ_letter'] = layout['targ_letter']
+    meta['undistorted_name'] = image_name(trial, layout['targ_pos'], layout['targ_letter'], distorted=False)
+    meta['im_name'] = image_name(trial, layout['targ_pos'], layout['targ_letter'], distorted=True)
+    meta['engine_version'] = ENGINE_VERSION
+    return meta
+
+
+def render_pair(trial, out=None, fields=None):
+    """Render the undistorted and distorted display of a trial.
+
+    Args:
+        trial (dict): a trial as returned by plan_trials
+        out (float): array of shape (2,) + CANVAS_SHAPE to render into
+            (allocated if None)
+        fields (list): collects the displacement fields, see render_display
+    Returns:
+        out (float): out[0] undistorted, out[1] distorted display
+        meta (dict): trial_meta of the trial plus its displacement_stats
+    """
+    if out is None:
+        out = np.empty((2,) + CANVAS_SHAPE)
+    if fields is None:
+        fields = []
+    n_before = len(fields)
+    np.random.seed(trial['seed'])
+    layout = make_layout(trial)
+    render_display(layout, trial, out[0], distorted=False)
+    render_display(layout, trial, out[1], distorted=True, fields=fields)
+    meta = trial_meta(trial, layout)
+    meta.update(display_stats(layout, fields[n_before:]))
+    return out, meta
+
+
+def display_stats(layout, fields):
+    """displacement_stats of the (patch index, x_offset, y_offset) fields of a display."""
+    if not fields:
+        return displacement_stats([], np.empty((0, len(FIELD_SUMMARY))))
+    idx, x_offsets, y_offsets = zip(*fields)
+    roles = [layout['patches'][i]['role'] for i in idx]
+    return displacement_stats(roles, field_summaries(np.stack(x_offsets), np.stack(y_offsets)))
+
+
+def display_bytes(big_array):
+    """The 8 bit image save_display writes for a display."""
+    im = exposure.rescale_intensity(big_array, out_range=(0, 1))
+    # scipy.misc.imsave byte-scales with rounding half up
+    return (im * 255 + 0.5).astype(np.uint8)
+
+
+def save_display(fname, big_array):
+    """Save a display as 8 bit png, scaled like scipy.misc.imsave in stim_gen."""
+    io.imsave(fname, display_bytes(big_array), check_contrast=False)
+
+
+def save_pair(pair, meta, out_dir):
+    """Save a rendered pair into out_dir/undistorted and out_dir/distorted."""
+    for sub_dir, im, name in (('undistorted', pair[0], meta['undistorted_name']),
+                              ('distorted', pair[1], meta['im_name'])):
+        this_dir = os.path.join(out_dir, sub_dir)
+        if not os.path.exists(this_dir):
+            os.makedirs(this_dir)
+        save_display(os.path.join(this_dir, name), im)
@@ -0,0 +1,251 @@
+'''	++++++++++++++++++     READ ME     ++++++++++++++++++
+Multi-process stimulus generation through a shared-memory canvas ring.
+
+A finished display pair is 2 x 1024 x 1024 float64 (16 MB). Instead of
+pickling it back to the parent, worker processes render into a slot of a
+preallocated ring of canvases in multiprocessing.shared_memory and only
+send the slot index and the trial metadata over a queue. A single writer
+process saves the pair from the slot and hands the slot back to the
+workers. The ring size caps the memory in flight:
+ring_size * 16 MB for the default canvas.
+
+Parameters:
+experiment (1/3a/3b/3c)
+distortiontype (bex/rf)
+
+e.g. 'python stim_pool.py 1 bex --flanked --reps 10 --workers 8 --ring-size 16'
+
+With --cache-dir, pairs already in the render cache (render_cache.py) are
+copied instead of re-rendered, so only changed conditions are rendered.
+With --bank, displays are assembled from a patch bank (patch_bank.py).
+With --metrics, the workers also score every pair (pair_metrics.py) and
+the scores are added to the manifest and written to pair_metrics.parquet.
+Pairs are scored after the rescaling and 8 bit rounding of the saved
+images, so the scores equal those of pair_metrics.py on the png files.
+
+Images are saved to <out-dir>/undistorted and <out-dir>/distorted with the
+file names of the experiment scripts, plus a manifest.csv listing every
+trial (seed, layout summary, file names, displacement statistics).
+'''
+
+import os
+import csv
+import argparse
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import stim_engine as se
+from render_cache import RenderCache, cached_render_pair
+from patch_bank import PatchBank
+import pair_metrics
+
+
+class CanvasRing(object):
+    """A ring of preallocated display slots in one shared-memory block.
+
+    Args:
+        ring_size (int): number of slots
+        shape (tuple): shape of one slot, default one display pair
+        dtype: dtype of the canvases
+        name (string): attach to the existing block of this name instead of
+            creating a new one (used by the worker and writer processes)
+
+    Example:
+        ring = CanvasRing(ring_size=4)
+        pair, meta = se.render_pair(trial, out=ring.slot(0))
+        ring.close()
+    """
+
+    def __init__(self, ring_size=8, shape=(2,) + se.CANVAS_SHAPE, dtype=np.float64, name=None):
+        self.ring_size = ring_size
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = ring_size * int(np.prod(self.shape)) * self.dtype.itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            # only the creating process unlinks the block
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.slots = np.ndarray((ring_size,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def nbytes(self):
+        return self.slots.nbytes
+
+    def attach_args(self):
+        """Arguments that re-create this ring in another process."""
+        return (self.ring_size, self.shape, self.dtype.str, self.shm.name)
+
+    def slot(self, idx):
+        """View of slot idx."""
+        return self.slots[idx]
+
+    def close(self):
+        """Release the block (and remove it, if this process created it)."""
+        self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+''' --------  Processes  ---------'''
+
+def _render_worker(ring_args, tasks, free, done, cache_args=None, bank=None, metrics=False):
+    ring = CanvasRing(*ring_args)
+    cache = RenderCache(*cache_args) if cache_args else None
+    bank = PatchBank(bank) if bank else None
+    try:
+        while True:
+            trial = tasks.get()
+            if trial is None:
+                break
+            slot = free.get()
+            if bank is not None:
+                pair, meta = bank.assemble_pair(trial, out=ring.slot(slot))
+            elif cache is None:
+                pair, meta = se.render_pair(trial, out=ring.slot(slot))
+            else:
+                pair, meta = cached_render_pair(trial, cache, out=ring.slot(slot))
+            if metrics:
+                # score the pixels save_display writes, so the scores equal those of the pngs
+                saved = np.stack([se.display_bytes(im) for im in pair]) / 255.
+                meta.update((k, float(v[0])) for k, v in pair_metrics.pair_metrics(saved).items())
+            done.put((slot, meta))
+    finally:
+        done.put(None)
+        ring.close()
+
+
+def _writer(ring_args, free, done, n_workers, writer, out_dir, metrics=False):
+    ring = CanvasRing(*ring_args)
+    rows = []
+    finished = 0
+    while finished < n_workers:
+        item = done.get()
+        if item is None:
+            finished += 1
+            continue
+        slot, meta = item
+        writer(ring.slot(slot), meta, out_dir)
+        free.put(slot)
+        rows.append(meta)
+    ring.close()
+    if rows:
+        write_manifest(os.path.join(out_dir, 'manifest.csv'), rows)
+        if metrics:
+            rows = sorted(rows, key=lambda r: (r.get('index', 0)))
+            pair_metrics.write_metrics(os.path.join(out_dir, 'pair_metrics.parquet'), rows)
+
+
+def write_manifest(fname, rows):
+    """Write one row per trial, in the order of the trial plan, to a csv file."""
+    fields = []
+    for row in rows:
+        fields.extend(k for k in row if k not in fields)
+    rows = sorted(rows, key=lambda r: (r.get('index', 0)))
+    with open(fname, 'w') as f:
+        w = csv.DictWriter(f, fieldnames=fields)
+        w.writeheader()
+        w.writerows(rows)
+
+
+def generate(trials, out_dir, n_workers=None, ring_size=8, writer=se.save_pair,
+             cache_dir=None, cache_bytes=2*1024**3, bank=None, metrics=False):
+    """Render trials in parallel and save them through a single writer process.
+
+    Args:
+        trials (list): trials from se.plan_trials
+        out_dir (string): output directory
+        n_workers (int): number of render processes (cpu count - 1 if None)
+        ring_size (int): number of shared canvas slots; caps the memory in
+            flight to ring_size * 16 MB
+        writer: function(pair, meta, out_dir) called in the writer process
+            for each rendered pair. The pair is a view into shared memory
+            and must not be kept after the call returns.
+        cache_dir (string): if given, reuse pairs from this render cache
+            (see render_cache.py) and add the ones that are missing
+        cache_bytes (int): size limit of the render cache
+        bank (string): if given, assemble the displays from this patch bank
+            (see patch_bank.py) instead of rendering them
+        metrics (bool): score every pair with pair_metrics and write
+            out_dir/pair_metrics.parquet
+    Returns:
+        n (int): the number of rendered trials.
+    """
+    if n_workers is None:
+        n_workers = max(1, mp.cpu_count() - 1)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    ring = CanvasRing(ring_size)
+    free, tasks, done = mp.Queue(), mp.Queue(), mp.Queue()
+    for slot in range(ring_size):
+        free.put(slot)
+    for index, trial in enumerate(trials):
+        trial = dict(trial, index=index)
+        tasks.put(trial)
+    for i in range(n_workers):
+        tasks.put(None)
+
+    cache_args = (cache_dir, cache_bytes) if cache_dir else None
+    procs = [mp.Process(target=_render_worker, args=(ring.attach_args(), tasks, free, done, cache_args, bank, metrics))
+             for i in range(n_workers)]
+    procs.append(mp.Process(target=_writer,
+                            args=(ring.attach_args(), free, done, n_workers, writer, out_dir, metrics)))
+    try:
+        for p in procs:
+            p.start()
+        # a failed process would leave the others waiting for slots forever
+        while any(p.is_alive() for p in procs):
+            if any(p.exitcode not in (None, 0) for p in procs):
+                for p in procs:
+                    p.terminate()
+            procs[-1].join(0.1)
+    finally:
+        ring.close()
+    failed = [p.exitcode for p in procs if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('{} generation process(es) failed'.format(len(failed)))
+    return len(trials)
+
+
+''' --------  Main function  ---------'''
+
+def number(s):
+    """Parse a frequency or amplitude, keeping integers integer (they appear in the file names)."""
+    return int(s) if s.lstrip('-').isdigit() else float(s)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate stimuli with several processes.')
+    parser.add_argument('experiment', choices=se.EXPERIMENTS)
+    parser.add_argument('distortiontype', choices=('bex', 'rf'))
+    parser.add_argument('--flanked', action='store_true', help='flanked displays (experiment 1)')
+    parser.add_argument('--distflanked', type=int, default=2, choices=(0, 2, 4),
+                        help='number of distorted flankers (experiment 3)')
+    parser.add_argument('--freqs', type=number, nargs='+', help='frequencies (script defaults if omitted)')
+    parser.add_argument('--amps', type=number, nargs='+', help='amplitudes (script defaults if omitted)')
+    parser.add_argument('--reps', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--ring-size', type=int, default=8)
+    parser.add_argument('--out-dir', default=os.path.join(os.getcwd(), 'stimuli_out'))
+    parser.add_argument('--cache-dir', default=None, help='render cache directory')
+    parser.add_argument('--cache-size', type=float, default=2., help='render cache size limit in GB')
+    parser.add_argument('--bank', default=None, help='assemble displays from this patch bank')
+    parser.add_argument('--metrics', action='store_true', help='score every pair (pair_metrics.py)')
+    args = parser.parse_args(argv)
+
+    trials = se.plan_trials(args.experiment, args.distortiontype, freqs=args.freqs, amps=args.amps,
+                            reps=args.reps, flanked=args.flanked, distflanked=args.distflanked,
+                            seed=args.seed)
+    n = generate(trials, args.out_dir, n_workers=args.workers, ring_size=args.ring_size,
+                 cache_dir=args.cache_dir, cache_bytes=int(args.cache_size * 1024**3),
+                 bank=args.bank, metrics=args.metrics)
+    print('{} stimulus pairs written to {}'.format(n, args.out_dir))
+
+
+if __name__ == '__main__':
+    main()